@@ -0,0 +1,215 @@
+"""Per-user admission control for write routes.
+
+Each write route belongs to a route class (ROUTE_CLASSES), and each logged
+in user has a token bucket per class. A write takes a token; an empty
+bucket gets a 429 with Retry-After, from a before_request hook that runs
+ahead of every other one, so a rejected write never loads the user or
+touches the database. Buckets hold up to N tokens and refill at N per
+period, as set by WRITE_RATE_LIMITS:
+
+    RATE_LIMIT_MESSAGE=10/minute
+    RATE_LIMIT_LIKE=120/minute
+    RATE_LIMIT_FOLLOW=30/minute
+    RATE_LIMIT_BATCH=10/minute     (a call, of up to BATCH_MAX_ITEMS)
+
+RATE_LIMIT_BACKEND picks where buckets are kept:
+
+- "memory" (the default): in each worker, so a user gets the rate per
+  worker. Free, but only approximate under several workers.
+- "postgres": the unlogged rate_limit_buckets table, one upsert per write
+  on its own connection, so the rate holds across every worker.
+
+Rejections are counted in warbler_write_rejections_total.
+"""
+
+import time
+from threading import Lock
+
+from flask import Response, request, session
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from metrics import counter
+from models import db, RateLimitBucket
+
+ROUTE_CLASSES = {
+    'warbler.add_message': 'message',
+    'warbler.like_or_unlike_message_homepage': 'like',
+    'warbler.start_following': 'follow',
+    'warbler.stop_following': 'follow',
+    'warbler.add_messages_batch': 'batch',
+    'warbler.add_follows_batch': 'batch',
+}
+
+DEFAULT_LIMITS = {
+    'message': '10/minute',
+    'like': '120/minute',
+    'follow': '30/minute',
+    'batch': '10/minute',
+}
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600}
+
+# The memory backend forgets full buckets past this many users.
+MAX_MEMORY_BUCKETS = 100_000
+
+rejections = counter(
+    'warbler_write_rejections_total',
+    "Writes refused with 429 by admission control, by route class.")
+
+
+def parse_limit(text):
+    """Parse "N/period" into (capacity, tokens per second)."""
+
+    count, period = text.split('/')
+    count = int(count)
+
+    return count, count / PERIODS[period]
+
+
+def limits_from_env(environ):
+    """Return {route class: "N/period"} for app.config's WRITE_RATE_LIMITS."""
+
+    return {
+        route_class: environ.get(f'RATE_LIMIT_{route_class.upper()}', default)
+        for route_class, default in DEFAULT_LIMITS.items()
+    }
+
+
+class MemoryBuckets:
+    """Token buckets in this process."""
+
+    def __init__(self):
+        self.lock = Lock()
+        # {key: (tokens, time counted, time it will be full)}
+        self.buckets = {}
+
+    def take(self, key, capacity, rate, now=None):
+        """Take a token from `key`'s bucket; return 0 if there was one,
+        otherwise the seconds until there will be."""
+
+        now = time.time() if now is None else now
+
+        with self.lock:
+            tokens, counted_at, _ = self.buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - counted_at) * rate)
+            taken = tokens >= 1
+
+            if taken:
+                tokens -= 1
+
+            self.buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+
+            if len(self.buckets) > MAX_MEMORY_BUCKETS:
+                # A bucket that has refilled is the same as no bucket.
+                self.buckets = {
+                    key: bucket for key, bucket in self.buckets.items()
+                    if bucket[2] > now
+                }
+
+        return 0 if taken else (1 - tokens) / rate
+
+    def reset(self):
+        with self.lock:
+            self.buckets = {}
+
+
+class PostgresBuckets:
+    """Token buckets in the rate_limit_buckets table, shared by workers."""
+
+    def take(self, key, capacity, rate, now=None):
+        now = time.time() if now is None else now
+
+        def refilled(tokens, counted_at):
+            return func.least(capacity, tokens + (now - counted_at) * rate)
+
+        statement = insert(RateLimitBucket).values(
+            key=key, tokens=capacity - 1, updated_at=now)
+        bucket = RateLimitBucket.__table__.c
+
+        with db.engine.begin() as conn:
+            # An empty bucket isn't updated, so no row comes back.
+            taken = conn.scalar(
+                statement.on_conflict_do_update(
+                    index_elements=[bucket.key],
+                    set_={
+                        'tokens': refilled(bucket.tokens, bucket.updated_at) - 1,
+                        'updated_at': now,
+                    },
+                    where=refilled(bucket.tokens, bucket.updated_at) >= 1)
+                .returning(bucket.key))
+
+            if taken is not None:
+                return 0
+
+            tokens = conn.scalar(
+                select(refilled(bucket.tokens, bucket.updated_at))
+                .where(bucket.key == key))
+
+        return (1 - tokens) / rate
+
+    def reset(self):
+        with db.engine.begin() as conn:
+            conn.execute(RateLimitBucket.__table__.delete())
+
+
+class Admission:
+    """Applies the write rate limits to an app's requests."""
+
+    def __init__(self):
+        self.limits = {}
+        self.backend = MemoryBuckets()
+        self.user_key = None
+        self.app = None
+
+    def init_app(self, app, user_key):
+        """Install the check, for users logged in as session[`user_key`].
+
+        Call before any other before_request hook is registered, so it runs
+        first.
+        """
+
+        app.before_request(self.check)
+
+        if self.app not in (None, app):
+            return  # configured by the first app; see create_app
+        self.app = app
+
+        self.user_key = user_key
+
+        self.limits = {
+            route_class: parse_limit(limit)
+            for route_class, limit in app.config.get(
+                'WRITE_RATE_LIMITS', DEFAULT_LIMITS).items()
+        }
+
+        if app.config.get('RATE_LIMIT_BACKEND', 'memory') == 'postgres':
+            self.backend = PostgresBuckets()
+
+    def check(self):
+        """Refuse the request with 429 if its user is out of tokens."""
+
+        if request.method != 'POST':
+            return None
+
+        route_class = ROUTE_CLASSES.get(request.endpoint)
+        user_id = session.get(self.user_key)
+
+        if route_class is None or user_id is None:
+            return None
+
+        capacity, rate = self.limits[route_class]
+        wait = self.backend.take(f"{route_class}:{user_id}", capacity, rate)
+
+        if not wait:
+            return None
+
+        rejections.inc(route_class=route_class)
+
+        return Response(
+            "Too many requests, please slow down.\n", 429,
+            mimetype="text/plain",
+            headers={'Retry-After': str(max(1, round(wait)))})
+
+
+admission = Admission()
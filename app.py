@@ -1,50 +1,173 @@
+"""Warbler, a Twitter clone.
+
+Build the app with create_app(), naming a config profile from config.py:
+
+    gunicorn "app:create_app('production')"
+
+Importing this module doesn't read the environment or connect to anything.
+`from app import app` still works for scripts and tests: it builds an app
+from the environment on first use and pushes an app context for it.
+"""
+
+import hashlib
 import os
+import time
+from datetime import datetime
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import (
+    Flask, Blueprint, render_template, request, flash, redirect, session, g,
+    Response, url_for, abort, stream_with_context, jsonify,
+    send_from_directory, current_app,
+)
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import IntegrityError, DataError
+from werkzeug.datastructures import MultiDict
 from werkzeug.exceptions import Unauthorized
 # from psycopg2 import
 
+from admission import admission
+from config import PROFILES, config_from_env
 from forms import UserAddForm, LoginForm, MessageForm, CSRFProtectForm, UserEditForm
-from models import db, connect_db, User, Message, DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL
-
-load_dotenv()
+from models import (
+    db, connect_db, User, Follow, DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL,
+)
+from shards import shards, ShardMoving
+from replicas import replicas
+from follow_graph import follow_graph
+import compression
+import export
+import hashtags
+import images
+import invalidation
+import jobs
+import likes
+import recommendations
+import trending
+from metrics import render as render_metrics, scrape_allowed
+from templating import init_bytecode_cache, init_trim_whitespace
+from pooling import engine_options
+from profiling import profiler
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+# Users or messages on one page of a paginated list
+PAGE_SIZE = 50
+
+# Messages or follows in one call to the batch API
+BATCH_MAX_ITEMS = 100
+
+bp = Blueprint('warbler', __name__)
+bp.add_app_template_filter(hashtags.link_hashtags)
+bp.add_app_template_filter(images.avatar)
+bp.add_app_template_filter(images.header)
+
+
+def create_app(config=None):
+    """Create a Warbler app.
+
+    `config` is a profile name from config.PROFILES or a config class; by
+    default the WARBLER_CONFIG environment variable picks the profile
+    ("development" if it's unset). Only development loads the debug toolbar.
+
+    The shard and replica routers, the follow graph, the like buffer, the
+    invalidation bus, admission control and the profiler are process-wide:
+    the first app created in a process configures them, and later apps get
+    their request hooks but share them as they are, rather than closing
+    the first app's connections.
+    """
+
+    load_dotenv()
+
+    if config is None:
+        config = os.environ.get('WARBLER_CONFIG', 'development')
+
+    if isinstance(config, str):
+        config = PROFILES[config]
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+    app.config.update(config_from_env(os.environ))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+
+    # First, so a rejected write does no other work
+    admission.init_app(app, user_key=CURR_USER_KEY)
+
+    # Before anything else adds an after_request function, so it's the last
+    # to run and compresses the finished response
+    compression.init_app(app)
+    profiler.init_app(app)
+
+    if app.config['DEBUG_TOOLBAR']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    init_bytecode_cache(app)
+    init_trim_whitespace(app)
+    connect_db(app)
+    shards.init_app(app)
+    replicas.init_app(app)
+    follow_graph.init_app(app)
+    likes.buffer.init_app(app)
+    trending.counters.init_app(app)
+    invalidation.bus.init_app(app)
+    app.register_blueprint(bp)
+
+    return app
+
+
+def __getattr__(name):
+    """Build the module-level `app` the first time it's imported."""
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-toolbar = DebugToolbarExtension(app)
+    if name != 'app':
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-connect_db(app)
+    app = create_app()
+    app.app_context().push()
+    globals()['app'] = app
+
+    return app
+
+
+@bp.app_context_processor
+def shard_counts():
+    """Messages and likes may live on other shards than their users, so
+    templates count them through the shard router rather than through
+    relationships."""
+
+    return dict(
+        count_messages=shards.count_messages,
+        count_likes=shards.count_likes,
+    )
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
         g.user = User.query.get(session[CURR_USER_KEY])
 
+        # Logged out everywhere once they've asked to be deleted
+        if g.user is not None and g.user.pending_deletion:
+            g.user = None
+
     else:
         g.user = None
 
 
-@app.before_request
+@bp.before_app_request
 def add_CSRF_to_g():
     """Adds a global property to access the CSRFProtectForm"""
 
-    g.csrf_form = CSRFProtectForm()
+    # A JSON body (the batch API) isn't form data.
+    g.csrf_form = (
+        CSRFProtectForm(formdata=None) if request.is_json else CSRFProtectForm())
 
 
 def do_login(user):
@@ -60,7 +183,18 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+def get_user_or_404(user_id):
+    """Find user `user_id`, unless they're being deleted."""
+
+    user = db.session.get(User, user_id)
+
+    if user is None or user.pending_deletion:
+        abort(404)
+
+    return user
+
+
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -84,6 +218,8 @@ def signup():
                 email=form.email.data,
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
+            db.session.flush()
+            enqueue_image_ingest(user)
             db.session.commit()
 
         except IntegrityError:
@@ -98,7 +234,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login and redirect to homepage on success."""
 
@@ -120,7 +256,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.post('/logout')
+@bp.post('/logout')
 def logout():
     """Handle logout of user and redirect to homepage."""
 
@@ -137,7 +273,7 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.get('/users')
+@bp.get('/users')
 def list_users():
     """Page with listing of users.
 
@@ -150,15 +286,20 @@ def list_users():
 
     search = request.args.get('q')
 
+    users = User.query.filter_by(pending_deletion=False)
+
     if not search:
-        users = User.query.all()
+        users = users.all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = users.filter(User.username.like(f"%{search}%")).all()
 
-    return render_template('users/index.html', users=users)
+    following_ids = g.user.following_ids([user.id for user in users])
 
+    return render_template(
+        'users/index.html', users=users, following_ids=following_ids)
 
-@app.get('/users/<int:user_id>')
+
+@bp.get('/users/<int:user_id>')
 def show_user(user_id):
     """Show user profile."""
 
@@ -166,48 +307,159 @@ def show_user(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = get_user_or_404(user_id)
+    messages = shards.recent_by_users([user.id])
+    liked_ids = likes.liked_message_ids(g.user.id, messages)
+
+    return render_template(
+        'users/show.html', user=user, messages=messages, liked_ids=liked_ids)
+
+
+def before_cursor():
+    """Where a keyset page starts: the (timestamp, id) of the last row on
+    the previous page, from the `before` and `before_id` query parameters.
+
+    None for the first page.
+    """
+
+    before_time = request.args.get('before', type=datetime.fromisoformat)
+    before_id = request.args.get('before_id', type=int)
+
+    return (before_time, before_id) if before_time and before_id else None
+
+
+def render_messages_page(template, rows, endpoint, url_args, **context):
+    """Render a page of the (message, timestamp) `rows`.
+
+    `rows` has up to PAGE_SIZE + 1 entries; an extra one means there's a
+    next page, which starts after the last message shown. Its URL is
+    `endpoint` with `url_args` and before_cursor's parameters. The template
+    gets `messages`, `liked_ids`, `next_page` and `context`.
+    """
+
+    page = rows[:PAGE_SIZE]
+    messages = [msg for msg, _ in page]
+
+    next_page = None
+    if len(rows) > PAGE_SIZE:
+        last_msg, last_time = page[-1]
+        next_page = url_for(
+            endpoint, **url_args,
+            before=last_time.isoformat(), before_id=last_msg.id)
+
+    return render_template(
+        template, messages=messages,
+        liked_ids=likes.liked_message_ids(g.user.id, messages),
+        next_page=next_page, **context)
+
+
+def render_follows_page(template, endpoint, user, load_page):
+    """Render a page of the users `load_page(limit, after)` returns.
 
-    return render_template('users/show.html', user=user)
+    The next page starts after the `after` user id, the last one shown.
+    Whether g.user follows each of them is looked up in one query.
+    """
+
+    users = load_page(PAGE_SIZE + 1, request.args.get('after', type=int))
+    page = users[:PAGE_SIZE]
+
+    next_page = None
+    if len(users) > PAGE_SIZE:
+        next_page = url_for(endpoint, user_id=user.id, after=page[-1].id)
 
+    return render_template(
+        template, user=user, users=page,
+        following_ids=g.user.following_ids([other.id for other in page]),
+        next_page=next_page)
 
-@app.get('/users/<int:user_id>/following')
+
+@bp.get('/users/<int:user_id>/following')
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show a page of the people this user is following."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = get_user_or_404(user_id)
+    return render_follows_page(
+        'users/following.html', 'warbler.show_following', user,
+        user.following_page)
 
 
-@app.get('/users/<int:user_id>/followers')
+@bp.get('/users/<int:user_id>/followers')
 def show_followers(user_id):
-    """Show list of followers of this user."""
+    """Show a page of the followers of this user."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = get_user_or_404(user_id)
+    return render_follows_page(
+        'users/followers.html', 'warbler.show_followers', user,
+        user.followers_page)
 
 
-@app.get('/users/<int:user_id>/likes')
+@bp.get('/users/<int:user_id>/likes')
 def show_liked_warbles(user_id):
-    """Show list of the messages the user has liked."""
+    """Show a page of the messages the user has liked, most recent first.
+
+    The next page starts after the `before` (time liked) and `before_id`
+    (message id) of the last message shown.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user)
+    user = get_user_or_404(user_id)
+    rows = shards.liked_page(user.id, PAGE_SIZE + 1, before_cursor())
+
+    return render_messages_page(
+        'users/likes.html', rows, 'warbler.show_liked_warbles',
+        {'user_id': user.id}, user=user)
+
+
+@bp.get('/users/<int:user_id>/mentions')
+def show_mentions(user_id):
+    """Show a page of the messages mentioning this user, newest first.
+
+    Paged like the likes page.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user = get_user_or_404(user_id)
+    rows = shards.mentions_page(user.id, PAGE_SIZE + 1, before_cursor())
+
+    return render_messages_page(
+        'messages/timeline.html', rows, 'warbler.show_mentions',
+        {'user_id': user.id}, heading=f"Mentioning @{user.username}")
 
 
-@app.post('/users/follow/<int:follow_id>')
+@bp.get('/tags/<tag>')
+def show_tag(tag):
+    """Show a page of the messages tagged #tag, newest first.
+
+    Paged like the likes page.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    tag = tag.lower()
+    rows = shards.tagged_page(tag, PAGE_SIZE + 1, before_cursor())
+
+    return render_messages_page(
+        'messages/timeline.html', rows, 'warbler.show_tag',
+        {'tag': tag}, heading=f"#{tag}")
+
+
+@bp.post('/users/follow/<int:follow_id>')
 def start_following(follow_id):
     """Add a follow for the currently-logged-in user.
 
@@ -218,14 +470,16 @@ def start_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
+    followed_user = get_user_or_404(follow_id)
     g.user.following.append(followed_user)
+    enqueue_suggestions_refresh(g.user.id)
     db.session.commit()
+    follow_graph.add(g.user.id, followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.post('/users/stop-following/<int:follow_id>')
+@bp.post('/users/stop-following/<int:follow_id>')
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user.
 
@@ -238,12 +492,45 @@ def stop_following(follow_id):
 
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.remove(followed_user)
+    enqueue_suggestions_refresh(g.user.id)
     db.session.commit()
+    follow_graph.remove(g.user.id, followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@bp.get('/users/<int:user_id>/export')
+def export_user(user_id):
+    """Download your own messages, likes and follows as NDJSON or CSV.
+
+    Streamed as it's read; `after` resumes from a record's cursor.
+    """
+
+    if not g.user or g.user.id != user_id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    format = request.args.get('format', 'ndjson')
+    after = request.args.get('after')
+
+    if format not in export.MIMETYPES:
+        abort(400)
+
+    if after:
+        try:
+            export.parse_cursor(after)
+        except ValueError:
+            abort(400)
+
+    return Response(
+        stream_with_context(
+            export.export_lines(shards, user_id, format, after)),
+        mimetype=export.MIMETYPES[format],
+        headers={'Content-Disposition':
+                 f'attachment; filename="warbler-{user_id}.{format}"'})
+
+
+@bp.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
 
@@ -256,6 +543,8 @@ def profile():
     if form.validate_on_submit():
 
         if User.authenticate(username=g.user.username, password=form.password.data):
+            old_urls = (g.user.image_url, g.user.header_image_url)
+
             g.user.username = form.username.data
             g.user.email = form.email.data
             g.user.image_url = form.image_url.data or DEFAULT_IMAGE_URL
@@ -263,6 +552,11 @@ def profile():
             g.user.bio = form.bio.data
             g.user.location = form.location.data
 
+            if (g.user.image_url, g.user.header_image_url) != old_urls:
+                g.user.image_digest = g.user.header_image_digest = None
+                enqueue_image_ingest(g.user)
+
+            invalidation.bus.publish('user', g.user.id)
             db.session.commit()
             return redirect(f"/users/{g.user.id}")
 
@@ -271,7 +565,7 @@ def profile():
     return render_template('users/edit.html', form=form)
 
 
-@app.post('/users/delete')
+@bp.post('/users/delete')
 def delete_user():
     """Delete user.
 
@@ -284,19 +578,24 @@ def delete_user():
 
     if g.csrf_form.validate_on_submit():
         do_logout()
-        for message in g.user.messages:
-            db.session.delete(message)
-
-        db.session.delete(g.user)
+        follow_graph.remove_user(g.user.id)
+
+        # Their messages and likes may span every shard, so a job deletes
+        # them, and then the user, after this response; until it runs,
+        # pending_deletion hides them. The job publishes the user's
+        # invalidation once they're gone.
+        g.user.pending_deletion = True
+        jobs.enqueue('delete_user', {'user_id': g.user.id},
+                     key=f"delete-user:{g.user.id}")
         db.session.commit()
-        flash("User Successfully Deleted!")
+        flash("Your account is being deleted.")
         return redirect("/signup")
 
 
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
 def add_message():
     """Add a message:
 
@@ -310,16 +609,15 @@ def add_message():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        shards.add_message(g.user.id, form.text.data)
+        shards.commit()
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/create.html', form=form)
 
 
-@app.get('/messages/<int:message_id>')
+@bp.get('/messages/<int:message_id>')
 def show_message(message_id):
     """Show a message."""
 
@@ -327,11 +625,68 @@ def show_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = shards.get_message_or_404(message_id)
+    liked_ids = likes.liked_message_ids(g.user.id, [msg])
+
+    return render_template(
+        'messages/show.html', message=msg, liked_ids=liked_ids)
 
 
-@app.post('/messages/<int:message_id>/delete')
+@bp.get('/messages/<int:message_id>/likes')
+def show_liked_by(message_id):
+    """Show who liked a message, newest likes first, a page at a time.
+
+    The next page starts after the `before` (time liked) and `before_id`
+    (user id) of the last like shown.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    msg = shards.get_message_or_404(message_id)
+    rows = shards.liked_by(msg, PAGE_SIZE + 1, before_cursor())
+    page = rows[:PAGE_SIZE]
+
+    user_ids = [user_id for user_id, _ in page]
+    users = {
+        user.id: user for user in User.query.filter(
+            User.id.in_(user_ids), User.pending_deletion.is_(False))
+    } if user_ids else {}
+    likers = [users[user_id] for user_id in user_ids if user_id in users]
+
+    next_page = None
+    if len(rows) > PAGE_SIZE:
+        last_id, last_time = page[-1]
+        next_page = url_for(
+            'warbler.show_liked_by', message_id=msg.id,
+            before=last_time.isoformat(), before_id=last_id)
+
+    return render_template(
+        'messages/liked_by.html', message=msg, likers=likers,
+        following_ids=g.user.following_ids(user_ids), next_page=next_page)
+
+
+@bp.get('/messages/trending')
+def show_trending():
+    """Show the most liked messages of the last day."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    top = trending.counters.top()
+    like_counts = {entry.message_id: entry.likes for entry in top}
+    messages = shards.get_messages(
+        [(entry.message_id, entry.user_id) for entry in top])
+    liked_ids = likes.liked_message_ids(g.user.id, messages)
+
+    return render_template(
+        'messages/trending.html', messages=messages, likes=like_counts,
+        liked_ids=liked_ids)
+
+
+@bp.post('/messages/<int:message_id>/delete')
 def delete_message(message_id):
     """Delete a message.
 
@@ -345,9 +700,10 @@ def delete_message(message_id):
 
     if g.csrf_form.validate_on_submit():
 
-        msg = Message.query.get_or_404(message_id)
-        db.session.delete(msg)
-        db.session.commit()
+        msg = shards.get_message_or_404(message_id)
+        shards.delete_message(msg)
+        invalidation.bus.publish('message', msg.id)
+        shards.commit()
         flash("Message Successfully Deleted!")
         return redirect(f"/users/{g.user.id}")
 
@@ -355,7 +711,7 @@ def delete_message(message_id):
 ##############################################################################
 # Like/Unlike
 
-@app.post('/messages/<int:id>/like_or_unlike')
+@bp.post('/messages/<int:id>/like_or_unlike')
 def like_or_unlike_message_homepage(id):
     """Unlike or like a warble.
 
@@ -366,24 +722,180 @@ def like_or_unlike_message_homepage(id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    message = Message.query.get_or_404(id)
+    message = shards.get_message_or_404(id)
+    likes.toggle_like(g.user.id, message)
 
-    if message in g.user.likes:
-        g.user.likes.remove(message)
+    return redirect(f"{request.referrer}")
 
-    else:
-        g.user.likes.append(message)
 
-    db.session.commit()
-    return redirect(f"{request.referrer}")
 
+##############################################################################
+# Batch API, for integrations that post or follow in bulk
+#
+# Both routes take JSON (which also keeps cross-site forms from posting
+# to them) and answer with one result per item, in order.
+
+
+def batch_items(key):
+    """Return the list under `key` in the request's JSON, or an error
+    response if there isn't one of at most BATCH_MAX_ITEMS items."""
+
+    if not g.user:
+        return None, (jsonify(error="Log in first."), 401)
+
+    body = request.get_json(silent=True) if request.is_json else None
+    items = body.get(key) if isinstance(body, dict) else None
+
+    if not isinstance(items, list):
+        return None, (jsonify(error=f"Send a JSON object with a {key!r} list."),
+                      400)
+
+    if len(items) > BATCH_MAX_ITEMS:
+        return None, (jsonify(
+            error=f"At most {BATCH_MAX_ITEMS} {key} per call."), 400)
+
+    return items, None
+
+
+@bp.post('/api/messages/batch')
+def add_messages_batch():
+    """Post up to BATCH_MAX_ITEMS messages: {"messages": [{"text": ...}]}.
+
+    Each is checked like the new message form; the valid ones are written
+    with one insert, and the results give each one's id or errors.
+    """
+
+    items, error = batch_items('messages')
+
+    if error:
+        return error
+
+    results = []
+    texts = []
+
+    for item in items:
+        text = item.get('text') if isinstance(item, dict) else None
+        form = MessageForm(
+            formdata=MultiDict({'text': text} if isinstance(text, str) else {}),
+            meta={'csrf': False})
+
+        if form.validate():
+            results.append({'ok': True})
+            texts.append(form.text.data)
+        else:
+            results.append({'ok': False, 'errors': form.errors})
+
+    if texts:
+        message_ids = iter(shards.add_messages(g.user.id, texts))
+        shards.commit()
+
+        for result in results:
+            if result['ok']:
+                result['id'] = next(message_ids)
+
+    return jsonify(results=results)
+
+
+@bp.post('/api/follows/batch')
+def add_follows_batch():
+    """Follow up to BATCH_MAX_ITEMS users: {"user_ids": [...]}.
+
+    The follows are written with one insert. Each result's status is
+    "followed", "already_following", "not_found" or "invalid".
+    """
+
+    items, error = batch_items('user_ids')
+
+    if error:
+        return error
+
+    wanted = {
+        user_id for user_id in items
+        if type(user_id) is int and user_id != g.user.id
+    }
+    existing = set(db.session.scalars(
+        select(User.id).where(User.id.in_(wanted)))) if wanted else set()
+
+    followed = set()
+
+    if existing:
+        followed = set(db.session.scalars(
+            insert(Follow)
+            .values([
+                {'user_being_followed_id': user_id,
+                 'user_following_id': g.user.id}
+                for user_id in sorted(existing)
+            ])
+            .on_conflict_do_nothing()
+            .returning(Follow.user_being_followed_id)))
+
+        if followed:
+            enqueue_suggestions_refresh(g.user.id)
+
+        db.session.commit()
+
+        for user_id in followed:
+            follow_graph.add(g.user.id, user_id)
+
+    def status(user_id):
+        if type(user_id) is not int or user_id not in wanted:
+            return "invalid"
+        if user_id not in existing:
+            return "not_found"
+        if user_id in followed:
+            followed.discard(user_id)
+            return "followed"
+        return "already_following"
+
+    return jsonify(results=[
+        {'user_id': user_id, 'status': status(user_id)} for user_id in items
+    ])
+
+
+##############################################################################
+# Images
+
+
+def enqueue_suggestions_refresh(user_id):
+    """Queue a job to recompute `user_id`'s suggestions at the end of the
+    current recommendations.REFRESH_SECONDS window, unless one is queued."""
+
+    now = time.time()
+    window = int(now // recommendations.REFRESH_SECONDS)
+
+    jobs.enqueue(
+        'refresh_suggestions', {'user_id': user_id},
+        key=f"refresh-suggestions:{user_id}:{window}",
+        delay=(window + 1) * recommendations.REFRESH_SECONDS - now)
+
+
+def enqueue_image_ingest(user):
+    """Queue a job to store resized copies of `user`'s current images."""
+
+    urls = f"{user.image_url} {user.header_image_url}"
+
+    jobs.enqueue(
+        'ingest_user_images', {'user_id': user.id},
+        key=f"ingest-images:{user.id}:{hashlib.sha256(urls.encode()).hexdigest()}")
+
+
+@bp.get('/images/<name>')
+def show_image(name):
+    """Serve a stored image variant. Names are content hashes, so they can
+    be cached for good."""
+
+    response = send_from_directory(
+        images.cache_dir(), name, max_age=images.CACHE_SECONDS)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 
 ##############################################################################
 # Homepage and error pages
 
 
-@app.get('/')
+@bp.get('/')
 def homepage():
     """Show homepage:
 
@@ -395,24 +907,49 @@ def homepage():
         user_ids = [user.id for user in g.user.following]
         user_ids.append(g.user.id)
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(user_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        return render_template('home.html', messages=messages)
+        messages = shards.recent_by_users(user_ids)
+        liked_ids = likes.liked_message_ids(g.user.id, messages)
+        suggestions = recommendations.suggestions_for(g.user.id)
+
+        return render_template(
+            'home.html', messages=messages, liked_ids=liked_ids,
+            suggestions=suggestions)
 
     else:
         return render_template('home-anon.html')
 
 
-@app.after_request
+@bp.get('/metrics')
+def metrics():
+    """Report this worker's metrics in Prometheus text format, to scrapers
+    allowed by METRICS_TOKEN (see metrics.py)."""
+
+    if not scrape_allowed(current_app.config.get('METRICS_TOKEN'),
+                          request.headers.get('Authorization'),
+                          request.remote_addr):
+        abort(404)
+
+    return Response(render_metrics(), mimetype="text/plain")
+
+
+@bp.app_errorhandler(ShardMoving)
+def shard_moving(error):
+    """Ask the user to retry a write made while their data changes shards."""
+
+    flash("Your account is being moved, please try again in a moment.",
+          "warning")
+    return redirect(request.referrer or "/")
+
+
+@bp.after_app_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request, except to responses meant
+    to be cached for good (like stored images) and static files, which are
+    revalidated with their ETags."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if not (response.cache_control.immutable or request.endpoint == 'static'):
+        response.cache_control.no_store = True
     return response
 
 
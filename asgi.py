@@ -0,0 +1,191 @@
+"""ASGI serving mode, with the hot read pages on an async database driver.
+
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker \\
+        "asgi:create_asgi_app('production')"
+
+The timeline, profile, followers, following, likes, mentions, tag, message,
+liked-by and trending pages (ASYNC_ENDPOINTS) run on the worker's event
+loop. They are the ordinary Flask views, run inside SQLAlchemy's greenlet
+bridge with every database engine swapped for its asyncpg twin (see
+async_db.py). While one request waits on Postgres the loop serves the
+others, so a process's concurrency grows with the requests in flight rather
+than with its threads.
+
+Every other request (forms, writes, static files) runs in a thread pool on
+the sync driver, as it would under a threaded WSGI server.
+"""
+
+from io import BytesIO
+import sys
+
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy.util import greenlet_spawn
+from werkzeug.exceptions import HTTPException
+
+from app import create_app
+from async_db import ASYNC_IO_KEY, create_twins, dispose_twins
+from metrics import counter, gauge
+from models import db
+from replicas import replicas
+from shards import shards
+
+ASYNC_ENDPOINTS = frozenset({
+    'warbler.homepage',
+    'warbler.show_user',
+    'warbler.show_following',
+    'warbler.show_followers',
+    'warbler.show_liked_warbles',
+    'warbler.show_mentions',
+    'warbler.show_tag',
+    'warbler.show_message',
+    'warbler.show_liked_by',
+    'warbler.show_trending',
+})
+
+ASYNC_METHODS = ("GET", "HEAD")
+
+async_in_flight = gauge(
+    'warbler_async_requests_in_flight',
+    "Requests being served on the event loop right now.")
+
+async_requests = counter(
+    'warbler_async_requests_total',
+    "Requests served on the event loop.")
+
+
+def environ_from_scope(scope):
+    """Build a WSGI environ for a bodiless ASGI HTTP request."""
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin1'),
+        'PATH_INFO': scope['path'].encode().decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    if scope.get('server'):
+        environ['SERVER_NAME'], port = scope['server'][:2]
+        environ['SERVER_PORT'] = str(port)
+
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f"HTTP_{name}"
+        value = value.decode('latin1')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+    return environ
+
+
+class WarblerASGI:
+    """ASGI app serving a Warbler Flask app; see the module docstring."""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.threaded = WsgiToAsgi(flask_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+
+        elif scope['type'] == 'http' and self.runs_async(scope):
+            await self.serve_async(scope, send)
+
+        else:
+            await self.threaded(scope, receive, send)
+
+    def runs_async(self, scope):
+        """Should this request run on the event loop?"""
+
+        if scope['method'] not in ASYNC_METHODS:
+            return False
+
+        adapter = self.flask_app.url_map.bind('localhost')
+
+        try:
+            endpoint, _ = adapter.match(scope['path'], method=scope['method'])
+        except HTTPException:
+            return False
+
+        return endpoint in ASYNC_ENDPOINTS
+
+    async def serve_async(self, scope, send):
+        """Run the Flask app on the event loop, awaiting its database I/O."""
+
+        environ = environ_from_scope(scope)
+        environ[ASYNC_IO_KEY] = True
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+
+        def run():
+            # A fresh app context, so each request gets its own sessions even
+            # if the caller has a context pushed.
+            with self.flask_app.app_context():
+                result = self.flask_app(environ, start_response)
+
+                try:
+                    return b''.join(result)
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+
+        async_in_flight.inc()
+
+        try:
+            body = await greenlet_spawn(run)
+        finally:
+            async_in_flight.inc(-1)
+
+        async_requests.inc()
+
+        await send({
+            'type': 'http.response.start',
+            'status': started['status'],
+            'headers': [
+                (name.lower().encode('latin1'), value.encode('latin1'))
+                for name, value in started['headers']
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def lifespan(self, receive, send):
+        """Close the async connection pools when the server shuts down."""
+
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+
+            elif message['type'] == 'lifespan.shutdown':
+                await dispose_twins()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def create_asgi_app(config=None):
+    """Create a Warbler app (see create_app) and serve it over ASGI."""
+
+    app = create_app(config)
+
+    with app.app_context():
+        engines = list(db.engines.values())
+
+    create_twins(engines + shards.engines + replicas.engines, app.config)
+
+    return WarblerASGI(app)
@@ -0,0 +1,63 @@
+"""Async twins of the database engines, for the ASGI serving mode.
+
+Each Postgres engine (primary, replicas and shards) can be given a twin that
+uses the asyncpg driver. While a request runs in async mode (see asgi.py),
+io_engine swaps every engine for its twin's sync facade. The ordinary
+session and query code then runs unchanged, but inside SQLAlchemy's greenlet
+bridge each round trip is awaited on the event loop instead of blocking the
+worker.
+
+Engines for other databases (SQLite shards in tests) have no twin and keep
+blocking.
+"""
+
+from weakref import WeakKeyDictionary
+
+from flask import has_request_context, request
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from pooling import async_engine_options
+
+ASYNC_IO_KEY = "warbler.async_io"
+
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg"}
+
+TWINS = WeakKeyDictionary()
+
+
+def create_twins(engines, config):
+    """Give each of `engines` an async twin, if its database supports one."""
+
+    for engine in engines:
+        driver = ASYNC_DRIVERS.get(engine.url.get_backend_name())
+
+        if driver and engine not in TWINS:
+            TWINS[engine] = create_async_engine(
+                engine.url.set(drivername=driver),
+                **async_engine_options(
+                    config, f"{getattr(engine.pool, 'name', 'default')}-async"))
+
+
+async def dispose_twins():
+    """Close every async twin's connections."""
+
+    for twin in list(TWINS.values()):
+        await twin.dispose()
+
+
+def is_async_request():
+    """Is this request running on the event loop?"""
+
+    return has_request_context() and request.environ.get(ASYNC_IO_KEY, False)
+
+
+def io_engine(engine):
+    """Return the engine this request should use in place of `engine`."""
+
+    if is_async_request():
+        twin = TWINS.get(engine)
+
+        if twin is not None:
+            return twin.sync_engine
+
+    return engine
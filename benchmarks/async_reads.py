@@ -0,0 +1,164 @@
+"""Compare the sync and ASGI serving modes on the hot read pages.
+
+    python -m benchmarks.async_reads [concurrency] [requests] [db_latency_ms]
+
+Starts one single-process gunicorn server per mode, each warmed up as in
+production, then has `concurrency` clients fetch the timeline, profile,
+followers, following and likes pages as the first user until `requests`
+requests have been made, and reports throughput and latency. Needs a seeded
+database at DATABASE_URL.
+
+With db_latency_ms the servers reach the database through a local proxy
+that delays every reply by that much, like a database across the network.
+"""
+
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from itertools import cycle, islice
+from threading import Thread
+
+from sqlalchemy.engine import make_url
+
+from benchmarks.startup import ROOT, run_python
+
+MODES = {
+    'sync': [],
+    'asgi': ["-k", "uvicorn.workers.UvicornWorker",
+             "asgi:create_asgi_app('benchmark')"],
+}
+
+PORT = 8790
+PROXY_PORT = 8791
+
+SESSION_COOKIE = """
+from app import create_app, CURR_USER_KEY
+from models import db, User
+app = create_app('benchmark')
+with app.app_context():
+    user_id = db.session.scalar(db.select(User.id).order_by(User.id).limit(1))
+print(user_id, app.session_interface.get_signing_serializer(app).dumps(
+    {CURR_USER_KEY: user_id}))
+"""
+
+
+async def _pipe(reader, writer, delay):
+    while data := await reader.read(65536):
+        if delay:
+            await asyncio.sleep(delay)
+        writer.write(data)
+        await writer.drain()
+
+    writer.close()
+
+
+def start_latency_proxy(database_url, delay):
+    """Proxy PROXY_PORT to the database, delaying its replies by `delay`s.
+
+    Returns the database URL to use through the proxy.
+    """
+
+    url = make_url(database_url)
+
+    async def connect():
+        if url.host:
+            return await asyncio.open_connection(url.host, url.port or 5432)
+
+        socket_dir = os.environ.get('PGHOST', '/var/run/postgresql')
+        return await asyncio.open_unix_connection(
+            f"{socket_dir}/.s.PGSQL.{url.port or 5432}")
+
+    async def handle(client_reader, client_writer):
+        server_reader, server_writer = await connect()
+        await asyncio.gather(
+            _pipe(client_reader, server_writer, 0),
+            _pipe(server_reader, client_writer, delay))
+
+    async def serve():
+        server = await asyncio.start_server(handle, '127.0.0.1', PROXY_PORT)
+        await server.serve_forever()
+
+    Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
+
+    return url.set(host='127.0.0.1', port=PROXY_PORT).render_as_string(
+        hide_password=False)
+
+
+def start_server(mode, env):
+    """Start a gunicorn server in `mode`; return it once it answers."""
+
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+         *MODES[mode]],
+        cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{PORT}/login")
+            return server
+        except OSError:
+            time.sleep(0.1)
+
+    server.kill()
+    raise RuntimeError(f"{mode} server didn't start")
+
+
+def load(paths, cookie, concurrency, requests):
+    """Fetch `paths` round robin; return (seconds, per-request latencies)."""
+
+    def fetch(path):
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{PORT}{path}",
+            headers={'Cookie': f"session={cookie}"})
+        start = time.perf_counter()
+        urllib.request.urlopen(request).read()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(fetch, islice(cycle(paths), requests)))
+
+    return time.perf_counter() - start, latencies
+
+
+if __name__ == "__main__":
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    db_latency_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+    env = dict(os.environ)
+    env.setdefault('SECRET_KEY', 'async-reads-benchmark')
+    env.update(GUNICORN_WORKERS='1', GUNICORN_BIND=f"127.0.0.1:{PORT}")
+
+    user_id, cookie = run_python(SESSION_COOKIE, env).split()
+
+    if db_latency_ms:
+        env['DATABASE_URL'] = start_latency_proxy(
+            env['DATABASE_URL'], db_latency_ms / 1000)
+    paths = ["/", f"/users/{user_id}", f"/users/{user_id}/followers",
+             f"/users/{user_id}/following", f"/users/{user_id}/likes"]
+
+    print(f"{concurrency} clients, {requests} requests, "
+          f"{db_latency_ms:g}ms database latency, one process per mode")
+
+    for mode in MODES:
+        server = start_server(mode, env)
+
+        try:
+            load(paths, cookie, concurrency, len(paths))
+            seconds, latencies = load(paths, cookie, concurrency, requests)
+        finally:
+            server.terminate()
+            server.wait()
+
+        latencies.sort()
+        print(f"{mode:5} {requests / seconds:7.1f} req/s   "
+              f"p50 {statistics.median(latencies) * 1000:7.1f}ms   "
+              f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:7.1f}ms")
@@ -0,0 +1,67 @@
+"""Measure a new worker's first requests, with and without warm_up.
+
+    python -m benchmarks.cold_start
+
+Each run starts a fresh interpreter, creates the app, optionally warms it up
+the way the gunicorn master does (see warmup.py), then times a logged-in
+user's first two homepage requests. The first request is the cold start;
+the second shows the steady state. Needs a seeded database at DATABASE_URL.
+"""
+
+import json
+import os
+import statistics
+
+from benchmarks.startup import run_python
+
+RUNS = 5
+
+FIRST_USER = """
+from app import create_app
+from models import db, User
+with create_app('benchmark').app_context():
+    print(db.session.scalar(db.select(User.id).order_by(User.id).limit(1)))
+"""
+
+MEASURE = """
+import json, time
+from app import create_app, CURR_USER_KEY
+from warmup import warm_up
+app = create_app('benchmark')
+if %(warm)r:
+    warm_up(app)
+client = app.test_client()
+with client.session_transaction() as session:
+    session[CURR_USER_KEY] = %(user_id)r
+timings = []
+for _ in range(2):
+    start = time.perf_counter()
+    client.get('/')
+    timings.append(time.perf_counter() - start)
+print(json.dumps(timings))
+"""
+
+
+def measure(warm, user_id, runs=RUNS):
+    """Return the median (first, second) request seconds."""
+
+    env = dict(os.environ)
+    env.setdefault('SECRET_KEY', 'cold-start-benchmark')
+
+    samples = [
+        json.loads(run_python(MEASURE % {'warm': warm, 'user_id': user_id}, env))
+        for _ in range(runs)
+    ]
+
+    return tuple(statistics.median(s[i] for s in samples) for i in range(2))
+
+
+if __name__ == "__main__":
+    env = dict(os.environ)
+    env.setdefault('SECRET_KEY', 'cold-start-benchmark')
+    user_id = int(run_python(FIRST_USER, env))
+
+    for label, warm in (("cold", False), ("warmed", True)):
+        first, second = measure(warm, user_id)
+        print(f"{label:7}first request {first * 1000:7.1f}ms   "
+              f"second {second * 1000:6.1f}ms")
@@ -0,0 +1,84 @@
+"""Measure the bytes sent for a 100-message homepage.
+
+    python -m benchmarks.page_weight
+
+Each run starts a fresh interpreter and fetches the homepage as the user
+whose timeline is longest (capped at 100 messages), as the benchmark
+profile would serve it:
+
+    plain       no whitespace trimming, no compression
+    trimmed     JINJA_TRIM_WHITESPACE on (see templating.py)
+    gzip        compression on (see compression.py)
+    both        trimmed and compressed, as in production
+
+Needs a seeded database at DATABASE_URL.
+"""
+
+import json
+import os
+
+from benchmarks.startup import run_python
+
+MEASURE = """
+import gzip, json
+from sqlalchemy import func, select
+from app import create_app, CURR_USER_KEY
+from config import BenchmarkConfig
+from models import db, Follow, Message, User
+
+class Config(BenchmarkConfig):
+    JINJA_TRIM_WHITESPACE = %(trim)r
+
+app = create_app(Config)
+
+with app.app_context():
+    followed = (
+        select(Follow.user_following_id.label('user_id'),
+               Follow.user_being_followed_id.label('author_id'))
+        .union_all(select(User.id, User.id))
+        .subquery())
+    user_id = db.session.scalar(
+        select(followed.c.user_id)
+        .join(Message, Message.user_id == followed.c.author_id)
+        .group_by(followed.c.user_id)
+        .order_by(func.count().desc(), followed.c.user_id)
+        .limit(1))
+
+client = app.test_client()
+with client.session_transaction() as session:
+    session[CURR_USER_KEY] = user_id
+response = client.get('/', headers={'Accept-Encoding': 'gzip'})
+html = response.get_data()
+if response.content_encoding == 'gzip':
+    html = gzip.decompress(html)
+print(json.dumps([len(response.get_data()),
+                  html.count(b'<li class="list-group-item">')]))
+"""
+
+RUNS = {
+    'plain': dict(trim=False, compress=False),
+    'trimmed': dict(trim=True, compress=False),
+    'gzip': dict(trim=False, compress=True),
+    'both': dict(trim=True, compress=True),
+}
+
+
+def measure(trim, compress):
+    """Return the homepage's (bytes, messages)."""
+
+    env = dict(os.environ)
+    env.setdefault('SECRET_KEY', 'page-weight-benchmark')
+    env['COMPRESS'] = str(compress)
+
+    return json.loads(
+        run_python(MEASURE % {'trim': trim, 'compress': compress}, env))
+
+
+if __name__ == "__main__":
+    plain, messages = measure(**RUNS['plain'])
+
+    print(f"homepage with {messages} messages")
+
+    for name, options in RUNS.items():
+        size = plain if name == 'plain' else measure(**options)[0]
+        print(f"{name:8} {size:8,} bytes  {size / plain:6.1%}")
@@ -0,0 +1,86 @@
+"""Measure how long Warbler takes to import and to start serving.
+
+    python benchmarks/startup.py
+
+Each measurement runs in a fresh interpreter, so nothing is already imported
+or cached, and the median of several runs is compared with its budget:
+
+    import      `import app`
+    startup     create_app('benchmark') and its first request (the
+                anonymous homepage, which needs no database)
+
+Exits with status 1 if either is over budget. DATABASE_URL and SECRET_KEY
+are given placeholder values if they're unset; neither measurement connects
+to the database.
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+IMPORT_BUDGET_SECONDS = 1.0
+STARTUP_BUDGET_SECONDS = 0.5
+
+RUNS = 5
+
+MEASURE = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.create_app('benchmark').test_client()
+client.get('/')
+started = time.perf_counter()
+print(json.dumps({'import': imported - start, 'startup': started - imported}))
+"""
+
+
+def run_python(code, env=None):
+    """Run `code` in a fresh interpreter in the repo root; return its stdout."""
+
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, env=env,
+        capture_output=True, text=True, check=True)
+
+    return result.stdout
+
+
+def measure(runs=RUNS):
+    """Return the median {'import': seconds, 'startup': seconds}."""
+
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', 'postgresql:///warbler')
+    env.setdefault('SECRET_KEY', 'startup-benchmark')
+
+    samples = [json.loads(run_python(MEASURE, env)) for _ in range(runs)]
+
+    return {
+        name: statistics.median(sample[name] for sample in samples)
+        for name in ('import', 'startup')
+    }
+
+
+def over_budget(timings):
+    """Return the names of the measurements that are over budget."""
+
+    budgets = {'import': IMPORT_BUDGET_SECONDS,
+               'startup': STARTUP_BUDGET_SECONDS}
+
+    return [name for name, budget in budgets.items() if timings[name] > budget]
+
+
+if __name__ == "__main__":
+    timings = measure()
+
+    print(f"import   {timings['import']:.3f}s "
+          f"(budget {IMPORT_BUDGET_SECONDS}s)")
+    print(f"startup  {timings['startup']:.3f}s "
+          f"(budget {STARTUP_BUDGET_SECONDS}s)")
+
+    if over_budget(timings):
+        sys.exit(1)
@@ -0,0 +1,59 @@
+"""Measure template compile time with and without the bytecode cache.
+
+    python -m benchmarks.template_cache
+
+Each run starts a fresh interpreter and loads every template, as a new
+worker does on its first requests (see templating.py):
+
+    no cache    JINJA_BYTECODE_CACHE off
+    cold        the cache directory starts empty
+    warm        the cache directory was filled by an earlier run
+"""
+
+import json
+import os
+import statistics
+import tempfile
+
+from benchmarks.startup import run_python
+
+RUNS = 5
+
+MEASURE = """
+import json, time
+from app import create_app
+from config import BenchmarkConfig
+from warmup import compile_templates
+
+class Config(BenchmarkConfig):
+    JINJA_BYTECODE_CACHE = %(cache)r
+
+app = create_app(Config)
+start = time.perf_counter()
+compile_templates(app)
+print(json.dumps(time.perf_counter() - start))
+"""
+
+
+def measure(cache, cache_dir, runs=RUNS):
+    """Return the median seconds to load every template."""
+
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', 'postgresql:///warbler')
+    env.setdefault('SECRET_KEY', 'template-cache-benchmark')
+    env['JINJA_BYTECODE_CACHE_DIR'] = cache_dir
+
+    return statistics.median(
+        json.loads(run_python(MEASURE % {'cache': cache}, env))
+        for _ in range(runs))
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as cache_dir:
+        no_cache = measure(False, cache_dir)
+        cold = measure(True, cache_dir, runs=1)
+        warm = measure(True, cache_dir)
+
+    print(f"no cache  {no_cache * 1000:6.1f}ms")
+    print(f"cold      {cold * 1000:6.1f}ms")
+    print(f"warm      {warm * 1000:6.1f}ms")
@@ -0,0 +1,190 @@
+"""Gzip compression of responses, and precompressed static files.
+
+Pages like the timeline and followers lists are tens of kilobytes of
+repetitive HTML that gzip shrinks several times over. After each request,
+a response is compressed when:
+
+- the client accepts gzip
+- it's a complete 200 response (not streamed, like the data export, or a
+  file sent from disk) without a Content-Encoding already
+- its mimetype is one of COMPRESSIBLE_MIMETYPES (images are compressed
+  already)
+- it's at least COMPRESS_MIN_SIZE bytes; below that the gzip framing costs
+  more than it saves
+
+COMPRESS_LEVEL is the gzip level, 1 (fastest) to 9 (smallest); the default
+6 is most of level 9's saving for much less CPU. Set COMPRESS to off to
+leave responses alone, as behind a proxy that compresses them itself.
+
+Static files don't change between deploys, so instead of compressing them
+on every request they're compressed once, at the highest level, with
+
+    python compression.py static
+
+which writes a .gz beside each compressible file under static/. A request
+for the file from a client that accepts gzip is sent the .gz, unless the
+original has changed since it was written.
+"""
+
+import gzip
+import mimetypes
+import os
+import sys
+
+from flask import request, send_from_directory
+
+from metrics import counter
+
+COMPRESSIBLE_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'text/javascript',
+    'application/javascript', 'application/json', 'application/x-ndjson',
+    'image/svg+xml', 'image/x-icon', 'image/vnd.microsoft.icon',
+}
+
+compressed_bytes = counter(
+    'warbler_compressed_bytes_total',
+    "Bytes of responses compressed on the fly, before and after")
+
+
+def accepts_gzip():
+    return request.accept_encodings['gzip'] > 0
+
+
+def compressible(response, min_size):
+    return (
+        response.status_code == 200
+        and not response.is_streamed
+        and not response.direct_passthrough
+        and 'Content-Encoding' not in response.headers
+        and response.mimetype in COMPRESSIBLE_MIMETYPES
+        and response.content_length is not None
+        and response.content_length >= min_size
+    )
+
+
+def compress_response(response, level, min_size):
+    """Gzip `response` in place if it's worth it and the client accepts it."""
+
+    if not compressible(response, min_size):
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    if not accepts_gzip():
+        return response
+
+    data = response.get_data()
+    compressed = gzip.compress(data, compresslevel=level, mtime=0)
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = 'gzip'
+
+    compressed_bytes.inc(len(data), stage='in')
+    compressed_bytes.inc(len(compressed), stage='out')
+
+    return response
+
+
+##############################################################################
+# Static files
+
+
+def compressible_file(filename):
+    """Whether `filename` is worth compressing (and isn't compressed)."""
+
+    mimetype, encoding = mimetypes.guess_type(filename)
+
+    return encoding is None and mimetype in COMPRESSIBLE_MIMETYPES
+
+
+def precompressed_path(directory, filename):
+    """The .gz of `filename` in `directory`, if there's an up to date one."""
+
+    path = os.path.join(directory, filename)
+    gz_path = path + ".gz"
+
+    try:
+        if os.path.getmtime(gz_path) >= os.path.getmtime(path):
+            return gz_path
+    except OSError:
+        pass
+
+    return None
+
+
+def send_static_file(app, filename):
+    """Send a static file, or its precompressed copy if the client
+    accepts gzip."""
+
+    directory = app.static_folder
+
+    if not compressible_file(filename):
+        return app.send_static_file(filename)
+
+    if not (accepts_gzip() and precompressed_path(directory, filename)):
+        response = app.send_static_file(filename)
+        response.vary.add('Accept-Encoding')
+        return response
+
+    response = send_from_directory(
+        directory, filename + ".gz",
+        mimetype=mimetypes.guess_type(filename)[0],
+        max_age=app.get_send_file_max_age(filename))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+
+    return response
+
+
+def precompress_static(directory):
+    """Write a .gz beside each compressible file under `directory` whose
+    .gz is missing or stale; return their paths."""
+
+    written = []
+
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if (not compressible_file(filename)
+                    or precompressed_path(root, filename)):
+                continue
+
+            path = os.path.join(root, filename)
+
+            with open(path, "rb") as file:
+                data = gzip.compress(file.read(), compresslevel=9, mtime=0)
+
+            # Written aside and renamed, so a half-written file is never sent.
+            with open(path + ".gz.tmp", "wb") as file:
+                file.write(data)
+
+            os.replace(path + ".gz.tmp", path + ".gz")
+            written.append(path + ".gz")
+
+    return written
+
+
+def init_app(app):
+    """Compress the app's responses and serve precompressed static files,
+    unless COMPRESS is off."""
+
+    if not app.config['COMPRESS']:
+        return
+
+    app.after_request(lambda response: compress_response(
+        response,
+        app.config['COMPRESS_LEVEL'],
+        app.config['COMPRESS_MIN_SIZE']))
+
+    app.view_functions['static'] = (
+        lambda filename: send_static_file(app, filename))
+
+
+if __name__ == "__main__":
+    from app import app
+
+    if sys.argv[1:] == ["static"]:
+        for path in precompress_static(app.static_folder):
+            print(f"Wrote {path}")
+
+    else:
+        print(__doc__)
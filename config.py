@@ -0,0 +1,90 @@
+"""Config profiles for create_app().
+
+Pick a profile by name (create_app('production')) or with the WARBLER_CONFIG
+environment variable. Database URLs, secrets and pool sizes always come from
+the environment; see config_from_env.
+"""
+
+from admission import limits_from_env
+from pooling import env_flag, pool_config_from_env
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SQLALCHEMY_ECHO = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+    DEBUG_TOOLBAR = False
+    JINJA_BYTECODE_CACHE = False
+    JINJA_TRIM_WHITESPACE = False
+
+
+class DevelopmentConfig(Config):
+    """Local development, with the debug toolbar."""
+
+    DEBUG_TOOLBAR = True
+
+
+class ProductionConfig(Config):
+    """Serving real traffic."""
+
+    TEMPLATES_AUTO_RELOAD = False
+    JINJA_BYTECODE_CACHE = True
+    JINJA_TRIM_WHITESPACE = True
+
+
+class BenchmarkConfig(ProductionConfig):
+    """Load and latency measurements: production settings, run locally."""
+
+
+PROFILES = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig,
+    'benchmark': BenchmarkConfig,
+}
+
+
+def list_from_env(value):
+    """Split a comma-separated environment variable into a list."""
+
+    return [item for item in (value or '').split(',') if item]
+
+
+def config_from_env(environ):
+    """Return the settings that come from the environment, for app.config."""
+
+    config = {
+        'SQLALCHEMY_DATABASE_URI': environ['DATABASE_URL'],
+        'SECRET_KEY': environ['SECRET_KEY'],
+        'SHARD_DATABASE_URLS': list_from_env(
+            environ.get('SHARD_DATABASE_URLS')),
+        'REPLICA_DATABASE_URLS': list_from_env(
+            environ.get('REPLICA_DATABASE_URLS')),
+        'READ_YOUR_WRITES_SECONDS': float(
+            environ.get('READ_YOUR_WRITES_SECONDS', 5)),
+        'JINJA_BYTECODE_CACHE_DIR': environ.get('JINJA_BYTECODE_CACHE_DIR'),
+        'FOLLOW_GRAPH_PATH': environ.get('FOLLOW_GRAPH_PATH'),
+        'FOLLOW_GRAPH_MAX_AGE_SECONDS': float(
+            environ.get('FOLLOW_GRAPH_MAX_AGE_SECONDS', 300)),
+        'JOB_WORKER_THREADS': int(environ.get('JOB_WORKER_THREADS', 4)),
+        'LIKE_WRITE_BEHIND': env_flag(environ.get('LIKE_WRITE_BEHIND', False)),
+        'LIKE_FLUSH_SECONDS': float(environ.get('LIKE_FLUSH_SECONDS', 1)),
+        'INVALIDATION_LISTEN': env_flag(
+            environ.get('INVALIDATION_LISTEN', True)),
+        'WRITE_RATE_LIMITS': limits_from_env(environ),
+        'RATE_LIMIT_BACKEND': environ.get('RATE_LIMIT_BACKEND', 'memory'),
+        'IMAGE_CACHE_DIR': environ.get('IMAGE_CACHE_DIR'),
+        'COMPRESS': env_flag(environ.get('COMPRESS', True)),
+        'COMPRESS_LEVEL': int(environ.get('COMPRESS_LEVEL', 6)),
+        'COMPRESS_MIN_SIZE': int(environ.get('COMPRESS_MIN_SIZE', 500)),
+        'PROFILE_SAMPLE_RATE': float(environ.get('PROFILE_SAMPLE_RATE', 0)),
+        'SLOW_REQUEST_SECONDS': float(environ.get('SLOW_REQUEST_SECONDS', 0)),
+        'PROFILE_INTERVAL_SECONDS': float(
+            environ.get('PROFILE_INTERVAL_SECONDS', 0.01)),
+        'PROFILE_KEEP': int(environ.get('PROFILE_KEEP', 100)),
+        'PROFILE_DIR': environ.get('PROFILE_DIR'),
+        'METRICS_TOKEN': environ.get('METRICS_TOKEN'),
+    }
+    config.update(pool_config_from_env(environ))
+
+    return config
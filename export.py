@@ -0,0 +1,211 @@
+"""Streaming export of a user's data, as NDJSON or CSV.
+
+A user downloads their own data from /users/<id>/export, or an operator
+runs
+
+    python export.py USER_ID [ndjson|csv] [CURSOR] > export.ndjson
+
+The export is the user's messages, their likes, the users they follow and
+their followers, in that order (SECTIONS), each in id order. Every section
+is read from a server-side cursor, EXPORT_BATCH_SIZE rows at a time, and
+written out as it's read, so memory stays flat however many rows there
+are. Messages are read from the user's shard and likes from every shard;
+reads on the primary go to a replica when the request has one.
+
+Each record carries a `cursor`. An export that was cut off resumes after
+the last record received by passing its cursor back (`?after=` or the
+CURSOR argument); since sections are read in key order, a resumed export
+picks up exactly where the first one stopped.
+"""
+
+import csv
+import io
+import json
+import sys
+
+from sqlalchemy import select
+
+from models import db, User, Message, Like, Follow
+from replicas import replicas
+
+EXPORT_BATCH_SIZE = 1000
+
+SECTIONS = ('messages', 'likes', 'following', 'followers')
+
+CSV_FIELDS = ['type', 'cursor', 'id', 'username', 'text', 'timestamp',
+              'like_count']
+
+MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def parse_cursor(cursor):
+    """Return (section, shard, key) for a record's cursor.
+
+    Raises ValueError if it isn't one.
+    """
+
+    section, shard, key = cursor.split(':')
+
+    if section not in SECTIONS:
+        raise ValueError(f"Unknown export section {section!r}")
+
+    return section, int(shard), int(key)
+
+
+def _engine(router, shard):
+    if shard == 0:
+        return replicas.engine_for_read() or db.engine
+
+    return router.engine(shard)
+
+
+def _stream(engine, statement):
+    """Yield the rows of `statement` from a server-side cursor."""
+
+    with engine.connect() as conn:
+        yield from conn.execution_options(
+            yield_per=EXPORT_BATCH_SIZE).execute(statement)
+
+
+def _messages(user_id, after):
+    return (
+        select(Message.id, Message.text, Message.timestamp, Message.like_count)
+        .where(Message.user_id == user_id, Message.id > after)
+        .order_by(Message.id))
+
+
+def _likes(user_id, after):
+    return (
+        select(Like.message_id, Like.timestamp)
+        .where(Like.user_id == user_id, Like.message_id > after)
+        .order_by(Like.message_id))
+
+
+def _following(user_id, after):
+    return (
+        select(User.id, User.username)
+        .join(Follow, Follow.user_being_followed_id == User.id)
+        .where(Follow.user_following_id == user_id, User.id > after)
+        .order_by(User.id))
+
+
+def _followers(user_id, after):
+    return (
+        select(User.id, User.username)
+        .join(Follow, Follow.user_following_id == User.id)
+        .where(Follow.user_being_followed_id == user_id, User.id > after)
+        .order_by(User.id))
+
+
+QUERIES = {
+    'messages': _messages,
+    'likes': _likes,
+    'following': _following,
+    'followers': _followers,
+}
+
+RECORD_TYPES = {
+    'messages': 'message',
+    'likes': 'like',
+    'following': 'following',
+    'followers': 'follower',
+}
+
+
+def _section_shards(router, section, user_id):
+    if section == 'messages':
+        return [router.shard_for(user_id)]
+
+    if section == 'likes':
+        return range(router.num_shards)
+
+    return [0]
+
+
+def records(router, user_id, after=None):
+    """Yield `user_id`'s export records, as dicts, after the `after`
+    cursor if it's given.
+
+    `router` is the ShardRouter.
+    """
+
+    start_section, start_shard, start_key = (
+        parse_cursor(after) if after else (SECTIONS[0], 0, 0))
+
+    for section in SECTIONS[SECTIONS.index(start_section):]:
+        for shard in _section_shards(router, section, user_id):
+            key = 0
+
+            if section == start_section:
+                if shard < start_shard:
+                    continue
+                if shard == start_shard:
+                    key = start_key
+
+            statement = QUERIES[section](user_id, key)
+
+            for row in _stream(_engine(router, shard), statement):
+                yield _record(section, shard, row)
+
+
+def _record(section, shard, row):
+    record = dict(type=RECORD_TYPES[section],
+                  cursor=f"{section}:{shard}:{row[0]}", id=row[0])
+
+    if section == 'messages':
+        record.update(text=row.text, timestamp=row.timestamp.isoformat(),
+                      like_count=row.like_count)
+    elif section == 'likes':
+        record.update(timestamp=row.timestamp.isoformat())
+    else:
+        record.update(username=row.username)
+
+    return record
+
+
+def ndjson_lines(records):
+    """Yield each record as a line of JSON."""
+
+    for record in records:
+        yield json.dumps(record) + "\n"
+
+
+def csv_lines(records):
+    """Yield a CSV header and then a line per record."""
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_FIELDS, restval='')
+    writer.writeheader()
+
+    for record in records:
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(record)
+
+    yield buffer.getvalue()
+
+
+def export_lines(router, user_id, format='ndjson', after=None):
+    """Yield the lines of `user_id`'s export in `format`."""
+
+    lines = csv_lines if format == 'csv' else ndjson_lines
+
+    return lines(records(router, user_id, after))
+
+
+if __name__ == "__main__":
+    from app import app  # noqa: F401 (connects the database)
+    from shards import shards
+
+    args = sys.argv[1:]
+
+    if not 1 <= len(args) <= 3 or args[1:2] not in ([], ['ndjson'], ['csv']):
+        print(__doc__)
+        sys.exit(1)
+
+    for line in export_lines(shards, int(args[0]), *args[1:]):
+        sys.stdout.write(line)
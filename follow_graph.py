@@ -0,0 +1,484 @@
+"""Compact in-memory index of the follow graph.
+
+The follows table is held as two CSR (compressed sparse row) adjacency
+arrays, one per direction. For user u, the ids u follows are
+
+    out_neighbors[out_offsets[u]:out_offsets[u + 1]]
+
+sorted ascending, so "does A follow B" is a binary search over A's row and
+listing someone's followers or followees is a slice. The arrays are int64
+offsets and int32 user ids: about 8 bytes per user plus 8 per follow.
+
+The arrays live in a snapshot file (FOLLOW_GRAPH_PATH, by default in the
+temporary directory) that every worker maps into memory, so they share one
+copy through the page cache and start without reading the follows table.
+The first process to find no snapshot builds one on a background thread,
+serving an empty graph plus its own deltas until the file appears. Once
+the snapshot is FOLLOW_GRAPH_MAX_AGE_SECONDS old, the next worker to look
+at it rebuilds it the same way. Either way, a lock file beside it keeps the
+other workers from building it too. A new snapshot can also be built by hand with
+
+    python follow_graph.py snapshot
+
+Workers notice a new file within SNAPSHOT_CHECK_SECONDS and map it in. The
+gunicorn master maps it before forking (see warmup.py).
+
+Follows and unfollows made by this process are applied at once, as deltas
+on top of the snapshot. A delta is dropped when a snapshot built after it
+is mapped, since the snapshot then reflects it. Other workers only see the
+change with the next snapshot, about FOLLOW_GRAPH_MAX_AGE_SECONDS +
+SNAPSHOT_CHECK_SECONDS later on a site with steady traffic. So use the
+index for questions that can be that stale (recommendations), not for the
+user's own follow buttons.
+"""
+
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from array import array
+from bisect import bisect_left
+from hashlib import sha1
+from threading import Lock, Thread
+
+from sqlalchemy import select
+
+from models import db, Follow
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"WBFGRAPH"
+VERSION = 1
+
+# magic, version, number of users (highest id + 1), number of follows,
+# time the snapshot was built
+HEADER = struct.Struct("<8sIIQd")
+
+SNAPSHOT_CHECK_SECONDS = 5
+SNAPSHOT_MAX_AGE_SECONDS = 300
+
+
+def _padded(size):
+    """Round `size` up to a multiple of 8 bytes."""
+
+    return (size + 7) // 8 * 8
+
+
+def build_csr(num_users, edges):
+    """Return (offsets, neighbors) arrays for `edges`, (row, column) pairs.
+
+    Each row's neighbors are sorted ascending.
+    """
+
+    counts = [0] * (num_users + 1)
+
+    for row, _ in edges:
+        counts[row + 1] += 1
+
+    offsets = array("q", counts)
+
+    for i in range(1, len(offsets)):
+        offsets[i] += offsets[i - 1]
+
+    neighbors = array("i", bytes(4 * len(edges)))
+    fill = array("q", offsets)
+
+    for row, column in sorted(edges):
+        neighbors[fill[row]] = column
+        fill[row] += 1
+
+    return offsets, neighbors
+
+
+def write_snapshot(path, edges, built_at=None):
+    """Write a snapshot of `edges`, (follower, followed) pairs, to `path`.
+
+    The file is written next to `path` and renamed into place, so readers
+    only ever see complete snapshots.
+    """
+
+    built_at = time.time() if built_at is None else built_at
+    num_users = max((max(edge) for edge in edges), default=-1) + 1
+
+    out_offsets, out_neighbors = build_csr(num_users, edges)
+    in_offsets, in_neighbors = build_csr(
+        num_users, [(followed, follower) for follower, followed in edges])
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(
+                MAGIC, VERSION, num_users, len(edges), built_at))
+
+            for part in (out_offsets, out_neighbors, in_offsets, in_neighbors):
+                data = part.tobytes()
+                f.write(data + bytes(_padded(len(data)) - len(data)))
+
+        os.replace(tmp_path, path)
+
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def snapshot_built_at(path):
+    """When the snapshot at `path` was built, or 0 if there isn't one."""
+
+    try:
+        with open(path, "rb") as f:
+            return HEADER.unpack(f.read(HEADER.size))[4]
+    except (FileNotFoundError, struct.error):
+        return 0.0
+
+
+def default_path(database_url):
+    """A snapshot path in the temporary directory, one per database."""
+
+    digest = sha1(database_url.encode()).hexdigest()[:12]
+
+    return os.path.join(
+        tempfile.gettempdir(), f"warbler-follow-graph-{digest}.bin")
+
+
+def load_edges():
+    """Return every (follower, followed) pair in the follows table."""
+
+    return list(db.session.execute(select(
+        Follow.user_following_id, Follow.user_being_followed_id)))
+
+
+class Snapshot:
+    """A snapshot file, mapped read-only into memory."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.num_users, num_follows, self.built_at = (
+            HEADER.unpack_from(self.map))
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} follow graph")
+
+        view = memoryview(self.map)
+        position = HEADER.size
+        parts = []
+
+        for typecode, count in (("q", self.num_users + 1), ("i", num_follows),
+                                ("q", self.num_users + 1), ("i", num_follows)):
+            size = count * struct.calcsize(typecode)
+            parts.append(view[position:position + size].cast(typecode))
+            position += _padded(size)
+
+        (self.out_offsets, self.out_neighbors,
+         self.in_offsets, self.in_neighbors) = parts
+
+    @classmethod
+    def empty(cls):
+        """A stand-in for a missing snapshot: nobody follows anybody."""
+
+        snapshot = cls.__new__(cls)
+        snapshot.identity = None
+        snapshot.num_users = 0
+        snapshot.built_at = 0.0
+        snapshot.out_offsets = snapshot.in_offsets = array("q", [0])
+        snapshot.out_neighbors = snapshot.in_neighbors = array("i")
+
+        return snapshot
+
+    def rows(self, direction):
+        """Return the (offsets, neighbors) arrays for "out" or "in"."""
+
+        if direction == "out":
+            return self.out_offsets, self.out_neighbors
+
+        return self.in_offsets, self.in_neighbors
+
+    def contains(self, direction, user_id, other_id):
+        """Is `other_id` in `user_id`'s row?"""
+
+        offsets, neighbors = self.rows(direction)
+
+        if not 0 <= user_id < self.num_users:
+            return False
+
+        start, end = offsets[user_id], offsets[user_id + 1]
+        i = bisect_left(neighbors, other_id, start, end)
+
+        return i < end and neighbors[i] == other_id
+
+    def degree(self, direction, user_id):
+        """Return the length of `user_id`'s row, from its offsets."""
+
+        offsets, _ = self.rows(direction)
+
+        if not 0 <= user_id < self.num_users:
+            return 0
+
+        return offsets[user_id + 1] - offsets[user_id]
+
+    def neighbors(self, direction, user_id):
+        """Return `user_id`'s row as a list."""
+
+        offsets, neighbors = self.rows(direction)
+
+        if not 0 <= user_id < self.num_users:
+            return []
+
+        return neighbors[offsets[user_id]:offsets[user_id + 1]].tolist()
+
+
+class FollowGraph:
+    """The follow graph index; see the module docstring.
+
+    Like `db`, this is created once and bound to the app with `init_app`.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.snapshot = Snapshot.empty()
+        self.checked_at = None
+        self.lock = Lock()
+        # {user: {other: (followed?, applied at)}}, in both directions
+        self.out_deltas = {}
+        self.in_deltas = {}
+        self.app = None
+        self.max_age = SNAPSHOT_MAX_AGE_SECONDS
+        self.rebuild_thread = None
+
+    def init_app(self, app):
+        """Use the snapshot file named by the app's config."""
+
+        if self.app not in (None, app):
+            return  # configured by the first app; see create_app
+        self.app = app
+
+        self.path = app.config.get('FOLLOW_GRAPH_PATH') or default_path(
+            app.config['SQLALCHEMY_DATABASE_URI'])
+        self.max_age = app.config.get(
+            'FOLLOW_GRAPH_MAX_AGE_SECONDS', SNAPSHOT_MAX_AGE_SECONDS)
+        self.snapshot = Snapshot.empty()
+        self.checked_at = None
+        self.out_deltas = {}
+        self.in_deltas = {}
+
+    ##########################################################################
+    # Snapshots
+
+    def build_snapshot(self):
+        """Write a new snapshot of the follows table and map it in."""
+
+        built_at = time.time()
+        write_snapshot(self.path, load_edges(), built_at)
+        self.refresh(force=True)
+
+    def refresh(self, force=False):
+        """Map in the snapshot file if it has changed since it was mapped.
+
+        Only looks at the file every SNAPSHOT_CHECK_SECONDS, unless `force`.
+        """
+
+        now = time.monotonic()
+
+        if (not force and self.checked_at is not None
+                and now - self.checked_at < SNAPSHOT_CHECK_SECONDS):
+            return
+
+        self.checked_at = now
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            # First use: serve the empty graph and deltas until it's built.
+            if self.app is not None:
+                self._start_rebuild()
+            return
+
+        if (stat.st_ino, stat.st_mtime_ns) != self.snapshot.identity:
+            snapshot = Snapshot(self.path)
+
+            with self.lock:
+                self.snapshot = snapshot
+                self._drop_deltas_before(snapshot.built_at)
+
+        self.rebuild_if_stale()
+
+    def rebuild_if_stale(self, wait=False):
+        """Rebuild the snapshot if it's missing or older than max_age
+        seconds, on a background thread unless `wait`."""
+
+        if self.app is None:
+            return
+
+        if ((not self.max_age
+                or time.time() - self.snapshot.built_at < self.max_age)
+                and os.path.exists(self.path)):
+            return
+
+        if wait:
+            self._rebuild()
+            return
+
+        self._start_rebuild()
+
+    def _start_rebuild(self):
+        with self.lock:
+            if self.rebuild_thread is not None and self.rebuild_thread.is_alive():
+                return
+
+            self.rebuild_thread = Thread(
+                target=self._rebuild, name="follow-graph", daemon=True)
+            self.rebuild_thread.start()
+
+    def _rebuild(self):
+        try:
+            with open(self.path + ".lock", "a") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return  # another process is rebuilding it
+
+                # Another process may have built it since this one looked.
+                built_at = snapshot_built_at(self.path)
+
+                if built_at and (not self.max_age
+                                 or time.time() - built_at < self.max_age):
+                    return
+
+                with self.app.app_context():
+                    built_at = time.time()
+                    write_snapshot(self.path, load_edges(), built_at)
+
+        except Exception:
+            logger.exception("Rebuilding the follow graph snapshot failed")
+
+    def _drop_deltas_before(self, built_at):
+        for deltas in (self.out_deltas, self.in_deltas):
+            for user_id in list(deltas):
+                row = deltas[user_id]
+
+                for other_id, (_, applied_at) in list(row.items()):
+                    if applied_at < built_at:
+                        del row[other_id]
+
+                if not row:
+                    del deltas[user_id]
+
+    ##########################################################################
+    # Updates
+
+    def _apply(self, follower_id, followed_id, following):
+        applied_at = time.time()
+
+        with self.lock:
+            self.out_deltas.setdefault(follower_id, {})[followed_id] = (
+                following, applied_at)
+            self.in_deltas.setdefault(followed_id, {})[follower_id] = (
+                following, applied_at)
+
+    def add(self, follower_id, followed_id):
+        """Record that `follower_id` now follows `followed_id`."""
+
+        self._apply(follower_id, followed_id, True)
+
+    def remove(self, follower_id, followed_id):
+        """Record that `follower_id` no longer follows `followed_id`."""
+
+        self._apply(follower_id, followed_id, False)
+
+    def remove_user(self, user_id):
+        """Record that `user_id`'s follows, both ways, are gone."""
+
+        for followed_id in self.following(user_id):
+            self.remove(user_id, followed_id)
+
+        for follower_id in self.followers(user_id):
+            self.remove(follower_id, user_id)
+
+    ##########################################################################
+    # Queries
+
+    def _deltas(self, direction, user_id):
+        deltas = self.out_deltas if direction == "out" else self.in_deltas
+
+        return deltas.get(user_id, {})
+
+    def _neighbors(self, direction, user_id):
+        self.refresh()
+
+        ids = self.snapshot.neighbors(direction, user_id)
+        deltas = self._deltas(direction, user_id)
+
+        if deltas:
+            ids = set(ids)
+
+            for other_id, (following, _) in list(deltas.items()):
+                if following:
+                    ids.add(other_id)
+                else:
+                    ids.discard(other_id)
+
+            ids = sorted(ids)
+
+        return ids
+
+    def follows(self, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?"""
+
+        self.refresh()
+        delta = self._deltas("out", follower_id).get(followed_id)
+
+        if delta is not None:
+            return delta[0]
+
+        return self.snapshot.contains("out", follower_id, followed_id)
+
+    def following(self, user_id):
+        """Return the ids `user_id` follows, ascending."""
+
+        return self._neighbors("out", user_id)
+
+    def followers(self, user_id):
+        """Return the ids following `user_id`, ascending."""
+
+        return self._neighbors("in", user_id)
+
+    def follower_count(self, user_id):
+        """Return how many users follow `user_id`, without listing them."""
+
+        self.refresh()
+
+        count = self.snapshot.degree("in", user_id)
+
+        # Only the deltas that change the snapshot's answer count.
+        for follower_id, (following, _) in list(
+                self._deltas("in", user_id).items()):
+            if following != self.snapshot.contains("out", follower_id, user_id):
+                count += 1 if following else -1
+
+        return count
+
+
+follow_graph = FollowGraph()
+
+
+if __name__ == "__main__":
+    from app import app  # noqa: F401 (connects the database)
+    # The instance app initialised, not this script's copy of it.
+    from follow_graph import follow_graph
+
+    if sys.argv[1:] == ["snapshot"]:
+        follow_graph.build_snapshot()
+        print(f"Wrote {follow_graph.path}: "
+              f"{len(follow_graph.snapshot.out_neighbors)} follows")
+
+    else:
+        print(__doc__)
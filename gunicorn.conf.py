@@ -0,0 +1,57 @@
+"""Gunicorn settings for Warbler.
+
+    gunicorn -c gunicorn.conf.py
+
+The app is created and warmed up once in the master process before the
+workers are forked; see warmup.py. To serve the ASGI mode instead (see
+asgi.py), name its app and worker class:
+
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker \
+        "asgi:create_asgi_app('production')"
+
+Gunicorn only serves requests. Background jobs (account deletion, image
+ingestion; see jobs.py) need at least one job worker running beside it,
+started separately:
+
+    python jobs.py work
+
+Without one, jobs wait in the queue, and users who deleted their accounts
+stay hidden but undeleted.
+"""
+
+import gc
+import os
+
+from warmup import dispose_engines, warm_up
+
+wsgi_app = "app:create_app('production')"
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 4))
+
+preload_app = True
+
+
+def flask_app(server):
+    """The Flask app gunicorn loaded, unwrapping the ASGI app if need be."""
+
+    app = server.app.wsgi()
+
+    return getattr(app, 'flask_app', app)
+
+
+def when_ready(server):
+    """Warm the preloaded app up before any worker is forked."""
+
+    warm_up(flask_app(server))
+
+    # Keep the garbage collector from touching (and so copying) the objects
+    # the workers share with the master.
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    """Give each worker its own database connections."""
+
+    dispose_engines(flask_app(worker), close=False)
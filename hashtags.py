@@ -0,0 +1,161 @@
+"""Hashtags and @mentions in messages.
+
+When a message is written (ShardRouter.add_message), its #hashtags and the
+users it @mentions are stored in the message_tags and mentions tables, in
+the same transaction and on the same shard as the message. Each table is
+indexed by (tag or user, timestamp DESC, message id DESC), so a tag's or a
+user's mentions timeline is read newest first straight from the index, a
+page at a time, like the likes page.
+
+Tags are matched case-insensitively and stored lowercased. A mention only
+counts if the username exists when the message is written.
+
+Messages written before these tables existed are indexed with
+
+    python hashtags.py backfill
+
+which walks each shard's messages in id order, BACKFILL_BATCH_SIZE at a
+time. It can be stopped and rerun: each batch replaces its own rows.
+"""
+
+import re
+import sys
+
+from markupsafe import Markup, escape
+from sqlalchemy import delete, insert, select
+
+from models import db, User, Message, MessageTag, Mention
+
+# Not after a word character, so "a#b" isn't a tag, nor after "&", so the
+# "&#39;" of escaped text isn't either.
+TAG_RE = re.compile(r"(?<![\w#&])#(\w+)")
+MENTION_RE = re.compile(r"(?<![\w@])@(\w+)")
+
+MAX_TAG_LENGTH = MessageTag.tag.type.length
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def extract_tags(text):
+    """Return the distinct hashtags in `text`, lowercased, in order."""
+
+    tags = (tag.lower() for tag in TAG_RE.findall(text))
+
+    return list(dict.fromkeys(
+        tag for tag in tags if len(tag) <= MAX_TAG_LENGTH))
+
+
+def extract_mentions(text):
+    """Return the distinct usernames @mentioned in `text`, in order."""
+
+    return list(dict.fromkeys(MENTION_RE.findall(text)))
+
+
+def user_ids_by_username(usernames):
+    """Return {username: user id} for those of `usernames` that exist."""
+
+    if not usernames:
+        return {}
+
+    return dict(db.session.execute(
+        select(User.username, User.id)
+        .where(User.username.in_(usernames))).all())
+
+
+def side_rows(messages):
+    """Return (tag rows, mention rows) to insert for `messages`.
+
+    `messages` are (id, text, timestamp) triples. Mentioned usernames are
+    looked up in one query.
+    """
+
+    mentions = {
+        message_id: extract_mentions(text)
+        for message_id, text, _ in messages}
+
+    user_ids = user_ids_by_username(
+        {name for names in mentions.values() for name in names})
+
+    tag_rows = [
+        dict(tag=tag, message_id=message_id, timestamp=timestamp)
+        for message_id, text, timestamp in messages
+        for tag in extract_tags(text)
+    ]
+
+    mention_rows = [
+        dict(user_id=user_ids[name], message_id=message_id,
+             timestamp=timestamp)
+        for message_id, _, timestamp in messages
+        for name in mentions[message_id] if name in user_ids
+    ]
+
+    return tag_rows, mention_rows
+
+
+def insert_side_rows(session, messages):
+    """Insert the tag and mention rows for `messages` into `session`."""
+
+    tag_rows, mention_rows = side_rows(messages)
+
+    if tag_rows:
+        session.execute(insert(MessageTag), tag_rows)
+
+    if mention_rows:
+        session.execute(insert(Mention), mention_rows)
+
+
+def link_hashtags(text):
+    """Template filter: escape `text` and link its hashtags to their pages."""
+
+    return Markup(TAG_RE.sub(
+        lambda match: Markup('<a href="/tags/{}">#{}</a>').format(
+            match.group(1).lower(), match.group(1)),
+        str(escape(text))))
+
+
+def backfill(router):
+    """Index the tags and mentions of every message on every shard.
+
+    `router` is the ShardRouter. Returns the number of messages indexed.
+    """
+
+    indexed = 0
+
+    for shard in range(router.num_shards):
+        session = router.session(shard)
+        last_id = 0
+
+        while True:
+            messages = session.execute(
+                select(Message.id, Message.text, Message.timestamp)
+                .where(Message.id > last_id)
+                .order_by(Message.id)
+                .limit(BACKFILL_BATCH_SIZE)).all()
+
+            if not messages:
+                break
+
+            message_ids = [message_id for message_id, _, _ in messages]
+
+            for model in (MessageTag, Mention):
+                session.execute(
+                    delete(model).where(model.message_id.in_(message_ids)))
+
+            insert_side_rows(session, messages)
+            session.commit()
+
+            indexed += len(messages)
+            last_id = message_ids[-1]
+
+    return indexed
+
+
+if __name__ == "__main__":
+    from app import app  # noqa: F401 (connects the database)
+    from shards import shards
+
+    if sys.argv[1:] == ["backfill"]:
+        print(f"Indexed {backfill(shards)} messages")
+
+    else:
+        print(__doc__)
@@ -0,0 +1,312 @@
+"""Local copies of profile and header images, resized for where they're shown.
+
+Users' image_url and header_image_url point anywhere on the web; a 60px
+timeline avatar might be a 2000px photo on another host. Instead, each image
+is fetched once, by the ingest_user_images job (see jobs.py), and cut into
+each of the fixed-size VARIANTS:
+
+    thumb   96x96     timeline, navigation and suggestion avatars
+    card    200x200   profile avatars and user cards
+    hero    1200x400  profile and card headers
+
+Variants are WebP files in IMAGE_CACHE_DIR named after a hash of the source
+image's bytes, so an image used by many users (the defaults) is stored
+once, and a name's content never changes: /images/<name> is served with a
+year-long immutable Cache-Control. The hash is stored on the user
+(image_digest, header_image_digest); until it's set, as right after a
+change, templates use the original URL.
+
+Only http(s) URLs and the app's own /static/ files are fetched. The URLs
+are whatever users typed, so a URL (or a redirect) whose host resolves to
+a loopback, private, link-local or otherwise non-public address is
+refused: the worker mustn't be a way to reach internal services or a
+cloud metadata endpoint. Each connection, the first and each redirect's,
+goes to the very address that was checked rather than resolving the host
+again, so a host whose DNS changes between the check and the connection
+can't slip through. Images already referenced are ingested with
+
+    python images.py ingest
+"""
+
+import hashlib
+import http.client
+import ipaddress
+import os
+import socket
+import sys
+import tempfile
+from functools import partial
+from io import BytesIO
+from urllib.parse import urlparse
+from urllib.request import (
+    HTTPHandler, HTTPSHandler, ProxyHandler, Request, build_opener,
+)
+
+from flask import current_app, url_for
+from PIL import Image, ImageOps
+from sqlalchemy import or_, select
+
+from models import db, User
+
+VARIANTS = {
+    'thumb': (96, 96),
+    'card': (200, 200),
+    'hero': (1200, 400),
+}
+
+FETCH_TIMEOUT_SECONDS = 10
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+
+# A year: the longest Cache-Control max-age browsers honour
+CACHE_SECONDS = 365 * 24 * 3600
+
+INGEST_BATCH_SIZE = 100
+
+# Refuse decompression bombs rather than only warning about them.
+Image.MAX_IMAGE_PIXELS = 50_000_000
+
+
+class ImageError(Exception):
+    """An image couldn't be fetched or read."""
+
+
+def cache_dir(config=None):
+    """The directory variants are stored in."""
+
+    config = current_app.config if config is None else config
+
+    return (config.get('IMAGE_CACHE_DIR')
+            or os.path.join(tempfile.gettempdir(), "warbler-images"))
+
+
+def variant_name(digest, variant):
+    return f"{digest}-{variant}.webp"
+
+
+def check_public(url):
+    """Return the address to connect to for `url`.
+
+    Raises ImageError unless `url` is http(s) and its host resolves only
+    to public addresses.
+    """
+
+    parsed = urlparse(url)
+
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ImageError(f"Can't fetch {url!r}")
+
+    try:
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        infos = socket.getaddrinfo(
+            parsed.hostname, port, proto=socket.IPPROTO_TCP)
+    except (OSError, ValueError) as error:
+        raise ImageError(f"Fetching {url}: {error}") from error
+
+    for *_, sockaddr in infos:
+        address = ipaddress.ip_address(sockaddr[0].split("%")[0])
+
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+
+        if not address.is_global or address.is_multicast:
+            raise ImageError(
+                f"Not fetching {url}: {address} isn't a public address")
+
+    return infos[0][4][0]
+
+
+class PinnedConnection:
+    """Connects to `address` whatever the host resolves to now; the Host
+    header (and for HTTPS, SNI and the certificate check) still use the
+    host."""
+
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, **kwargs)
+        self._create_connection = (
+            lambda host_port, *args: socket.create_connection(
+                (address, host_port[1]), *args))
+
+
+class PinnedHTTPConnection(PinnedConnection, http.client.HTTPConnection):
+    pass
+
+
+class PinnedHTTPSConnection(PinnedConnection, http.client.HTTPSConnection):
+    pass
+
+
+class PublicHTTPHandler(HTTPHandler):
+    """Opens http URLs, redirects included, only at checked addresses."""
+
+    def http_open(self, req):
+        return self.do_open(
+            partial(PinnedHTTPConnection, address=check_public(req.full_url)),
+            req)
+
+
+class PublicHTTPSHandler(HTTPSHandler):
+    """Opens https URLs, redirects included, only at checked addresses."""
+
+    def https_open(self, req):
+        return self.do_open(
+            partial(PinnedHTTPSConnection, address=check_public(req.full_url)),
+            req, context=self._context)
+
+
+def fetch(url):
+    """Return the bytes of the image at `url`."""
+
+    if url.startswith("/static/"):
+        path = os.path.join(
+            current_app.static_folder, url[len("/static/"):].split("?")[0])
+
+        if not os.path.realpath(path).startswith(
+                os.path.realpath(current_app.static_folder) + os.sep):
+            raise ImageError(f"Not a static file: {url}")
+
+        try:
+            with open(path, "rb") as file:
+                return file.read(MAX_IMAGE_BYTES + 1)
+        except OSError as error:
+            raise ImageError(str(error)) from error
+
+    check_public(url)
+
+    try:
+        request = Request(url, headers={"User-Agent": "warbler-images"})
+        # No proxies: the connection must go to the address checked.
+        opener = build_opener(
+            ProxyHandler({}), PublicHTTPHandler, PublicHTTPSHandler)
+        with opener.open(request, timeout=FETCH_TIMEOUT_SECONDS) as response:
+            data = response.read(MAX_IMAGE_BYTES + 1)
+    except OSError as error:
+        raise ImageError(f"Fetching {url}: {error}") from error
+
+    if len(data) > MAX_IMAGE_BYTES:
+        raise ImageError(f"{url} is over {MAX_IMAGE_BYTES} bytes")
+
+    return data
+
+
+def ingest(data, directory=None):
+    """Store the variants of the image in `data` (bytes); return its
+    digest. Does nothing if they're already stored."""
+
+    directory = directory or cache_dir()
+    digest = hashlib.sha256(data).hexdigest()[:32]
+
+    missing = [
+        variant for variant in VARIANTS
+        if not os.path.exists(
+            os.path.join(directory, variant_name(digest, variant)))
+    ]
+
+    if not missing:
+        return digest
+
+    try:
+        image = Image.open(BytesIO(data))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+    except (OSError, Image.DecompressionBombError) as error:
+        raise ImageError(f"Not a usable image: {error}") from error
+
+    os.makedirs(directory, exist_ok=True)
+
+    for variant in missing:
+        resized = ImageOps.fit(image, VARIANTS[variant], Image.LANCZOS)
+        path = os.path.join(directory, variant_name(digest, variant))
+
+        # Written aside and renamed, so a half-written file is never served.
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+
+        with os.fdopen(fd, "wb") as file:
+            resized.save(file, "WEBP", quality=85)
+
+        os.replace(tmp_path, path)
+
+    return digest
+
+
+def ingest_user(user_id):
+    """Ingest `user_id`'s avatar and header and record their digests.
+
+    An image that can't be ingested leaves its digest unset, so the
+    original URL is still used.
+    """
+
+    user = db.session.get(User, user_id)
+
+    if user is None:
+        return
+
+    for url_field, digest_field in (('image_url', 'image_digest'),
+                                    ('header_image_url', 'header_image_digest')):
+        try:
+            digest = ingest(fetch(getattr(user, url_field)))
+        except ImageError as error:
+            current_app.logger.warning(
+                "Image for user %s not ingested: %s", user_id, error)
+            digest = None
+
+        setattr(user, digest_field, digest)
+
+
+def ingest_all():
+    """Ingest the images of every user missing a digest; return how many
+    users were done. Commits after each INGEST_BATCH_SIZE users."""
+
+    done = 0
+    last_id = 0
+
+    while True:
+        user_ids = db.session.scalars(
+            select(User.id)
+            .where(User.id > last_id,
+                   or_(User.image_digest.is_(None),
+                       User.header_image_digest.is_(None)))
+            .order_by(User.id)
+            .limit(INGEST_BATCH_SIZE)).all()
+
+        if not user_ids:
+            return done
+
+        for user_id in user_ids:
+            ingest_user(user_id)
+
+        db.session.commit()
+        done += len(user_ids)
+        last_id = user_ids[-1]
+
+
+##############################################################################
+# Template filters
+
+
+def _variant_url(digest, url, variant):
+    if not digest:
+        return url
+
+    return url_for('warbler.show_image', name=variant_name(digest, variant))
+
+
+def avatar(user, variant='thumb'):
+    """Template filter: the URL of `user`'s avatar in `variant`."""
+
+    return _variant_url(user.image_digest, user.image_url, variant)
+
+
+def header(user):
+    """Template filter: the URL of `user`'s header image."""
+
+    return _variant_url(user.header_image_digest, user.header_image_url, 'hero')
+
+
+if __name__ == "__main__":
+    from app import app  # noqa: F401 (connects the database)
+
+    if sys.argv[1:] == ["ingest"]:
+        print(f"Ingested the images of {ingest_all()} users")
+
+    else:
+        print(__doc__)
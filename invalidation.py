@@ -0,0 +1,238 @@
+"""Cross-worker cache invalidation over Postgres LISTEN/NOTIFY.
+
+A route that changes an entity publishes its key in the same transaction:
+
+    invalidation.bus.publish('user', g.user.id)
+    db.session.commit()
+
+NOTIFY is transactional, so the key ("user:42") is only sent if the change
+commits, and only once it has. Every worker keeps a connection LISTENing
+on CHANNEL (DATABASE_DIRECT_URL if set, as LISTEN can't go through
+PgBouncer) and bumps its version of each key it hears about; the
+publishing worker bumps its own as soon as it commits.
+
+A per-process cache stamps what it stores with the entity's key, and
+checks the stamp when reading it back:
+
+    stamp = bus.stamp(f"user:{user_id}")   # before loading
+    ...
+    if bus.fresh(f"user:{user_id}", stamp): ...
+
+An entry is fresh while its key's version is unchanged and the listener
+has been connected since it was loaded. While the listener is down (or
+when it reconnects, since notifications sent in the gap are lost) entries
+only stay fresh for FALLBACK_TTL_SECONDS, so caches degrade to short TTLs
+rather than serving stale data.
+
+Postgres takes a database-wide lock to queue each committed NOTIFY, so
+publish changes people expect to see everywhere (profiles, deletions,
+follows), not every write.
+"""
+
+import logging
+import os
+import select
+import time
+from collections import namedtuple
+from threading import Event, Lock, Thread
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from metrics import counter, gauge
+from models import db
+from pooling import direct_engine
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'warbler_invalidate'
+
+FALLBACK_TTL_SECONDS = 5
+POLL_SECONDS = 1
+RECONNECT_SECONDS = 2
+
+# Versions are forgotten (and every stamp goes stale) past this many keys.
+MAX_KEYS = 100_000
+
+# Keys published in a session's transaction, bumped locally on commit
+PUBLISHED_KEY = 'invalidation_published'
+
+Stamp = namedtuple('Stamp', ['version', 'loaded_at'])
+
+received = counter(
+    'warbler_invalidations_received_total',
+    "Invalidation notifications heard from the database.")
+
+
+class InvalidationBus:
+    """Versions of entity keys, kept current by a LISTEN thread."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.versions = {}
+        # Bumped when versions is cleared, so older stamps don't match
+        self.epoch = 0
+        self.connected_since = None
+        self.engine = None
+        self.thread = None
+        self.pid = None
+        self.stopping = Event()
+        # Set while the gunicorn master warms up (see warmup.py): its
+        # requests mustn't start a listener, or check out a connection,
+        # that the forked workers would inherit.
+        self.paused = False
+        self.app = None
+
+    def init_app(self, app):
+        """Listen on the app's primary database, if it's Postgres."""
+
+        # Later apps share the first one's connection; see create_app.
+        if self.app in (None, app):
+            self.app = app
+
+            if (app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql')
+                    and app.config.get('INVALIDATION_LISTEN', True)):
+                self.engine = direct_engine(app.config)
+
+        if self.engine is not None:
+            app.before_request(self.ensure_listening)
+
+    ##########################################################################
+    # Versions
+
+    def version(self, key):
+        with self.lock:
+            return (self.epoch, self.versions.get(key, 0))
+
+    def bump(self, key):
+        """Mark `key` changed: stamps taken before now are stale."""
+
+        with self.lock:
+            if key not in self.versions and len(self.versions) >= MAX_KEYS:
+                self.versions = {}
+                self.epoch += 1
+
+            self.versions[key] = self.versions.get(key, 0) + 1
+
+    def stamp(self, key):
+        """Return a Stamp for a cache entry about to be loaded for `key`."""
+
+        return Stamp(self.version(key), time.monotonic())
+
+    def fresh(self, key, stamp):
+        """Whether an entry stamped with `stamp` can still be used."""
+
+        if self.version(key) != stamp.version:
+            return False
+
+        since = self.connected_since
+
+        if since is not None and since <= stamp.loaded_at:
+            return True
+
+        return time.monotonic() - stamp.loaded_at < FALLBACK_TTL_SECONDS
+
+    ##########################################################################
+    # Publishing
+
+    def publish(self, kind, entity_id):
+        """Invalidate "`kind`:`entity_id`" everywhere when db.session's
+        transaction commits."""
+
+        key = f"{kind}:{entity_id}"
+
+        if self.engine is not None:
+            db.session.execute(
+                text("SELECT pg_notify(:channel, :key)"),
+                {'channel': CHANNEL, 'key': key})
+
+        db.session.info.setdefault(PUBLISHED_KEY, set()).add(key)
+
+    ##########################################################################
+    # Listening
+
+    def ensure_listening(self):
+        """Start this process's listener thread if it isn't running.
+
+        Called before each request, so each forked worker starts its own.
+        """
+
+        if self.paused:
+            return
+
+        if self.pid == os.getpid() and self.thread.is_alive():
+            return
+
+        with self.lock:
+            if self.pid == os.getpid() and self.thread.is_alive():
+                return
+
+            self.pid = os.getpid()
+            self.connected_since = None
+            self.stopping.clear()
+            self.thread = Thread(
+                target=self.listen, name="invalidation", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+        if self.thread is not None:
+            self.thread.join()
+
+    def listen(self):
+        """Bump the keys notified on CHANNEL until stopped, reconnecting
+        after RECONNECT_SECONDS whenever the connection drops."""
+
+        while not self.stopping.is_set():
+            conn = None
+
+            try:
+                conn = self.engine.raw_connection()
+                pg = conn.driver_connection
+                pg.autocommit = True
+
+                with pg.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CHANNEL}")
+
+                self.connected_since = time.monotonic()
+
+                while not self.stopping.is_set():
+                    if not select.select([pg], [], [], POLL_SECONDS)[0]:
+                        continue
+
+                    pg.poll()
+
+                    while pg.notifies:
+                        self.bump(pg.notifies.pop(0).payload)
+                        received.inc()
+
+            except Exception:
+                logger.exception("Invalidation listener disconnected")
+
+            finally:
+                self.connected_since = None
+
+                # Never hand a LISTENing connection back to the pool.
+                if conn is not None:
+                    conn.invalidate()
+
+            self.stopping.wait(RECONNECT_SECONDS)
+
+
+bus = InvalidationBus()
+
+gauge('warbler_invalidation_listening',
+      "1 while this worker's invalidation listener is connected.",
+      collect=lambda: {(): int(bus.connected_since is not None)})
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_published(session):
+    for key in session.info.pop(PUBLISHED_KEY, ()):
+        bus.bump(key)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_published(session, previous_transaction):
+    session.info.pop(PUBLISHED_KEY, None)
@@ -0,0 +1,346 @@
+"""Background jobs, kept in the jobs table on the primary database.
+
+A request enqueues a job in its own transaction, so the job is queued
+exactly when the request's writes commit, and not at all if they roll back:
+
+    jobs.enqueue('delete_user', {'user_id': user.id},
+                 key=f"delete-user:{user.id}")
+    db.session.commit()
+
+Worker processes run the jobs, each on JOB_WORKER_THREADS threads:
+
+    python jobs.py work      # until interrupted
+    python jobs.py status    # jobs by status, and the queue's lag
+
+The web server doesn't run jobs itself, so a deployment needs at least one
+`python jobs.py work` process beside gunicorn (see gunicorn.conf.py).
+
+Each thread claims the next due job with SELECT ... FOR UPDATE SKIP LOCKED,
+so any number of workers can share the queue without running a job twice
+at once. The job's handler (registered with @handler) runs, and the job is
+marked done in the same primary transaction as the handler's writes.
+
+- A job that raises is retried after RETRY_BASE_SECONDS * 2 ** (attempts -
+  1) seconds, up to its max_attempts, and then marked failed.
+- A job still running LEASE_SECONDS after it started is assumed to have lost
+  its worker and is claimed again. Handlers must therefore be safe to run
+  more than once.
+- Enqueueing with an idempotency key that another job already has does
+  nothing, so retried requests don't queue duplicates. Finished jobs, and
+  their keys, are kept for RETAIN_DAYS.
+
+/metrics reports the jobs in each status (warbler_jobs) and how long the
+oldest due job has waited (warbler_jobs_lag_seconds); workers count the
+jobs they run by kind and outcome (warbler_jobs_run_total).
+"""
+
+import logging
+import sys
+import time
+import traceback
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+
+from flask import has_app_context
+from sqlalchemy import and_, delete, func, or_, select
+from sqlalchemy.dialects.postgresql import insert
+
+import images
+import invalidation
+import recommendations
+from metrics import counter, gauge
+from models import db, User, Job
+from shards import shards
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = 300
+RETRY_BASE_SECONDS = 5
+RETAIN_DAYS = 7
+
+POLL_SECONDS = 1
+PRUNE_SECONDS = 3600
+
+HANDLERS = {}
+
+jobs_run = counter(
+    'warbler_jobs_run_total',
+    "Jobs this worker has run, by kind and outcome (done, retry, failed).")
+
+
+def handler(kind):
+    """Register the decorated function to run jobs of `kind`.
+
+    It's called with the job's payload as keyword arguments, in an app
+    context, and its writes are committed with the job.
+    """
+
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+
+    return register
+
+
+def enqueue(kind, payload=None, key=None, delay=0):
+    """Add a job to db.session's transaction; it's queued on commit.
+
+    `delay` is seconds before the job may run. Nothing is added if `key` is
+    given and another job already has it.
+    """
+
+    if kind not in HANDLERS:
+        raise ValueError(f"No handler for {kind!r} jobs")
+
+    statement = insert(Job).values(
+        kind=kind,
+        payload=payload or {},
+        idempotency_key=key,
+        run_at=datetime.utcnow() + timedelta(seconds=delay))
+
+    if key is not None:
+        statement = statement.on_conflict_do_nothing(
+            index_elements=[Job.idempotency_key])
+
+    db.session.execute(statement)
+
+
+##############################################################################
+# Running jobs
+
+
+def claim_next():
+    """Claim the next due job for this thread and commit; None if none is
+    due."""
+
+    now = datetime.utcnow()
+
+    job = db.session.scalars(
+        select(Job)
+        .where(or_(
+            and_(Job.status == 'queued', Job.run_at <= now),
+            and_(Job.status == 'running',
+                 Job.started_at < now - timedelta(seconds=LEASE_SECONDS))))
+        .order_by(Job.run_at)
+        .limit(1)
+        .with_for_update(skip_locked=True)).first()
+
+    if job is None:
+        db.session.rollback()
+        return None
+
+    job.status = 'running'
+    job.started_at = now
+    job.attempts += 1
+    db.session.commit()
+
+    return job
+
+
+def run_next():
+    """Claim and run the next due job; return it, or None if none was due."""
+
+    job = claim_next()
+
+    if job is None:
+        return None
+
+    job_id, kind, payload = job.id, job.kind, job.payload
+
+    try:
+        HANDLERS[kind](**payload)
+
+        job.status = 'done'
+        job.finished_at = datetime.utcnow()
+        shards.commit()
+
+        jobs_run.inc(kind=kind, outcome='done')
+
+    except Exception:
+        logger.exception("Job %s (%s) failed", job_id, kind)
+
+        db.session.rollback()
+        shards.remove_sessions()
+
+        job = db.session.get(Job, job_id)
+        job.last_error = traceback.format_exc()
+
+        if job.attempts >= job.max_attempts:
+            job.status = 'failed'
+            job.finished_at = datetime.utcnow()
+        else:
+            job.status = 'queued'
+            job.run_at = datetime.utcnow() + timedelta(
+                seconds=RETRY_BASE_SECONDS * 2 ** (job.attempts - 1))
+
+        db.session.commit()
+        jobs_run.inc(kind=kind, outcome=job.status.replace('queued', 'retry'))
+
+    return job
+
+
+def run_pending():
+    """Run jobs until none is due; return how many ran."""
+
+    ran = 0
+
+    while run_next() is not None:
+        ran += 1
+
+    return ran
+
+
+def prune():
+    """Delete jobs that finished more than RETAIN_DAYS ago; commits."""
+
+    db.session.execute(delete(Job).where(
+        Job.status.in_(['done', 'failed']),
+        Job.finished_at < datetime.utcnow() - timedelta(days=RETAIN_DAYS)))
+    db.session.commit()
+
+
+class Worker:
+    """Runs jobs for `app` on a pool of threads until stopped."""
+
+    def __init__(self, app, threads=None):
+        self.app = app
+        self.num_threads = threads or app.config['JOB_WORKER_THREADS']
+        self.stopping = Event()
+        self.threads = []
+        self.prune_lock = Lock()
+        self.pruned_at = None
+
+    def start(self):
+        self.threads = [
+            Thread(target=self.work, name=f"jobs-{n}", daemon=True)
+            for n in range(self.num_threads)
+        ]
+
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """Finish the jobs being run, then stop."""
+
+        self.stopping.set()
+
+        for thread in self.threads:
+            thread.join()
+
+    def work(self):
+        while not self.stopping.is_set():
+            with self.app.app_context():
+                self.maybe_prune()
+                job = run_next()
+
+            if job is None:
+                self.stopping.wait(POLL_SECONDS)
+
+    def maybe_prune(self):
+        with self.prune_lock:
+            if (self.pruned_at is not None
+                    and time.monotonic() - self.pruned_at < PRUNE_SECONDS):
+                return
+
+            self.pruned_at = time.monotonic()
+
+        prune()
+
+
+##############################################################################
+# Queue metrics, read from the database when /metrics is scraped
+
+
+def _job_counts():
+    if not has_app_context():
+        return {}
+
+    return {
+        (("status", status),): count
+        for status, count in db.session.execute(
+            select(Job.status, func.count()).group_by(Job.status))
+    }
+
+
+def _lag_seconds():
+    if not has_app_context():
+        return {}
+
+    now = datetime.utcnow()
+    oldest = db.session.scalar(
+        select(func.min(Job.run_at))
+        .where(Job.status == 'queued', Job.run_at <= now))
+
+    return {(): round((now - oldest).total_seconds(), 3) if oldest else 0}
+
+
+gauge('warbler_jobs',
+      "Jobs in the queue, by status.",
+      collect=_job_counts)
+
+gauge('warbler_jobs_lag_seconds',
+      "How long the oldest due job has been waiting to run.",
+      collect=_lag_seconds)
+
+
+##############################################################################
+# Handlers
+
+
+@handler('delete_user')
+def delete_user(user_id):
+    """Delete a user, their messages and their likes on every shard."""
+
+    user = db.session.get(User, user_id)
+
+    if user is None:
+        return
+
+    shards.delete_user_data(user_id)
+    db.session.delete(user)
+    db.session.flush()
+
+    # Sent as the job commits, so no worker reloads the user before then.
+    invalidation.bus.publish('user', user_id)
+
+
+@handler('ingest_user_images')
+def ingest_user_images(user_id):
+    """Store resized copies of a user's avatar and header image."""
+
+    images.ingest_user(user_id)
+
+
+@handler('refresh_suggestions')
+def refresh_suggestions(user_id):
+    """Recompute a user's who to follow suggestions."""
+
+    user = db.session.get(User, user_id)
+
+    if user is None or user.pending_deletion:
+        return
+
+    recommendations.refresh_user(user_id)
+
+
+if __name__ == "__main__":
+    from app import app
+
+    if sys.argv[1:] == ["work"]:
+        logging.basicConfig(level=logging.INFO)
+        worker = Worker(app)
+        worker.start()
+        print(f"Running jobs on {worker.num_threads} threads")
+
+        try:
+            worker.stopping.wait()
+        except KeyboardInterrupt:
+            worker.stop()
+
+    elif sys.argv[1:] == ["status"]:
+        for (labels, count) in sorted(_job_counts().items()):
+            print(f"{labels[0][1]}: {count}")
+        print(f"lag: {_lag_seconds()[()]}s")
+
+    else:
+        print(__doc__)
@@ -0,0 +1,435 @@
+"""Liking and unliking messages, optionally written behind.
+
+By default a like or unlike is written and committed in its request, by
+ShardRouter.toggle_like. With LIKE_WRITE_BEHIND on, it only changes an
+entry in this process's LikeBuffer, one per (user, message), so however
+many times a user toggles a message between flushes it's one change, or
+none. Every LIKE_FLUSH_SECONDS (checked after each request, and when the
+process exits) the buffer is written one transaction per shard:
+
+- one multi-row INSERT ... ON CONFLICT DO NOTHING for the likes,
+- one DELETE for the unlikes,
+- and one UPDATE per message whose like_count changed, by the number of
+  rows really inserted or deleted, so counts don't drift when another
+  process flushes the same like.
+
+A burst of likes on a popular message is then a few statements and one
+commit a second rather than a commit per click.
+
+liked_message_ids applies the buffer to what the database says, so a user
+sees their own likes and like counts change straight away. The worker that
+served the click has it buffered; every other worker learns of it from the
+user's session, which remembers their last SESSION_LIKES toggles for
+SESSION_SECONDS, long enough for them to be flushed. A toggle also starts
+from what the session says the user sees, so unliking on one worker a like
+still buffered on another is written as an unlike. Other users see changes
+after the flush. Two toggles of one like on different workers within a
+flush are written in the order the workers flush them, and changes still
+buffered when a worker is killed are lost.
+"""
+
+import atexit
+import logging
+import time
+from collections import Counter, namedtuple
+from datetime import datetime
+from threading import Lock
+
+from flask import has_request_context, session
+from sqlalchemy import bindparam, delete, select, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm.attributes import set_committed_value
+
+import trending
+from metrics import counter, gauge
+from models import Like, Message
+from shards import shards, ShardMoving
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SECONDS = 1
+
+# How many of a user's toggles their session remembers, and for how long
+SESSION_KEY = 'unflushed_likes'
+SESSION_LIKES = 50
+SESSION_SECONDS = 60
+
+# What a buffered like needs of its message: trending.counters.record takes
+# its id and user_id, and the timestamp finds its partition.
+LikedMessage = namedtuple('LikedMessage', ['id', 'user_id', 'timestamp'])
+
+flushed_likes = counter(
+    'warbler_like_flush_rows_total',
+    "Likes inserted or deleted by write-behind flushes, by change.")
+
+flushes = counter(
+    'warbler_like_flushes_total',
+    "Write-behind like flushes, one commit per shard changed.")
+
+
+class PendingLike:
+    """A buffered like state: whether it was liked when first buffered,
+    and whether it's liked now. `elsewhere` is set if the user toggled it
+    on another worker too, so it's written even if it looks unchanged."""
+
+    __slots__ = ('msg', 'was_liked', 'liked', 'liked_at', 'elsewhere')
+
+    def __init__(self, msg, was_liked):
+        self.msg = msg
+        self.was_liked = was_liked
+        self.liked = was_liked
+        self.liked_at = None
+        self.elsewhere = False
+
+
+class LikeBuffer:
+    """Buffered likes; see the module docstring.
+
+    The lock only guards the in-memory state and is never held while
+    talking to the database, as in trending.LikeCounters. flush_lock is:
+    it only keeps flushes from overlapping, and toggles never take it.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.flush_seconds = FLUSH_SECONDS
+        self.lock = Lock()
+        # One flush at a time, so each sees the last one's results
+        self.flush_lock = Lock()
+        # {(user id, message id): PendingLike}
+        self.pending = {}
+        # The entries being flushed, which still count until committed
+        self.flushing = {}
+        self.flushed_at = time.monotonic()
+        self.app = None
+
+        atexit.register(self.flush_at_exit)
+
+    def init_app(self, app):
+        """Turn write-behind on if the app's LIKE_WRITE_BEHIND says so."""
+
+        app.after_request(self.flush_after_request)
+
+        if self.app not in (None, app):
+            return  # configured by the first app; see create_app
+        self.app = app
+
+        self.enabled = app.config.get('LIKE_WRITE_BEHIND', False)
+        self.flush_seconds = app.config.get('LIKE_FLUSH_SECONDS', FLUSH_SECONDS)
+
+    def flush_at_exit(self):
+        if self.pending and self.app is not None:
+            with self.app.app_context():
+                self.flush()
+
+    def _entry(self, key):
+        return self.pending.get(key) or self.flushing.get(key)
+
+    def toggle(self, user_id, msg, seen=None):
+        """Buffer a like of `msg` by `user_id`, or an unlike if they already
+        like it. Returns True if it's now liked.
+
+        `seen` is whether the user's session says they like it, if they
+        toggled it lately, which wins over what this worker knows.
+        """
+
+        key = (user_id, msg.id)
+
+        with self.lock:
+            entry = self._entry(key)
+            was_liked = entry.liked if entry else None
+
+        if was_liked is None:
+            with shards.engine(shards.shard_for_write(msg.user_id)).connect() as conn:
+                was_liked = conn.execute(
+                    select(Like.user_id)
+                    .where(Like.user_id == user_id, Like.message_id == msg.id)
+                ).first() is not None
+
+        with self.lock:
+            entry = self.pending.get(key)
+
+            if entry is None:
+                flushing = self.flushing.get(key)
+                entry = self.pending[key] = PendingLike(
+                    LikedMessage(msg.id, msg.user_id, msg.timestamp),
+                    flushing.liked if flushing else was_liked)
+
+            if seen is not None and seen != entry.liked:
+                entry.liked = seen
+                entry.elsewhere = True
+
+            entry.liked = not entry.liked
+            entry.liked_at = datetime.utcnow()
+
+            return entry.liked
+
+    def apply(self, user_id, messages, liked_ids, seen=None):
+        """Apply `user_id`'s buffered likes of `messages`, then those
+        their session has `seen`, to `liked_ids` (which it changes) and to
+        the messages' like counts."""
+
+        with self.lock:
+            entries = [
+                (msg, self._entry((user_id, msg.id)))
+                for msg in messages
+            ]
+
+        for msg, entry in entries:
+            if entry is None:
+                continue
+
+            if entry.liked:
+                liked_ids.add(msg.id)
+            else:
+                liked_ids.discard(msg.id)
+
+            # Not a change to write: the flush updates the row.
+            set_committed_value(
+                msg, 'like_count',
+                msg.like_count + entry.liked - entry.was_liked)
+
+        for msg in messages:
+            liked = seen.get(msg.id) if seen else None
+
+            if liked is None or liked == (msg.id in liked_ids):
+                continue
+
+            # Toggled on another worker and not flushed yet
+            if liked:
+                liked_ids.add(msg.id)
+            else:
+                liked_ids.discard(msg.id)
+
+            set_committed_value(
+                msg, 'like_count', msg.like_count + (1 if liked else -1))
+
+        return liked_ids
+
+    def flush_after_request(self, response):
+        self.maybe_flush()
+        return response
+
+    def maybe_flush(self):
+        """Flush if flush_seconds have passed since the last flush."""
+
+        with self.lock:
+            if (not self.pending
+                    or time.monotonic() - self.flushed_at < self.flush_seconds):
+                return
+
+            self.flushed_at = time.monotonic()
+
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Flushing buffered likes failed")
+
+    def flush(self):
+        """Write the buffered likes; needs an app context.
+
+        A shard whose transaction fails keeps its entries buffered, under
+        any newer toggles of the same likes, and the first error is raised
+        once the other shards are written. Likes of messages whose bucket
+        is moving (ShardMoving) stay buffered until a flush after the move.
+        """
+
+        with self.flush_lock:
+            with self.lock:
+                self.flushing, self.pending = self.pending, {}
+                self.flushed_at = time.monotonic()
+
+            try:
+                self._flush_batch(self.flushing)
+            finally:
+                with self.lock:
+                    self.flushing = {}
+
+    def _flush_batch(self, batch):
+        by_shard = {}
+        held = {}
+        error = None
+
+        for key, entry in batch.items():
+            if entry.liked == entry.was_liked and not entry.elsewhere:
+                continue
+
+            try:
+                shard = shards.shard_for_write(entry.msg.user_id)
+            except ShardMoving:
+                held[key] = entry
+                continue
+            except Exception as exc:
+                # The bucket map couldn't be read: keep the whole batch.
+                self._restore(batch)
+                raise exc
+
+            by_shard.setdefault(shard, {})[key] = entry
+
+        self._restore(held)
+
+        for shard, entries in by_shard.items():
+            try:
+                self._flush_shard(shard, entries)
+            except Exception as exc:
+                self._restore(entries)
+                error = error or exc
+
+        if error:
+            raise error
+
+    def _restore(self, entries):
+        with self.lock:
+            for key, entry in entries.items():
+                newer = self.pending.get(key)
+
+                if newer is None:
+                    self.pending[key] = entry
+                else:
+                    newer.was_liked = entry.was_liked
+
+    def _flush_shard(self, shard, entries):
+        engine = shards.engine(shard)
+        likes = [(key, entry) for key, entry in entries.items() if entry.liked]
+        unlikes = [key for key, entry in entries.items() if not entry.liked]
+        deltas = Counter()
+
+        with engine.begin() as conn:
+            if likes:
+                # Messages deleted since being liked are skipped.
+                existing = set(conn.scalars(select(Message.id).where(
+                    Message.id.in_({message_id for (_, message_id), _ in likes}))))
+
+                rows = [
+                    dict(user_id=user_id, message_id=message_id,
+                         timestamp=entry.liked_at)
+                    for (user_id, message_id), entry in likes
+                    if message_id in existing
+                ]
+
+                if rows:
+                    dialect = (postgresql if engine.dialect.name == 'postgresql'
+                               else sqlite)
+                    added = conn.scalars(
+                        dialect.insert(Like)
+                        .on_conflict_do_nothing()
+                        .returning(Like.message_id),
+                        rows).all()
+                    deltas.update(added)
+                    flushed_likes.inc(len(added), change='like')
+
+            if unlikes:
+                removed = conn.scalars(
+                    delete(Like)
+                    .where(tuple_(Like.user_id, Like.message_id).in_(unlikes))
+                    .returning(Like.message_id)).all()
+                deltas.subtract(removed)
+                flushed_likes.inc(len(removed), change='unlike')
+
+            messages = {entry.msg.id: entry.msg for entry in entries.values()}
+            changed = [
+                dict(b_id=message_id, b_timestamp=messages[message_id].timestamp,
+                     b_delta=delta)
+                for message_id, delta in deltas.items() if delta
+            ]
+
+            if changed:
+                conn.execute(
+                    update(Message)
+                    .where(Message.id == bindparam('b_id'),
+                           Message.timestamp == bindparam('b_timestamp'))
+                    .values(like_count=Message.like_count + bindparam('b_delta')),
+                    changed)
+
+        flushes.inc()
+
+        for message_id, delta in deltas.items():
+            if delta:
+                trending.counters.record(messages[message_id], delta)
+
+    def reset(self):
+        """Forget everything buffered."""
+
+        with self.lock:
+            self.pending = {}
+            self.flushing = {}
+
+
+buffer = LikeBuffer()
+
+gauge('warbler_likes_buffered',
+      "Likes and unlikes waiting for a write-behind flush.",
+      collect=lambda: {(): len(buffer.pending)})
+
+
+def seen_likes(user_id):
+    """Return {message id: liked} for `user_id`'s recent toggles, as
+    remembered by their session, or {} outside a request."""
+
+    if not has_request_context():
+        return {}
+
+    remembered = session.get(SESSION_KEY)
+
+    if not remembered or remembered['user_id'] != user_id:
+        return {}
+
+    cutoff = time.time() - SESSION_SECONDS
+
+    return {
+        int(message_id): liked
+        for message_id, (liked, toggled_at) in remembered['likes'].items()
+        if toggled_at > cutoff
+    }
+
+
+def remember_like(user_id, message_id, liked):
+    """Remember a buffered toggle in `user_id`'s session, for the other
+    workers, dropping ones old enough to have been flushed."""
+
+    if not has_request_context():
+        return
+
+    remembered = session.get(SESSION_KEY)
+    cutoff = time.time() - SESSION_SECONDS
+
+    toggles = {
+        key: toggle
+        for key, toggle in (remembered['likes'].items()
+                            if remembered and remembered['user_id'] == user_id
+                            else ())
+        if toggle[1] > cutoff and key != str(message_id)
+    }
+    toggles[str(message_id)] = [liked, time.time()]
+
+    session[SESSION_KEY] = {
+        'user_id': user_id,
+        'likes': dict(list(toggles.items())[-SESSION_LIKES:]),
+    }
+
+
+def toggle_like(user_id, msg):
+    """Like `msg` for `user_id`, or unlike it; return True if now liked.
+
+    Commits straight away unless write-behind is on.
+    """
+
+    if buffer.enabled:
+        liked = buffer.toggle(user_id, msg, seen_likes(user_id).get(msg.id))
+        remember_like(user_id, msg.id, liked)
+        return liked
+
+    liked = shards.toggle_like(user_id, msg)
+    shards.commit()
+    trending.counters.record(msg, 1 if liked else -1)
+
+    return liked
+
+
+def liked_message_ids(user_id, messages):
+    """Return the ids of those `messages` that `user_id` likes, counting
+    their buffered likes."""
+
+    return buffer.apply(
+        user_id, messages, shards.liked_message_ids(user_id, messages),
+        seen_likes(user_id) if buffer.enabled else {})
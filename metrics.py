@@ -0,0 +1,128 @@
+"""In-process metrics, served in Prometheus text format at /metrics.
+
+Metrics are kept per worker process; label each scrape target by worker (or
+sum across them in Prometheus) when running several gunicorn workers.
+
+    reads = counter('warbler_db_reads_total', "Reads by database role.")
+    reads.inc(role='replica')
+
+A metric can also be computed when /metrics is scraped, by passing `collect`:
+a function returning {labels_tuple: value}, where labels_tuple is a tuple of
+(label, value) pairs.
+
+Some collectors query the database, so /metrics isn't public. With
+METRICS_TOKEN set, a scrape must send it as a bearer token (Prometheus's
+`authorization` setting); without it, only requests from this host are
+answered. Behind a proxy on the same host every request comes from this
+host, so set METRICS_TOKEN there.
+"""
+
+import hmac
+from threading import Lock
+
+REGISTRY = {}
+
+
+class Metric:
+    """A named counter or gauge, with one value per set of labels."""
+
+    def __init__(self, name, help, kind, collect=None):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.collect = collect
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, amount=1, **labels):
+        """Add `amount` to the value for `labels`."""
+
+        key = tuple(sorted(labels.items()))
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """Set the value for `labels` to `value`."""
+
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def get(self, **labels):
+        """Return the value for `labels` (0 if never set)."""
+
+        return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        """Return {labels_tuple: value} for every value of this metric."""
+
+        if self.collect:
+            return self.collect()
+
+        with self.lock:
+            return dict(self.values)
+
+
+def _register(name, help, kind, collect=None):
+    """Return the metric called `name`, creating it on first use."""
+
+    if name not in REGISTRY:
+        REGISTRY[name] = Metric(name, help, kind, collect)
+
+    return REGISTRY[name]
+
+
+def counter(name, help, collect=None):
+    """Return the counter called `name`."""
+
+    return _register(name, help, 'counter', collect)
+
+
+def gauge(name, help, collect=None):
+    """Return the gauge called `name`."""
+
+    return _register(name, help, 'gauge', collect)
+
+
+def format_labels(labels):
+    """Format a labels tuple as Prometheus {label="value",...} text."""
+
+    if not labels:
+        return ""
+
+    pairs = []
+
+    for label, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append(f'{label}="{value}"')
+
+    return "{" + ",".join(pairs) + "}"
+
+
+def render():
+    """Return every metric in Prometheus text exposition format."""
+
+    lines = []
+
+    for metric in REGISTRY.values():
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+
+        for labels, value in sorted(metric.samples().items()):
+            lines.append(f"{metric.name}{format_labels(labels)} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+LOCAL_ADDRESSES = {'127.0.0.1', '::1'}
+
+
+def scrape_allowed(token, authorization, remote_addr):
+    """May a request with this Authorization header, from `remote_addr`,
+    read the metrics? See the module docstring."""
+
+    if token:
+        return hmac.compare_digest(
+            (authorization or '').encode(), f"Bearer {token}".encode())
+
+    return remote_addr in LOCAL_ADDRESSES
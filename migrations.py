@@ -0,0 +1,561 @@
+"""Versioned schema migrations for Warbler.
+
+Apply every pending migration to the configured database:
+
+    python migrations.py
+
+Show which migrations have been applied:
+
+    python migrations.py status
+
+Migrations run in version order and each one is recorded in the
+`schema_migrations` table once it finishes. Index builds and drops use
+CREATE/DROP INDEX CONCURRENTLY on Postgres, so they can run against a
+live database without blocking writes to the table being indexed.
+"""
+
+import sys
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+from models import (
+    db, SchemaMigration, Suggestion, LikeCount, LikeTotal, MessageTag,
+    Mention, Job, RateLimitBucket,
+)
+from partitions import (
+    DEFAULT_PARTITION, MONTHS_AHEAD,
+    is_partitioned, list_partitions, ensure_partitions, next_month,
+)
+from shards import shards, shard_metadata
+
+# Arbitrary key for the advisory lock that keeps two deploys from running
+# migrations at the same time.
+MIGRATION_LOCK_KEY = 7_283_001
+
+# Rows per transaction when a migration fills in a new column
+BACKFILL_BATCH_SIZE = 10_000
+
+Migration = namedtuple('Migration', ['version', 'name', 'upgrade'])
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    """Register the decorated function as the upgrade step for `version`."""
+
+    def register(upgrade):
+        MIGRATIONS.append(Migration(version, name, upgrade))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return upgrade
+
+    return register
+
+
+##############################################################################
+# Helpers for writing migrations
+
+
+def is_postgres(engine):
+    """Is `engine` connected to Postgres?"""
+
+    return engine.dialect.name == 'postgresql'
+
+
+def create_index(engine, name, table, columns, include=None):
+    """Build index `name` on `table` without blocking writes.
+
+    `columns` is a list of SQL column expressions (eg "timestamp DESC").
+    `include` lists extra columns stored in the index so that lookups can be
+    answered from the index alone (Postgres only).
+
+    A CONCURRENTLY build that fails part-way leaves an INVALID index behind;
+    that index is dropped and rebuilt rather than skipped.
+
+    Postgres can't build an index on a partitioned table concurrently, so
+    for one the index is created on the parent alone, built concurrently on
+    each partition, and then attached partition by partition.
+    """
+
+    if not is_postgres(engine):
+        with engine.begin() as conn:
+            conn.execute(text(
+                f"CREATE INDEX IF NOT EXISTS {name} "
+                f"ON {table} ({', '.join(columns)})"))
+        return
+
+    definition = f"({', '.join(columns)})"
+    if include:
+        definition += f" INCLUDE ({', '.join(include)})"
+
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+
+        if table == 'messages' and is_partitioned(conn):
+            if index_is_valid(conn, name):
+                return
+
+            conn.execute(text(
+                f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} "
+                f"{definition}"))
+
+            partitions = [p for p, _, _ in list_partitions(conn)]
+            for partition in partitions + [DEFAULT_PARTITION]:
+                partition_index = f"{partition}_{name}"
+                _create_index_concurrently(
+                    conn, partition_index, partition, definition)
+                conn.execute(text(
+                    f"ALTER INDEX {name} ATTACH PARTITION {partition_index}"))
+            return
+
+        _create_index_concurrently(conn, name, table, definition)
+
+
+def index_is_valid(conn, name):
+    """Is index `name` usable? Returns None if there's no such index."""
+
+    return conn.execute(
+        text("""SELECT i.indisvalid
+                FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE c.relname = :name"""),
+        {"name": name},
+    ).scalar()
+
+
+def _create_index_concurrently(conn, name, table, definition):
+    """Build index `name`, replacing an INVALID one left by a failed build."""
+
+    if index_is_valid(conn, name) is False:
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+    conn.execute(text(
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} "
+        f"ON {table} {definition}"))
+
+
+def drop_index(engine, name):
+    """Drop index `name`, if it exists, without blocking writes."""
+
+    if not is_postgres(engine):
+        with engine.begin() as conn:
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        return
+
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+
+def add_column(engine, table, name, definition):
+    """Add column `name` to `table` unless it's already there.
+
+    `definition` is the SQL type and constraints (eg "INTEGER NOT NULL").
+    """
+
+    if name in {column['name'] for column in inspect(engine).get_columns(table)}:
+        return
+
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {definition}"))
+
+
+##############################################################################
+# Migrations
+
+
+@migration(1, "indexes for timeline, following, and liked-by lookups")
+def add_hot_path_indexes(engine):
+    """Index the access paths that the composite primary keys don't cover.
+
+    - messages (user_id, timestamp DESC): home timeline and profile pages
+    - follows (user_following_id): who a user follows (the follows primary
+      key only serves who follows a user)
+    - likes (message_id): who liked a message, and cascading message deletes
+
+    users.email and users.username are already indexed by their unique
+    constraints.
+    """
+
+    create_index(
+        engine,
+        'ix_messages_user_id_timestamp',
+        'messages',
+        ['user_id', 'timestamp DESC'])
+
+    create_index(
+        engine,
+        'ix_follows_user_following_id',
+        'follows',
+        ['user_following_id'],
+        include=['user_being_followed_id'])
+
+    create_index(
+        engine,
+        'ix_likes_message_id',
+        'likes',
+        ['message_id'],
+        include=['user_id'])
+
+
+@migration(2, "partition messages by month")
+def partition_messages(engine):
+    """Convert messages into a table range-partitioned by timestamp.
+
+    Rows are copied into monthly partitions covering the existing messages
+    and the next few months. The table is locked for the copy, so this is
+    a one-time step best run in a quiet period; afterwards partitions are
+    added with partitions.py without locking out writes.
+
+    Postgres can only enforce a foreign key into a partitioned table on
+    columns that include the partition key, so the likes -> messages
+    foreign key is replaced with triggers that do the same work: likes must
+    name an existing message, and deleting a message deletes its likes.
+    """
+
+    if not is_postgres(engine):
+        return
+
+    with engine.begin() as conn:
+        if is_partitioned(conn):
+            return
+
+        conn.execute(text("LOCK TABLE messages IN ACCESS EXCLUSIVE MODE"))
+
+        now = datetime.utcnow()
+        oldest, newest = conn.execute(text(
+            "SELECT min(timestamp), max(timestamp) FROM messages")).one()
+
+        end = max(newest or now, now)
+        for _ in range(MONTHS_AHEAD):
+            end = next_month(end)
+
+        foreign_keys = conn.execute(text(
+            """SELECT conname FROM pg_constraint
+               WHERE conrelid = 'likes'::regclass
+               AND confrelid = 'messages'::regclass""")).scalars().all()
+
+        for foreign_key in foreign_keys:
+            conn.execute(text(
+                f"ALTER TABLE likes DROP CONSTRAINT {foreign_key}"))
+
+        conn.execute(text("""
+            ALTER TABLE messages RENAME TO messages_unpartitioned;
+            ALTER TABLE messages_unpartitioned
+                RENAME CONSTRAINT messages_pkey
+                TO messages_unpartitioned_pkey;
+            DROP INDEX IF EXISTS ix_messages_user_id_timestamp;
+
+            CREATE TABLE messages (
+                id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+                text VARCHAR(140) NOT NULL,
+                timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                user_id INTEGER NOT NULL
+                    REFERENCES users (id) ON DELETE CASCADE,
+                PRIMARY KEY (id, timestamp)
+            ) PARTITION BY RANGE (timestamp);
+
+            CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+        """))
+
+        ensure_partitions(conn, oldest or now, end)
+
+        conn.execute(text("""
+            INSERT INTO messages (id, text, timestamp, user_id)
+            SELECT id, text, timestamp, user_id FROM messages_unpartitioned;
+
+            ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+            DROP TABLE messages_unpartitioned;
+
+            CREATE INDEX ix_messages_user_id_timestamp
+                ON messages (user_id, timestamp DESC);
+
+            CREATE OR REPLACE FUNCTION likes_delete_for_message()
+            RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                -- A row moving between partitions is deleted and
+                -- re-inserted; its likes must survive that.
+                IF NOT EXISTS (SELECT 1 FROM messages WHERE id = OLD.id) THEN
+                    DELETE FROM likes WHERE message_id = OLD.id;
+                END IF;
+                RETURN OLD;
+            END $$;
+
+            CREATE TRIGGER messages_delete_likes
+                AFTER DELETE ON messages
+                FOR EACH ROW EXECUTE FUNCTION likes_delete_for_message();
+
+            CREATE OR REPLACE FUNCTION likes_check_message()
+            RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                PERFORM 1 FROM messages
+                    WHERE id = NEW.message_id FOR KEY SHARE;
+                IF NOT FOUND THEN
+                    RAISE foreign_key_violation USING MESSAGE =
+                        format('message %s does not exist', NEW.message_id);
+                END IF;
+                RETURN NEW;
+            END $$;
+
+            CREATE TRIGGER likes_check_message
+                BEFORE INSERT OR UPDATE OF message_id ON likes
+                FOR EACH ROW EXECUTE FUNCTION likes_check_message();
+        """))
+
+
+@migration(3, "who to follow suggestions")
+def add_user_suggestions(engine):
+    """Create the user_suggestions table that recommendations.py fills."""
+
+    Suggestion.__table__.create(engine, checkfirst=True)
+
+
+@migration(4, "like timestamps and hourly like counts")
+def add_like_counts(engine):
+    """Timestamp likes, and create the like_counts table trending.py fills.
+
+    Likes made before this migration are stamped with the time it ran. The
+    default is evaluated once, so Postgres adds the column without
+    rewriting the table. Extra shards get the column too.
+    """
+
+    for shard_engine in [engine] + shards.engines:
+        if is_postgres(shard_engine):
+            add_column(
+                shard_engine, 'likes', 'timestamp',
+                "TIMESTAMP WITHOUT TIME ZONE NOT NULL "
+                "DEFAULT timezone('utc', now())")
+
+    LikeCount.__table__.create(engine, checkfirst=True)
+
+
+@migration(5, "denormalized message like counts")
+def add_message_like_counts(engine):
+    """Add messages.like_count, count existing likes into it, and index
+    likes for paging through who liked a message.
+
+    The count is filled in BACKFILL_BATCH_SIZE messages at a time, so each
+    transaction only holds a few row locks.
+
+    The new likes index leads with message_id too, so it also serves the
+    lookups and cascading deletes migration 1's ix_likes_message_id did;
+    that one is dropped once it's built.
+    """
+
+    for shard_engine in [engine] + shards.engines:
+        if is_postgres(shard_engine):
+            add_column(
+                shard_engine, 'messages', 'like_count',
+                "INTEGER NOT NULL DEFAULT 0")
+
+            with shard_engine.connect() as conn:
+                last_id = conn.scalar(text("SELECT max(id) FROM messages")) or 0
+
+            for start in range(0, last_id + 1, BACKFILL_BATCH_SIZE):
+                with shard_engine.begin() as conn:
+                    conn.execute(
+                        text("""
+                            UPDATE messages m SET like_count = counts.n
+                            FROM (SELECT message_id, count(*) AS n
+                                  FROM likes
+                                  WHERE message_id >= :start
+                                  AND message_id < :end
+                                  GROUP BY message_id) counts
+                            WHERE m.id = counts.message_id
+                        """),
+                        {"start": start, "end": start + BACKFILL_BATCH_SIZE})
+
+        create_index(
+            shard_engine,
+            'ix_likes_message_id_timestamp',
+            'likes',
+            ['message_id', 'timestamp DESC', 'user_id DESC'])
+        drop_index(shard_engine, 'ix_likes_message_id')
+
+
+@migration(6, "indexes for paging follows and likes")
+def add_paging_indexes(engine):
+    """Index the orders the followers, following and likes pages use.
+
+    - follows (user_following_id, user_being_followed_id): who a user
+      follows, in id order (followers come in id order from the primary key)
+    - likes (user_id, timestamp DESC, message_id DESC): what a user liked,
+      most recent first, on every shard
+
+    The new follows index answers everything migration 1's
+    ix_follows_user_following_id (user_following_id INCLUDE
+    user_being_followed_id) did, so that one is dropped once it's built.
+    """
+
+    create_index(
+        engine,
+        'ix_follows_user_following_id_followed_id',
+        'follows',
+        ['user_following_id', 'user_being_followed_id'])
+    drop_index(engine, 'ix_follows_user_following_id')
+
+    for shard_engine in [engine] + shards.engines:
+        create_index(
+            shard_engine,
+            'ix_likes_user_id_timestamp',
+            'likes',
+            ['user_id', 'timestamp DESC', 'message_id DESC'])
+
+
+@migration(7, "hashtag and mention tables")
+def add_tags_and_mentions(engine):
+    """Create the message_tags and mentions tables on every shard.
+
+    Existing messages are indexed afterwards by `python hashtags.py
+    backfill`, which can run while the site is up.
+    """
+
+    MessageTag.__table__.create(engine, checkfirst=True)
+    Mention.__table__.create(engine, checkfirst=True)
+
+    metadata = shard_metadata()
+
+    for shard_engine in shards.engines:
+        metadata.tables['message_tags'].create(shard_engine, checkfirst=True)
+        metadata.tables['mentions'].create(shard_engine, checkfirst=True)
+
+
+@migration(8, "background jobs")
+def add_jobs(engine):
+    """Create the jobs table that jobs.py runs."""
+
+    Job.__table__.create(engine, checkfirst=True)
+
+
+@migration(9, "rate limit buckets")
+def add_rate_limit_buckets(engine):
+    """Create the table behind admission.py's shared backend."""
+
+    RateLimitBucket.__table__.create(engine, checkfirst=True)
+
+
+@migration(10, "user image digests")
+def add_image_digests(engine):
+    """Record where images.py stored each user's resized images."""
+
+    add_column(engine, 'users', 'image_digest', 'VARCHAR(32)')
+    add_column(engine, 'users', 'header_image_digest', 'VARCHAR(32)')
+
+
+@migration(11, "pending account deletions")
+def add_pending_deletion(engine):
+    """Flag users whose delete_user job hasn't run yet."""
+
+    add_column(
+        engine, 'users', 'pending_deletion', 'BOOLEAN NOT NULL DEFAULT false')
+
+
+@migration(12, "running trending totals")
+def add_like_totals(engine):
+    """Create like_totals and sum the like_counts buckets into it.
+
+    like_counts is locked against writes while it's summed, so no flush
+    lands between the sum and the totals. Totals a flush already wrote are
+    replaced by the sum, which includes them.
+    """
+
+    LikeTotal.__table__.create(engine, checkfirst=True)
+
+    if not is_postgres(engine):
+        return
+
+    with engine.begin() as conn:
+        conn.execute(text("LOCK TABLE like_counts IN SHARE MODE"))
+        conn.execute(text("""
+            INSERT INTO like_totals (message_id, user_id, likes)
+            SELECT message_id, max(user_id), sum(count)
+            FROM like_counts
+            GROUP BY message_id
+            ON CONFLICT (message_id) DO UPDATE SET likes = excluded.likes
+        """))
+
+
+##############################################################################
+# Running migrations
+
+
+def applied_versions(engine):
+    """Return the set of migration versions already applied to `engine`."""
+
+    SchemaMigration.__table__.create(engine, checkfirst=True)
+
+    with engine.connect() as conn:
+        return set(conn.execute(
+            db.select(SchemaMigration.version)).scalars())
+
+
+def pending_migrations(engine):
+    """Return the migrations not yet applied to `engine`, in version order."""
+
+    applied = applied_versions(engine)
+    return [m for m in MIGRATIONS if m.version not in applied]
+
+
+def run_migrations(engine=None):
+    """Apply every pending migration, returning the ones that were applied.
+
+    On Postgres, an advisory lock is held for the duration so concurrent
+    callers wait their turn instead of racing each other.
+    """
+
+    engine = engine or db.engine
+
+    with engine.connect() as lock_conn:
+        lock_conn = lock_conn.execution_options(isolation_level="AUTOCOMMIT")
+
+        if is_postgres(engine):
+            lock_conn.execute(
+                text("SELECT pg_advisory_lock(:key)"),
+                {"key": MIGRATION_LOCK_KEY})
+
+        try:
+            applied = []
+
+            for m in pending_migrations(engine):
+                m.upgrade(engine)
+
+                with engine.begin() as conn:
+                    conn.execute(db.insert(SchemaMigration).values(
+                        version=m.version, name=m.name))
+
+                applied.append(m)
+
+            return applied
+
+        finally:
+            if is_postgres(engine):
+                lock_conn.execute(
+                    text("SELECT pg_advisory_unlock(:key)"),
+                    {"key": MIGRATION_LOCK_KEY})
+
+
+def print_status(engine=None):
+    """Print each known migration and whether it has been applied."""
+
+    engine = engine or db.engine
+    applied = applied_versions(engine)
+
+    for m in MIGRATIONS:
+        mark = "x" if m.version in applied else " "
+        print(f"[{mark}] {m.version:04d} {m.name}")
+
+
+if __name__ == "__main__":
+    from app import app
+    from pooling import direct_engine
+
+    # The migration lock outlives single transactions, so bypass PgBouncer.
+    engine = direct_engine(app.config)
+
+    if sys.argv[1:] == ["status"]:
+        print_status(engine)
+
+    else:
+        for m in run_migrations(engine):
+            print(f"Applied {m.version:04d} {m.name}")
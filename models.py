@@ -1,12 +1,14 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 
+from replicas import RoutingSession
+
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 DEFAULT_IMAGE_URL = (
     "https://icon-library.com/images/default-user-icon/" +
@@ -17,6 +19,11 @@ DEFAULT_HEADER_IMAGE_URL = (
     "rb-4.0.3&ixid=MnwxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8&auto=for" +
     "mat&fit=crop&w=2070&q=80")
 
+# Timelines first look only this far back, so that Postgres can skip the
+# older monthly partitions of messages; older messages are read only when
+# too few recent ones are found.
+TIMELINE_WINDOW = timedelta(days=7)
+
 
 class Follow(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -35,6 +42,17 @@ class Follow(db.Model):
         primary_key=True,
     )
 
+    # The composite primary key serves "who follows X" lookups; this index
+    # serves the reverse direction ("who does X follow"), in id order for
+    # paging through it, without a heap visit.
+    __table_args__ = (
+        db.Index(
+            'ix_follows_user_following_id_followed_id',
+            user_following_id,
+            user_being_followed_id,
+        ),
+    )
+
 
 class User(db.Model):
     """User in the system."""
@@ -70,6 +88,16 @@ class User(db.Model):
         default=DEFAULT_HEADER_IMAGE_URL,
     )
 
+    # Where images.py stored the resized copies of image_url and
+    # header_image_url; None until they're ingested.
+    image_digest = db.Column(
+        db.String(32),
+    )
+
+    header_image_digest = db.Column(
+        db.String(32),
+    )
+
     bio = db.Column(
         db.Text,
         nullable=False,
@@ -87,6 +115,16 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Set when the user deletes their account, until the delete_user job
+    # removes them: they can't log in, and they and their messages are
+    # hidden.
+    pending_deletion = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default='false',
+    )
+
     messages = db.relationship('Message', backref="user")
 
     followers = db.relationship(
@@ -134,7 +172,8 @@ class User(db.Model):
         False.
         """
 
-        user = cls.query.filter_by(username=username).one_or_none()
+        user = cls.query.filter_by(
+            username=username, pending_deletion=False).one_or_none()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -146,16 +185,67 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return self.id in other_user.following_ids([self.id])
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.following_ids([other_user.id])
+
+    def following_ids(self, user_ids):
+        """Return the set of `user_ids` this user follows, in one query."""
+
+        if not user_ids:
+            return set()
+
+        return set(db.session.scalars(
+            db.select(Follow.user_being_followed_id)
+            .where(Follow.user_following_id == self.id)
+            .where(Follow.user_being_followed_id.in_(user_ids))))
+
+    def count_followers(self):
+        """How many users follow this one?"""
+
+        return db.session.scalar(
+            db.select(db.func.count())
+            .where(Follow.user_being_followed_id == self.id))
+
+    def count_following(self):
+        """How many users does this one follow?"""
+
+        return db.session.scalar(
+            db.select(db.func.count())
+            .where(Follow.user_following_id == self.id))
+
+    def followers_page(self, limit, after=None):
+        """Return up to `limit` of this user's followers in id order,
+        starting after user id `after`."""
+
+        return self._follows_page(
+            Follow.user_following_id, Follow.user_being_followed_id,
+            limit, after)
+
+    def following_page(self, limit, after=None):
+        """Return up to `limit` of the users this one follows in id order,
+        starting after user id `after`."""
+
+        return self._follows_page(
+            Follow.user_being_followed_id, Follow.user_following_id,
+            limit, after)
+
+    def _follows_page(self, other_column, own_column, limit, after):
+        query = (
+            db.select(User)
+            .join(Follow, other_column == User.id)
+            .where(own_column == self.id)
+            .where(User.pending_deletion.is_(False))
+            .order_by(other_column)
+            .limit(limit))
+
+        if after is not None:
+            query = query.where(other_column > after)
+
+        return db.session.scalars(query).all()
 
 
 class Message(db.Model):
@@ -185,6 +275,50 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Kept in step with the likes table by ShardRouter.toggle_like, so pages
+    # can show it without counting likes.
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', user_id, timestamp.desc()),
+    )
+
+    @classmethod
+    def recent_by_users(cls, user_ids, limit=100, session=None):
+        """Return the `limit` newest messages written by any of `user_ids`.
+
+        The last TIMELINE_WINDOW is read first; when it holds `limit`
+        messages they are the newest overall, so most timelines are answered
+        from the latest partitions alone. Otherwise one more query reads
+        only the rest, from before the window, so a quiet account costs two
+        queries and the second stops at the messages still wanted.
+
+        `session` picks the database to read (see shards.py); it defaults
+        to the primary.
+        """
+
+        session = session or db.session
+        cutoff = datetime.utcnow() - TIMELINE_WINDOW
+
+        query = (db.select(cls)
+                 .where(cls.user_id.in_(user_ids))
+                 .order_by(cls.timestamp.desc()))
+
+        messages = session.scalars(
+            query.where(cls.timestamp >= cutoff).limit(limit)).all()
+
+        if len(messages) < limit:
+            messages += session.scalars(
+                query.where(cls.timestamp < cutoff)
+                .limit(limit - len(messages))).all()
+
+        return messages
+
     def is_liked_already(self, user):
         """Is this messaged liked by user? Returns True/False"""
 
@@ -214,7 +348,351 @@ class Like(db.Model):
         primary_key=True,
     )
 
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        # Who liked a message, newest first, a page at a time; also serves
+        # cascading message deletes
+        db.Index(
+            'ix_likes_message_id_timestamp',
+            message_id,
+            timestamp.desc(),
+            user_id.desc(),
+        ),
+        # What a user liked, newest first, a page at a time
+        db.Index(
+            'ix_likes_user_id_timestamp',
+            user_id,
+            timestamp.desc(),
+            message_id.desc(),
+        ),
+    )
+
+
+class MessageTag(db.Model):
+    """A hashtag in a message; see hashtags.py.
+
+    Stored with the message, on its author's shard.
+    """
+
+    __tablename__ = 'message_tags'
+
+    tag = db.Column(
+        db.String(50),
+        primary_key=True,
+    )
+
+    # No foreign key: messages is partitioned (see migrations.py).
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    # The message's timestamp, so a tag's timeline is read in order from
+    # the index
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_message_tags_tag_timestamp',
+            tag,
+            timestamp.desc(),
+            message_id.desc(),
+        ),
+        db.Index('ix_message_tags_message_id', message_id),
+    )
+
+
+class Mention(db.Model):
+    """An @mention of a user in a message; see hashtags.py.
+
+    Stored with the message, on its author's shard.
+    """
+
+    __tablename__ = 'mentions'
+
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_mentions_user_id_timestamp',
+            user_id,
+            timestamp.desc(),
+            message_id.desc(),
+        ),
+        db.Index('ix_mentions_message_id', message_id),
+    )
+
+
+class ShardBucket(db.Model):
+    """A bucket of users whose messages live on a shard other than shard 0.
+
+    See shards.py.
+    """
+
+    __tablename__ = 'shard_buckets'
+
+    bucket = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    shard = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    moving = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+
+class Suggestion(db.Model):
+    """An account suggested for a user to follow; see recommendations.py."""
+
+    __tablename__ = 'user_suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    suggested_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    # How many of the accounts user_id follows also follow this one
+    mutual = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class LikeCount(db.Model):
+    """Net likes a message got in one hour; see trending.py."""
+
+    __tablename__ = 'like_counts'
+
+    # Hours since the Unix epoch, UTC
+    hour = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    # No foreign key: messages may live on another shard.
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    # The message's author, which says which shard holds the message
+    user_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class LikeTotal(db.Model):
+    """Net likes a message got in trending.py's window: the sum of its
+    like_counts rows, kept up to date as they're written and pruned."""
+
+    __tablename__ = 'like_totals'
+
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
 
+    user_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    likes = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # The top of the trending list is the first few entries
+    __table_args__ = (
+        db.Index('ix_like_totals_likes', likes.desc(), message_id.desc()),
+    )
+
+
+class Job(db.Model):
+    """A background job; see jobs.py."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.String(50),
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+        default=dict,
+    )
+
+    # Enqueueing a job with a key that's already used does nothing
+    idempotency_key = db.Column(
+        db.String(200),
+        unique=True,
+    )
+
+    # queued, running, done or failed
+    status = db.Column(
+        db.String(10),
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5,
+    )
+
+    # When the job is next due to run
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    enqueued_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    started_at = db.Column(
+        db.DateTime,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', status, run_at),
+    )
+
+
+class RateLimitBucket(db.Model):
+    """A write rate limit's token bucket, for the shared backend of
+    admission.py.
+
+    Unlogged: losing the buckets in a crash only forgives some writes.
+    """
+
+    __tablename__ = 'rate_limit_buckets'
+
+    # "<route class>:<user id>"
+    key = db.Column(
+        db.String(100),
+        primary_key=True,
+    )
+
+    tokens = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    # Unix time the tokens were last counted
+    updated_at = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        {'prefixes': ['UNLOGGED']},
+    )
+
+
+class SchemaMigration(db.Model):
+    """A migration from migrations.py that has been applied to this database."""
+
+    __tablename__ = 'schema_migrations'
+
+    version = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    name = db.Column(
+        db.String(100),
+        nullable=False,
+    )
+
+    applied_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
 
 
 def connect_db(app):
@@ -223,6 +701,4 @@ def connect_db(app):
     You should call this in your Flask app.
     """
 
-    app.app_context().push()
-    db.app = app
     db.init_app(app)
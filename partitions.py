@@ -0,0 +1,220 @@
+"""Monthly range partitions for the messages table.
+
+Once migration 0002 has converted `messages` into a table partitioned by
+`timestamp`, each calendar month lives in its own partition
+(messages_p2024_05, ...), plus a default partition that catches anything
+outside the known months.
+
+Create partitions for the next few months (run this daily from cron):
+
+    python partitions.py create-ahead
+
+Detach partitions older than a cutoff, so they can be archived with
+pg_dump and dropped:
+
+    python partitions.py detach-before 2022-01-01
+
+A detached partition becomes an ordinary table that the app no longer
+reads; attaching it again brings its messages back.
+"""
+
+import re
+import sys
+from datetime import datetime
+
+from sqlalchemy import text
+
+from models import db
+
+PARENT_TABLE = 'messages'
+DEFAULT_PARTITION = 'messages_default'
+MONTHS_AHEAD = 3
+
+BOUND_RE = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+def month_start(moment):
+    """Return midnight on the first day of the month containing `moment`."""
+
+    return datetime(moment.year, moment.month, 1)
+
+
+def next_month(moment):
+    """Return midnight on the first day of the month after `moment`."""
+
+    if moment.month == 12:
+        return datetime(moment.year + 1, 1, 1)
+
+    return datetime(moment.year, moment.month + 1, 1)
+
+
+def partition_name(start):
+    """Name of the partition holding the month beginning at `start`."""
+
+    return f"{PARENT_TABLE}_p{start.year:04d}_{start.month:02d}"
+
+
+def is_partitioned(conn):
+    """Has the messages table been converted to a partitioned table?"""
+
+    if conn.dialect.name != 'postgresql':
+        return False
+
+    return bool(conn.execute(text(
+        """SELECT 1
+           FROM pg_partitioned_table pt
+           JOIN pg_class c ON c.oid = pt.partrelid
+           WHERE c.relname = :table"""),
+        {"table": PARENT_TABLE},
+    ).scalar())
+
+
+def list_partitions(conn):
+    """Return [(name, start, end), ...] for the monthly partitions.
+
+    The default partition is not included. Results are ordered by start.
+    """
+
+    rows = conn.execute(text(
+        """SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+           FROM pg_inherits i
+           JOIN pg_class c ON c.oid = i.inhrelid
+           JOIN pg_class p ON p.oid = i.inhparent
+           WHERE p.relname = :table"""),
+        {"table": PARENT_TABLE},
+    )
+
+    partitions = []
+
+    for name, bound in rows:
+        match = BOUND_RE.search(bound)
+        if match:
+            start, end = (datetime.fromisoformat(b) for b in match.groups())
+            partitions.append((name, start, end))
+
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def create_partition(conn, start):
+    """Create the partition for the month beginning at `start`.
+
+    Postgres refuses to create a partition while the default partition
+    holds rows in its range, so any such rows are moved into the new
+    partition. Rows are moved with the default partition detached, which
+    keeps the likes-cleanup trigger on messages from firing for them.
+    """
+
+    end = next_month(start)
+    name = partition_name(start)
+    bounds = {"start": start, "end": end}
+
+    has_strays = conn.execute(text(
+        f"""SELECT EXISTS (
+               SELECT 1 FROM {DEFAULT_PARTITION}
+               WHERE timestamp >= :start AND timestamp < :end)"""),
+        bounds,
+    ).scalar()
+
+    if has_strays:
+        conn.execute(text(
+            f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {DEFAULT_PARTITION}"))
+
+    conn.execute(text(
+        f"""CREATE TABLE {name} PARTITION OF {PARENT_TABLE}
+            FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"""))
+
+    if has_strays:
+        conn.execute(text(
+            f"""WITH moved AS (
+                   DELETE FROM {DEFAULT_PARTITION}
+                   WHERE timestamp >= :start AND timestamp < :end
+                   RETURNING *)
+                INSERT INTO {PARENT_TABLE} SELECT * FROM moved"""),
+            bounds)
+        conn.execute(text(
+            f"""ALTER TABLE {PARENT_TABLE}
+                ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"""))
+
+    return name
+
+
+def ensure_partitions(conn, start, end):
+    """Make sure a partition exists for every month from `start` to `end`.
+
+    Returns the names of the partitions that were created.
+    """
+
+    existing = {name for name, _, _ in list_partitions(conn)}
+    created = []
+
+    month = month_start(start)
+
+    while month <= end:
+        if partition_name(month) not in existing:
+            created.append(create_partition(conn, month))
+        month = next_month(month)
+
+    return created
+
+
+def create_partitions_ahead(engine=None, now=None, months_ahead=MONTHS_AHEAD):
+    """Create partitions for this month and the next `months_ahead` months."""
+
+    engine = engine or db.engine
+    now = now or datetime.utcnow()
+
+    end = now
+    for _ in range(months_ahead):
+        end = next_month(end)
+
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            return []
+
+        return ensure_partitions(conn, now, end)
+
+
+def detach_partitions_before(engine=None, cutoff=None):
+    """Detach every monthly partition that ends on or before `cutoff`.
+
+    Returns the names of the detached partitions, which are left in place
+    as ordinary tables for archiving. Likes on their messages are kept, so
+    re-attaching a partition restores it completely.
+    """
+
+    engine = engine or db.engine
+    detached = []
+
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            return []
+
+        for name, _, end in list_partitions(conn):
+            if end <= cutoff:
+                conn.execute(text(
+                    f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {name}"))
+                # Archived rows never need new ids, and keeping the default
+                # would tie the archive to the messages id sequence.
+                conn.execute(text(
+                    f"ALTER TABLE {name} ALTER COLUMN id DROP DEFAULT"))
+                detached.append(name)
+
+    return detached
+
+
+if __name__ == "__main__":
+    from app import app  # noqa: F401 (connects the database)
+
+    command = sys.argv[1:2]
+
+    if command == ["create-ahead"]:
+        for name in create_partitions_ahead():
+            print(f"Created {name}")
+
+    elif command == ["detach-before"] and len(sys.argv) == 3:
+        cutoff = datetime.fromisoformat(sys.argv[2])
+        for name in detach_partitions_before(cutoff=cutoff):
+            print(f"Detached {name}")
+
+    else:
+        print(__doc__)
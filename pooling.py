@@ -0,0 +1,200 @@
+"""Database connection pool settings and pool metrics.
+
+Every engine (primary, replicas and shards) is built with the same pool
+settings, taken from the app's config:
+
+    DB_POOL_SIZE        connections kept open per worker (default 5)
+    DB_MAX_OVERFLOW     extra connections allowed under load (default 10)
+    DB_POOL_TIMEOUT     seconds to wait for a free connection (default 30)
+    DB_POOL_PRE_PING    test connections before use (default on)
+    DB_POOL_RECYCLE     seconds before a connection is replaced (default 1800)
+
+Each gunicorn worker has its own pool, so the database sees up to
+workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections per engine.
+
+Set DB_PGBOUNCER when DATABASE_URL points at PgBouncer in transaction
+pooling mode. Consecutive transactions may then run on different server
+connections, so nothing may rely on per-connection state:
+
+- psycopg2 never creates server-side prepared statements, so queries need
+  no changes; the async driver's statement caches are turned off.
+- Work that holds session state across transactions (the migration lock,
+  LISTEN) connects with DATABASE_DIRECT_URL, bypassing PgBouncer.
+- The app keeps only a small pool of its own (DB_POOL_SIZE connections,
+  no overflow), since PgBouncer does the real pooling.
+
+Pool usage is exported at /metrics: connections checked out, threads
+waiting for one, and the total time spent waiting.
+"""
+
+import time
+from threading import Lock
+from uuid import uuid4
+from weakref import WeakSet
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from metrics import counter, gauge
+
+POOLS = WeakSet()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats_lock = Lock()
+        self.waiting = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        POOLS.add(self)
+
+    @property
+    def name(self):
+        """The engine's pool_logging_name, used as the metrics label."""
+
+        return self._orig_logging_name or "default"
+
+    def connect(self):
+        start = time.perf_counter()
+
+        with self.stats_lock:
+            self.waiting += 1
+
+        try:
+            return super().connect()
+
+        except PoolTimeoutError:
+            with self.stats_lock:
+                self.timeouts += 1
+            raise
+
+        finally:
+            with self.stats_lock:
+                self.waiting -= 1
+                self.checkouts += 1
+                self.wait_seconds += time.perf_counter() - start
+
+
+class InstrumentedAsyncQueuePool(InstrumentedQueuePool, AsyncAdaptedQueuePool):
+    """InstrumentedQueuePool for engines on an async driver."""
+
+
+def _pool_samples(read):
+    """Return a metrics collector that calls `read(pool)` for every pool.
+
+    Pools with the same name (say, of an app built twice in one process)
+    are added together rather than hiding each other.
+    """
+
+    def collect():
+        samples = {}
+
+        for pool in list(POOLS):
+            labels = (("pool", pool.name),)
+            samples[labels] = samples.get(labels, 0) + read(pool)
+
+        return samples
+
+    return collect
+
+
+gauge('warbler_db_pool_size',
+      "Connections the pool keeps open.",
+      collect=_pool_samples(lambda pool: pool.size()))
+
+gauge('warbler_db_pool_checked_out',
+      "Connections currently in use.",
+      collect=_pool_samples(lambda pool: pool.checkedout()))
+
+gauge('warbler_db_pool_overflow',
+      "Connections open beyond the pool size (negative: not yet opened).",
+      collect=_pool_samples(lambda pool: pool.overflow()))
+
+gauge('warbler_db_pool_waiting',
+      "Threads waiting to check out a connection.",
+      collect=_pool_samples(lambda pool: pool.waiting))
+
+counter('warbler_db_pool_checkouts_total',
+        "Connection checkouts.",
+        collect=_pool_samples(lambda pool: pool.checkouts))
+
+counter('warbler_db_pool_wait_seconds_total',
+        "Seconds spent checking out connections, including connecting.",
+        collect=_pool_samples(lambda pool: round(pool.wait_seconds, 6)))
+
+counter('warbler_db_pool_timeouts_total',
+        "Checkouts that gave up after DB_POOL_TIMEOUT seconds.",
+        collect=_pool_samples(lambda pool: pool.timeouts))
+
+
+def env_flag(value):
+    """Interpret an environment variable's text as on or off."""
+
+    return str(value).lower() in ("1", "true", "yes", "on")
+
+
+def pool_config_from_env(environ):
+    """Return the pool settings found in `environ`, for app.config."""
+
+    return {
+        'DB_POOL_SIZE': int(environ.get('DB_POOL_SIZE', 5)),
+        'DB_MAX_OVERFLOW': int(environ.get('DB_MAX_OVERFLOW', 10)),
+        'DB_POOL_TIMEOUT': float(environ.get('DB_POOL_TIMEOUT', 30)),
+        'DB_POOL_PRE_PING': env_flag(environ.get('DB_POOL_PRE_PING', True)),
+        'DB_POOL_RECYCLE': int(environ.get('DB_POOL_RECYCLE', 1800)),
+        'DB_PGBOUNCER': env_flag(environ.get('DB_PGBOUNCER', False)),
+        'DATABASE_DIRECT_URL': environ.get('DATABASE_DIRECT_URL'),
+    }
+
+
+def engine_options(config, name="primary"):
+    """Return create_engine() keyword arguments for an engine called `name`."""
+
+    return dict(
+        poolclass=InstrumentedQueuePool,
+        pool_size=config.get('DB_POOL_SIZE', 5),
+        max_overflow=(
+            0 if config.get('DB_PGBOUNCER')
+            else config.get('DB_MAX_OVERFLOW', 10)),
+        pool_timeout=config.get('DB_POOL_TIMEOUT', 30),
+        pool_pre_ping=config.get('DB_POOL_PRE_PING', True),
+        pool_recycle=config.get('DB_POOL_RECYCLE', 1800),
+        pool_logging_name=name,
+    )
+
+
+def async_engine_options(config, name):
+    """Return create_async_engine() keyword arguments for an engine."""
+
+    options = dict(engine_options(config, name),
+                   poolclass=InstrumentedAsyncQueuePool)
+
+    if config.get('DB_PGBOUNCER'):
+        # Prepared statements belong to one server connection, so give each
+        # a unique name and never reuse them.
+        options['connect_args'] = {
+            'statement_cache_size': 0,
+            'prepared_statement_cache_size': 0,
+            'prepared_statement_name_func': lambda: f"__warbler_{uuid4()}__",
+        }
+
+    return options
+
+
+def direct_engine(config):
+    """Return an engine that bypasses PgBouncer, for session-level features.
+
+    Uses DATABASE_DIRECT_URL if it's set, otherwise the main database URL.
+    """
+
+    url = (config.get('DATABASE_DIRECT_URL')
+           or config['SQLALCHEMY_DATABASE_URI'])
+
+    return create_engine(url, poolclass=InstrumentedQueuePool,
+                         pool_size=1, max_overflow=1,
+                         pool_logging_name="direct")
@@ -0,0 +1,335 @@
+"""Sampling profiler for live requests, and capture of slow ones.
+
+The debug toolbar's profiler traces every call, which is far too slow to
+leave on in production. This one samples instead: a thread wakes every
+PROFILE_INTERVAL_SECONDS and records the stack of each request it's
+watching, so a request's cost is a few dictionary updates per sample
+rather than per call.
+
+It watches two kinds of request:
+
+- a PROFILE_SAMPLE_RATE fraction of requests (0 to 1), picked at random,
+  for a picture of where time goes in normal traffic
+- with SLOW_REQUEST_SECONDS set, every request, keeping the profile only
+  of those that took at least that long
+
+Profiles are written to PROFILE_DIR in the collapsed stack format that
+flamegraph.pl and speedscope read, one "frame;frame;frame count" line per
+distinct stack, with the request's endpoint as the root frame:
+
+    sampled/    the most recent PROFILE_KEEP sampled requests
+    slow/       the slowest PROFILE_KEEP slow requests of the last
+                SLOW_RETAIN_SECONDS; older ones make way for new ones first
+
+File names start with what the ring is ordered by (the time for sampled/,
+the duration for slow/), so the files to drop are found from a directory
+listing alone. Every worker writes to the same rings. To look at them:
+
+    python profiling.py slowest             # the slow requests, slowest first
+    python profiling.py merge slow|sampled  # every profile in a ring, merged
+    python profiling.py merge slow | flamegraph.pl > slow.svg
+
+Only requests with a thread to themselves are watched. Requests served on
+the event loop in ASGI mode (see asgi.py) share its thread with every
+other request in flight, so its stack says nothing about any one of them;
+they are neither sampled nor timed for the slow ring.
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from threading import Event, Lock, Thread, get_ident
+
+from flask import g, request
+
+from async_db import is_async_request
+from metrics import counter
+
+SLOW_RETAIN_SECONDS = 24 * 3600
+
+# Frames nearest the root are the server's and Flask's, the same for every
+# request; stacks are cut off below the view's dispatch to keep them short.
+ROOT_FUNCTIONS = {'dispatch_request'}
+
+profiles_written = counter(
+    'warbler_profiles_written_total',
+    "Request profiles written, by why they were kept.")
+
+
+def profile_dir(config):
+    """The directory the rings are kept in."""
+
+    return (config.get('PROFILE_DIR')
+            or os.path.join(tempfile.gettempdir(), "warbler-profiles"))
+
+
+def fold(frame):
+    """Return `frame`'s stack as "outermost;...;innermost"."""
+
+    names = []
+
+    while frame is not None:
+        code = frame.f_code
+        names.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}"
+            f":{code.co_firstlineno})")
+
+        if code.co_name in ROOT_FUNCTIONS:
+            break
+
+        frame = frame.f_back
+
+    return ";".join(reversed(names))
+
+
+class Ring:
+    """At most `keep` profiles in `directory`, dropping the lowest-ranked
+    (by file name) when there are more."""
+
+    def __init__(self, directory, keep, retain_seconds=None):
+        self.directory = directory
+        self.keep = keep
+        self.retain_seconds = retain_seconds
+
+    def files(self):
+        try:
+            return sorted(name for name in os.listdir(self.directory)
+                          if name.endswith(".folded"))
+        except FileNotFoundError:
+            return []
+
+    def add(self, rank, tag, samples, now=None):
+        """Write `samples` ({stack: count}) as a profile ranked `rank`;
+        return its path."""
+
+        now = time.time() if now is None else now
+        os.makedirs(self.directory, exist_ok=True)
+
+        name = f"{rank:015d}-{now * 1000:015.0f}-{os.getpid()}-{tag}.folded"
+        path = os.path.join(self.directory, name)
+
+        # Written aside and renamed, so a half-written profile is never read.
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+
+        with os.fdopen(fd, "w") as file:
+            for stack, count in samples.items():
+                file.write(f"{stack} {count}\n")
+
+        os.replace(tmp_path, path)
+        self.prune(now)
+
+        return path
+
+    def prune(self, now=None):
+        """Drop expired profiles, then the lowest-ranked past `keep`."""
+
+        now = time.time() if now is None else now
+        files = self.files()
+
+        if self.retain_seconds is not None:
+            cutoff = (now - self.retain_seconds) * 1000
+            expired = [name for name in files
+                       if float(name.split("-")[1]) < cutoff]
+            files = [name for name in files if name not in expired]
+        else:
+            expired = []
+
+        for name in expired + files[:max(len(files) - self.keep, 0)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass  # another worker got there first
+
+
+class Profile:
+    """The samples taken of one request."""
+
+    def __init__(self, tag, sampled):
+        self.tag = tag
+        self.sampled = sampled
+        self.thread_id = get_ident()
+        self.started = time.perf_counter()
+        self.samples = Counter()
+
+
+class Profiler:
+    """Samples the stacks of the requests it's watching, on one thread per
+    process."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.active = {}
+        self.sample_rate = 0
+        self.slow_seconds = None
+        self.interval = 0.01
+        self.sampled_ring = None
+        self.slow_ring = None
+        self.thread = None
+        self.pid = None
+        self.stopping = Event()
+        self.app = None
+
+    def init_app(self, app):
+        """Profile the app's requests, if sampling or slow capture is on."""
+
+        # Later apps share the first one's settings; see create_app.
+        if self.app in (None, app):
+            self.app = app
+            self.configure(app.config)
+
+        if self.sample_rate or self.slow_seconds:
+            app.before_request(self.start_request)
+            app.teardown_request(self.finish_request)
+
+    def configure(self, config):
+        self.sample_rate = config['PROFILE_SAMPLE_RATE']
+        self.slow_seconds = config['SLOW_REQUEST_SECONDS']
+        self.interval = config['PROFILE_INTERVAL_SECONDS']
+
+        directory = profile_dir(config)
+        keep = config['PROFILE_KEEP']
+        self.sampled_ring = Ring(os.path.join(directory, "sampled"), keep)
+        self.slow_ring = Ring(
+            os.path.join(directory, "slow"), keep, SLOW_RETAIN_SECONDS)
+
+    ##########################################################################
+    # Requests
+
+    def start_request(self):
+        if is_async_request():
+            return
+
+        sampled = random.random() < self.sample_rate
+
+        if not (sampled or self.slow_seconds):
+            return
+
+        self.ensure_sampling()
+
+        profile = g.profile = Profile(request.endpoint or "unmatched", sampled)
+
+        with self.lock:
+            self.active[profile.thread_id] = profile
+
+    def finish_request(self, error=None):
+        profile = g.pop('profile', None)
+
+        if profile is None:
+            return
+
+        with self.lock:
+            if self.active.get(profile.thread_id) is profile:
+                del self.active[profile.thread_id]
+
+        self.record(profile, time.perf_counter() - profile.started)
+
+    def record(self, profile, seconds):
+        """Keep `profile` in the rings it qualifies for."""
+
+        # The endpoint is the root frame, so merged profiles split by route.
+        samples = {f"{profile.tag};{stack}": count
+                   for stack, count in profile.samples.items()}
+
+        if not samples:
+            # Finished between two samples; still worth recording it ran.
+            samples = {profile.tag: 1}
+
+        if profile.sampled:
+            self.sampled_ring.add(int(time.time() * 1000), profile.tag, samples)
+            profiles_written.inc(reason='sampled')
+
+        if self.slow_seconds and seconds >= self.slow_seconds:
+            self.slow_ring.add(int(seconds * 1_000_000), profile.tag, samples)
+            profiles_written.inc(reason='slow')
+
+    ##########################################################################
+    # Sampling
+
+    def sample(self):
+        """Add the current stack of each watched request to its profile."""
+
+        frames = sys._current_frames()
+
+        with self.lock:
+            for thread_id, profile in self.active.items():
+                frame = frames.get(thread_id)
+
+                if frame is not None:
+                    profile.samples[fold(frame)] += 1
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.sample()
+
+    def ensure_sampling(self):
+        """Start this process's sampling thread if it isn't running.
+
+        Called at the start of each watched request, so each forked worker
+        starts its own.
+        """
+
+        if self.pid == os.getpid() and self.thread.is_alive():
+            return
+
+        with self.lock:
+            if self.pid == os.getpid() and self.thread.is_alive():
+                return
+
+            self.pid = os.getpid()
+            self.active = {}
+            self.stopping.clear()
+            self.thread = Thread(target=self.run, name="profiler", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+        if self.thread is not None:
+            self.thread.join()
+
+
+profiler = Profiler()
+
+
+##############################################################################
+# Reading the rings
+
+
+def merged(ring):
+    """Sum the samples of every profile in `ring`; return {stack: count}."""
+
+    totals = Counter()
+
+    for name in ring.files():
+        with open(os.path.join(ring.directory, name)) as file:
+            for line in file:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                totals[stack] += int(count)
+
+    return totals
+
+
+if __name__ == "__main__":
+    from app import app
+
+    directory = profile_dir(app.config)
+    rings = {
+        'sampled': Ring(os.path.join(directory, "sampled"), 0),
+        'slow': Ring(os.path.join(directory, "slow"), 0),
+    }
+
+    if sys.argv[1:] == ["slowest"]:
+        for name in reversed(rings['slow'].files()):
+            rank, _, pid, tag = name[:-len(".folded")].split("-", 3)
+            print(f"{int(rank) / 1000:10.1f}ms  {tag:40} "
+                  f"{os.path.join(rings['slow'].directory, name)}")
+
+    elif sys.argv[1:2] == ["merge"] and sys.argv[2:] in (["slow"], ["sampled"]):
+        for stack, count in merged(rings[sys.argv[2]]).items():
+            print(f"{stack} {count}")
+
+    else:
+        print(__doc__)
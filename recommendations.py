@@ -0,0 +1,258 @@
+"""Who to follow suggestions.
+
+Candidates for a user are friends of friends: accounts followed by the
+accounts the user follows. Each is scored by
+
+    mutual + POPULARITY_WEIGHT * log(1 + followers)
+
+where `mutual` is how many of the user's followees follow the candidate.
+Users who follow nobody get the most-followed accounts instead. The user
+and the accounts they already follow are never suggested.
+
+The TOP_K best candidates per user are precomputed from the follow graph
+index (see follow_graph.py) into the user_suggestions table:
+
+    python recommendations.py refresh    # every user, e.g. nightly
+
+After a user follows or unfollows someone, a refresh_suggestions job (see
+jobs.py) recomputes their own suggestions (refresh_user) at the end of the
+current REFRESH_SECONDS window; all their follows in one window share a
+job. Until it runs, the sidebar just leaves out whoever they've followed
+since. The knock-on changes for other users wait for the next full
+refresh. Users pending deletion are never shown.
+
+The home page sidebar shows the first SIDEBAR_SIZE suggestions, cached per
+process for CACHE_SECONDS, or until refresh_user publishes "user:<id>" on
+the invalidation bus (see invalidation.py).
+"""
+
+import sys
+import time
+from collections import OrderedDict, namedtuple
+from heapq import nlargest
+from math import log
+from threading import Lock
+
+from sqlalchemy import delete, func, insert, select
+
+from follow_graph import follow_graph
+from invalidation import bus
+from models import db, User, Follow, Suggestion
+
+TOP_K = 20
+SIDEBAR_SIZE = 5
+POPULARITY_WEIGHT = 0.5
+
+CACHE_SECONDS = 60
+MAX_CACHED_USERS = 10_000
+REFRESH_BATCH_SIZE = 500
+REFRESH_SECONDS = 5
+
+SuggestedUser = namedtuple(
+    'SuggestedUser', ['id', 'username', 'image_url', 'image_digest', 'mutual'])
+
+
+def popularity(user_id):
+    """The popularity part of a candidate's score."""
+
+    return POPULARITY_WEIGHT * log(1 + follow_graph.follower_count(user_id))
+
+
+def most_followed(limit):
+    """Return the ids of the `limit` most-followed users."""
+
+    return db.session.scalars(
+        select(Follow.user_being_followed_id)
+        .group_by(Follow.user_being_followed_id)
+        .order_by(func.count().desc(), Follow.user_being_followed_id)
+        .limit(limit)).all()
+
+
+def score_candidates(user_id, popular=None, following=None):
+    """Return the TOP_K (score, candidate id, mutual) for `user_id`.
+
+    `popular` are the fallback candidates for users who follow nobody;
+    they're looked up if needed and not given. `following` are the ids
+    `user_id` follows, by default from the follow graph.
+    """
+
+    if following is None:
+        following = follow_graph.following(user_id)
+
+    excluded = set(following)
+    excluded.add(user_id)
+
+    mutual = {}
+
+    for followed_id in following:
+        for candidate_id in follow_graph.following(followed_id):
+            if candidate_id not in excluded:
+                mutual[candidate_id] = mutual.get(candidate_id, 0) + 1
+
+    if not following:
+        if popular is None:
+            popular = most_followed(TOP_K + 1)
+
+        mutual = {
+            candidate_id: 0
+            for candidate_id in popular if candidate_id not in excluded}
+
+    return nlargest(TOP_K, (
+        (count + popularity(candidate_id), candidate_id, count)
+        for candidate_id, count in mutual.items()))
+
+
+def save_suggestions(scored):
+    """Replace the stored suggestions of every user in `scored`.
+
+    `scored` is {user id: [(score, candidate id, mutual), ...]}.
+    """
+
+    db.session.execute(
+        delete(Suggestion).where(Suggestion.user_id.in_(list(scored))))
+
+    rows = [
+        dict(user_id=user_id, suggested_user_id=candidate_id,
+             score=score, mutual=mutual)
+        for user_id, candidates in scored.items()
+        for score, candidate_id, mutual in candidates
+    ]
+
+    if rows:
+        db.session.execute(insert(Suggestion), rows)
+
+
+def load_suggested_users(scored):
+    """Return SuggestedUsers for `scored` candidates, in the same order."""
+
+    ids = [candidate_id for _, candidate_id, _ in scored]
+    users = {
+        row.id: row for row in db.session.execute(
+            select(User.id, User.username, User.image_url, User.image_digest)
+            .where(User.id.in_(ids), User.pending_deletion.is_(False)))
+    } if ids else {}
+
+    return [
+        SuggestedUser(*users[candidate_id], mutual)
+        for _, candidate_id, mutual in scored if candidate_id in users
+    ]
+
+
+class SuggestionCache:
+    """Per-process cache of each user's sidebar suggestions."""
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, user_id):
+        """Return the cached suggestions for `user_id`, or None."""
+
+        with self.lock:
+            entry = self.entries.get(user_id)
+
+            if entry is None or entry[0] < time.monotonic():
+                return None
+
+            self.entries.move_to_end(user_id)
+
+        expires, suggestions, stamp = entry
+
+        if not bus.fresh(f"user:{user_id}", stamp):
+            return None
+
+        return suggestions
+
+    def set(self, user_id, suggestions, stamp):
+        """Cache `suggestions`, loaded after bus.stamp() returned `stamp`."""
+
+        with self.lock:
+            self.entries[user_id] = (
+                time.monotonic() + CACHE_SECONDS, suggestions, stamp)
+            self.entries.move_to_end(user_id)
+
+            while len(self.entries) > MAX_CACHED_USERS:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+
+cache = SuggestionCache()
+
+
+def refresh_user(user_id):
+    """Recompute and store `user_id`'s suggestions in db.session's
+    transaction.
+
+    Their own follows are read from the database: this process's follow
+    graph hasn't seen follows made by other processes since its snapshot.
+    """
+
+    following = db.session.scalars(
+        select(Follow.user_being_followed_id)
+        .where(Follow.user_following_id == user_id)).all()
+
+    save_suggestions({user_id: score_candidates(user_id, following=following)})
+    bus.publish('user', user_id)
+
+
+def refresh_all():
+    """Recompute and store every user's suggestions; return how many users.
+
+    Commits after every REFRESH_BATCH_SIZE users.
+    """
+
+    follow_graph.refresh(force=True)
+    popular = most_followed(TOP_K + 1)
+    user_ids = db.session.scalars(select(User.id).order_by(User.id)).all()
+
+    for start in range(0, len(user_ids), REFRESH_BATCH_SIZE):
+        batch = user_ids[start:start + REFRESH_BATCH_SIZE]
+        save_suggestions({
+            user_id: score_candidates(user_id, popular) for user_id in batch})
+        db.session.commit()
+
+    return len(user_ids)
+
+
+def suggestions_for(user_id, limit=SIDEBAR_SIZE):
+    """Return up to `limit` SuggestedUsers for `user_id`, best first."""
+
+    suggestions = cache.get(user_id)
+
+    if suggestions is None:
+        stamp = bus.stamp(f"user:{user_id}")
+        rows = db.session.execute(
+            select(User.id, User.username, User.image_url, User.image_digest,
+                   Suggestion.mutual)
+            .join(Suggestion, Suggestion.suggested_user_id == User.id)
+            .where(Suggestion.user_id == user_id,
+                   User.pending_deletion.is_(False))
+            .order_by(Suggestion.score.desc(), User.id)
+            .limit(TOP_K))
+
+        suggestions = [SuggestedUser(*row) for row in rows]
+
+        if not suggestions:
+            # Not computed yet (a new user): score them now, without storing.
+            suggestions = load_suggested_users(score_candidates(user_id))
+
+        cache.set(user_id, suggestions, stamp)
+
+    # Drop anyone followed since the suggestions were computed.
+    return [
+        suggestion for suggestion in suggestions
+        if not follow_graph.follows(user_id, suggestion.id)
+    ][:limit]
+
+
+if __name__ == "__main__":
+    from app import app  # noqa: F401 (connects the database)
+
+    if sys.argv[1:] == ["refresh"]:
+        print(f"Refreshed suggestions for {refresh_all()} users")
+
+    else:
+        print(__doc__)
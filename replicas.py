@@ -0,0 +1,188 @@
+"""Read replica routing.
+
+GET and HEAD requests read from one of the replicas listed in the
+REPLICA_DATABASE_URLS config setting; every other request, and every write,
+uses the primary. After a user writes to the primary, their reads stay on
+the primary for READ_YOUR_WRITES_SECONDS, so they never see a lagging
+replica that's missing their own change.
+
+A replica lagging more than MAX_REPLICA_LAG_SECONDS behind the primary (or
+one that can't be reached) is skipped until it catches up. Lag is checked at
+most every LAG_CHECK_SECONDS and reported as warbler_replica_lag_seconds.
+"""
+
+import random
+import time
+from threading import Lock
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from async_db import io_engine
+from metrics import counter, gauge
+from pooling import engine_options
+
+LAST_WRITE_KEY = "last_db_write"
+
+READ_ONLY_METHODS = ("GET", "HEAD")
+
+LAG_CHECK_SECONDS = 2
+
+LAG_QUERY = text("""
+    SELECT CASE
+        WHEN pg_is_in_recovery()
+        THEN EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+        ELSE 0
+    END""")
+
+replica_lag = gauge(
+    'warbler_replica_lag_seconds',
+    "Seconds the replica's last replayed transaction is behind the primary.")
+
+db_reads = counter(
+    'warbler_db_reads_total',
+    "Statements run by requests, by the database role that ran them.")
+
+
+class ReplicaSet:
+    """Chooses a replica for read-only requests.
+
+    Like `db`, this is created once and bound to the app with `init_app`.
+    """
+
+    def __init__(self):
+        self.engines = []
+        self.lag = []
+        self.checked_at = None
+        self.lock = Lock()
+        self.read_your_writes_seconds = 5
+        self.max_lag_seconds = 5
+        self.app = None
+
+    def init_app(self, app):
+        """Connect to the app's replicas and route its requests."""
+
+        app.before_request(self.choose_role)
+        app.after_request(self.remember_write)
+
+        if self.app not in (None, app):
+            return  # configured by the first app; see create_app
+        self.app = app
+
+        self.read_your_writes_seconds = app.config.get(
+            'READ_YOUR_WRITES_SECONDS', 5)
+        self.max_lag_seconds = app.config.get(
+            'MAX_REPLICA_LAG_SECONDS', self.read_your_writes_seconds)
+        self.configure(app.config.get('REPLICA_DATABASE_URLS', []), app.config)
+
+    def configure(self, urls, config=None):
+        """(Re)connect to `urls`, using the pool settings in `config`."""
+
+        for engine in self.engines:
+            engine.dispose()
+
+        self.engines = [
+            create_engine(url, **engine_options(config or {}, f"replica{i}"))
+            for i, url in enumerate(urls)
+        ]
+        self.lag = [None] * len(self.engines)
+        self.checked_at = None
+
+    def choose_role(self):
+        """Decide whether this request may read from a replica."""
+
+        last_write = session.get(LAST_WRITE_KEY, 0)
+        wrote_recently = (
+            time.time() - last_write < self.read_your_writes_seconds)
+
+        g.db_role = (
+            'replica'
+            if self.engines
+            and request.method in READ_ONLY_METHODS
+            and not wrote_recently
+            else 'primary')
+        g.db_replica = None
+        g.db_wrote = False
+
+    def remember_write(self, response):
+        """Keep this user on the primary for a while if they wrote."""
+
+        if g.get('db_wrote'):
+            session[LAST_WRITE_KEY] = time.time()
+
+        return response
+
+    def check_lag(self):
+        """Measure each replica's lag, if it hasn't been done lately.
+
+        The lock is only held to claim the check, never while querying: in
+        the ASGI mode concurrent requests share one thread, so a request
+        waiting on the lock would block the one holding it.
+        """
+
+        with self.lock:
+            if (self.checked_at is not None
+                    and time.monotonic() - self.checked_at < LAG_CHECK_SECONDS):
+                return
+
+            self.checked_at = time.monotonic()
+
+        for i, engine in enumerate(self.engines):
+            try:
+                with io_engine(engine).connect() as conn:
+                    lag = conn.execute(LAG_QUERY).scalar()
+            except SQLAlchemyError:
+                lag = None
+
+            self.lag[i] = None if lag is None else float(lag)
+            replica_lag.set(
+                float('nan') if lag is None else float(lag), replica=i)
+
+    def engine_for_read(self):
+        """Return this request's replica engine, or None to use the primary."""
+
+        if not has_request_context() or g.get('db_role') != 'replica':
+            return None
+
+        if g.db_replica is None:
+            self.check_lag()
+
+            healthy = [
+                engine for engine, lag in zip(self.engines, self.lag)
+                if lag is not None and lag <= self.max_lag_seconds]
+
+            g.db_replica = random.choice(healthy) if healthy else False
+
+        return g.db_replica or None
+
+
+replicas = ReplicaSet()
+
+
+class RoutingSession(Session):
+    """Session that sends reads in read-only requests to a replica.
+
+    Writes (flushes and INSERT/UPDATE/DELETE statements) always go to the
+    primary, and mark the request as having written.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        primary = super().get_bind(
+            mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+        if bind is not None:
+            return io_engine(primary)
+
+        if self._flushing or getattr(clause, 'is_dml', False):
+            if has_request_context():
+                g.db_wrote = True
+            return io_engine(primary)
+
+        replica = replicas.engine_for_read()
+
+        if has_request_context():
+            db_reads.inc(role='replica' if replica else 'primary')
+
+        return io_engine(replica or primary)
@@ -1,8 +1,11 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
-from app import db
-from models import User, Message, Follow
+from app import create_app
+from models import db, User, Message, Follow
+from migrations import run_migrations
+
+create_app().app_context().push()
 
 db.drop_all()
 db.create_all()
@@ -17,3 +20,6 @@ with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follow, DictReader(follows))
 
 db.session.commit()
+
+# Run after loading the data, so the messages partitions are sized to it.
+run_migrations()
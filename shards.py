@@ -0,0 +1,781 @@
+"""Shard routing for messages and likes.
+
+A message lives on the shard that owns its author, and a like lives with
+the message it likes, so a message, its likes and its author's timeline are
+always on one database. Users and follows stay on the primary database.
+
+Shard 0 is the primary database. Extra shards are listed in the
+SHARD_DATABASE_URLS config setting; with none listed, every message and like
+stays on the primary exactly as before.
+
+Each user id falls into one of NUM_BUCKETS buckets, and each bucket belongs
+to one shard. Buckets start out on shard 0; the bucket map lives in the
+shard_buckets table on the primary, so buckets can be moved between shards
+without rehashing every user:
+
+    python shards.py create-tables    # create tables on the extra shards
+    python shards.py status           # messages per shard
+    python shards.py move-bucket 17 2 # move bucket 17 to shard 2
+    python shards.py rebalance        # spread buckets evenly over shards
+
+Message ids are drawn from the primary's messages id sequence on every
+shard, so they stay unique across shards.
+"""
+
+import heapq
+import sys
+import time
+from datetime import datetime
+from itertools import islice
+from threading import Lock
+
+from flask import abort
+from flask.globals import app_ctx
+from sqlalchemy import (
+    Column, Index, MetaData, Table, create_engine, delete, func, insert,
+    select, text, tuple_, update,
+)
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
+
+import hashtags
+from async_db import io_engine
+from models import db, User, Message, Like, MessageTag, Mention, ShardBucket
+from pooling import engine_options
+
+NUM_BUCKETS = 1024
+
+# How long a worker trusts its copy of the bucket map. Bucket moves wait at
+# least this long between steps, so every worker sees each step.
+BUCKET_MAP_TTL = 5
+
+MOVE_BATCH_SIZE = 1000
+REBALANCE_GROUP_SIZE = 64
+
+# Rows that live with a message, on its shard, keyed by message_id
+MESSAGE_ROWS = (Like, MessageTag, Mention)
+
+
+class ShardMoving(Exception):
+    """Writes for this user are paused while their bucket changes shards."""
+
+
+def shard_metadata():
+    """Tables for messages and the rows kept with them on an extra shard.
+
+    They have the same columns as on the primary but no foreign keys, since
+    users live on the primary; the router deletes likes, tags and mentions
+    with their message.
+    """
+
+    metadata = MetaData()
+
+    for model in (Message,) + MESSAGE_ROWS:
+        Table(
+            model.__tablename__,
+            metadata,
+            *(Column(
+                column.name,
+                column.type,
+                primary_key=column.primary_key,
+                nullable=column.nullable,
+                server_default=column.server_default,
+                autoincrement=False,
+            ) for column in model.__table__.columns),
+        )
+
+    Index('ix_messages_user_id_timestamp',
+          metadata.tables['messages'].c.user_id,
+          metadata.tables['messages'].c.timestamp.desc())
+    Index('ix_likes_message_id_timestamp',
+          metadata.tables['likes'].c.message_id,
+          metadata.tables['likes'].c.timestamp.desc(),
+          metadata.tables['likes'].c.user_id.desc())
+    Index('ix_likes_user_id_timestamp',
+          metadata.tables['likes'].c.user_id,
+          metadata.tables['likes'].c.timestamp.desc(),
+          metadata.tables['likes'].c.message_id.desc())
+
+    for table, key in (('message_tags', 'tag'), ('mentions', 'user_id')):
+        columns = metadata.tables[table].c
+        Index(f'ix_{table}_{key}_timestamp',
+              columns[key], columns.timestamp.desc(),
+              columns.message_id.desc())
+        Index(f'ix_{table}_message_id', columns.message_id)
+
+    return metadata
+
+
+class ShardSession(Session):
+    """Session on an extra shard; uses the async twin in async requests."""
+
+    def get_bind(self, *args, **kwargs):
+        return io_engine(super().get_bind(*args, **kwargs))
+
+
+def _app_ctx_id():
+    """Scope shard sessions to the app context, as db.session is.
+
+    Thread-local sessions would be shared by the concurrent requests of the
+    ASGI mode, which all run on one thread.
+    """
+
+    return id(app_ctx._get_current_object())
+
+
+class ShardRouter:
+    """Routes message and like reads and writes to the right shard.
+
+    Like `db`, this is created once and bound to the app with `init_app`.
+    """
+
+    def __init__(self):
+        self.engines = []
+        self.sessions = []
+        self._bucket_map = {}
+        self._bucket_map_loaded_at = None
+        self._bucket_map_lock = Lock()
+        self.app = None
+
+    def init_app(self, app):
+        """Connect to the extra shards listed in the app's config."""
+
+        app.teardown_appcontext(self.remove_sessions)
+
+        if self.app not in (None, app):
+            return  # configured by the first app; see create_app
+        self.app = app
+
+        self.configure(app.config.get('SHARD_DATABASE_URLS', []), app.config)
+
+    def configure(self, urls, config=None):
+        """(Re)connect to `urls`, using the pool settings in `config`."""
+
+        for engine in self.engines:
+            engine.dispose()
+
+        self.engines = [
+            create_engine(url, **engine_options(config or {}, f"shard{i}"))
+            for i, url in enumerate(urls, start=1)
+        ]
+        self.sessions = [
+            scoped_session(
+                sessionmaker(bind=engine, class_=ShardSession),
+                scopefunc=_app_ctx_id)
+            for engine in self.engines
+        ]
+        self._bucket_map_loaded_at = None
+
+    def remove_sessions(self, exception=None):
+        """Close this request's sessions on the extra shards."""
+
+        for session in self.sessions:
+            session.remove()
+
+    @property
+    def num_shards(self):
+        """Number of shards, including the primary."""
+
+        return len(self.engines) + 1
+
+    def session(self, shard):
+        """Return the session for `shard`."""
+
+        if shard == 0:
+            return db.session
+
+        return self.sessions[shard - 1]()
+
+    def engine(self, shard):
+        """Return the engine for `shard`."""
+
+        if shard == 0:
+            return db.engine
+
+        return self.engines[shard - 1]
+
+    def create_tables(self):
+        """Create the messages and likes tables on every extra shard."""
+
+        metadata = shard_metadata()
+
+        for engine in self.engines:
+            metadata.create_all(engine)
+
+    def commit(self):
+        """Commit the extra shards, then the primary."""
+
+        for shard in range(1, self.num_shards):
+            self.session(shard).commit()
+
+        db.session.commit()
+
+    ##########################################################################
+    # Bucket map
+
+    def bucket_map(self):
+        """Return {bucket: (shard, moving)} for buckets moved off shard 0.
+
+        The lock only guards the cached copy and is never held while
+        querying, as in ReplicaSet.check_lag.
+        """
+
+        with self._bucket_map_lock:
+            loaded_at = self._bucket_map_loaded_at
+
+            if loaded_at is not None and time.monotonic() - loaded_at <= BUCKET_MAP_TTL:
+                return self._bucket_map
+
+        with io_engine(db.engine).connect() as conn:
+            rows = conn.execute(select(
+                ShardBucket.bucket,
+                ShardBucket.shard,
+                ShardBucket.moving))
+
+            bucket_map = {
+                bucket: (shard, moving) for bucket, shard, moving in rows}
+
+        with self._bucket_map_lock:
+            self._bucket_map = bucket_map
+            self._bucket_map_loaded_at = time.monotonic()
+
+        return bucket_map
+
+    def bucket_for(self, user_id):
+        """Return the bucket holding `user_id`."""
+
+        return user_id % NUM_BUCKETS
+
+    def shard_for(self, user_id):
+        """Return the shard holding `user_id`'s messages."""
+
+        if self.num_shards == 1:
+            return 0
+
+        shard, _ = self.bucket_map().get(self.bucket_for(user_id), (0, False))
+        return shard
+
+    def shard_for_write(self, user_id):
+        """Like shard_for, but raise ShardMoving while the bucket moves."""
+
+        if self.num_shards == 1:
+            return 0
+
+        shard, moving = self.bucket_map().get(
+            self.bucket_for(user_id), (0, False))
+
+        if moving:
+            raise ShardMoving(user_id)
+
+        return shard
+
+    def group_by_shard(self, user_ids):
+        """Return {shard: [user_id, ...]} for `user_ids`."""
+
+        groups = {}
+
+        for user_id in user_ids:
+            groups.setdefault(self.shard_for(user_id), []).append(user_id)
+
+        return groups
+
+    ##########################################################################
+    # Reads
+
+    def attach_authors(self, messages):
+        """Load the authors of `messages` from the primary in one query.
+
+        Returns the messages whose authors are still there: those of users
+        deleted, or waiting for their delete_user job, are left out.
+        """
+
+        user_ids = {msg.user_id for msg in messages}
+        users = {
+            user.id: user
+            for user in User.query.filter(
+                User.id.in_(user_ids), User.pending_deletion.is_(False))
+        } if user_ids else {}
+
+        shown = []
+
+        for msg in messages:
+            if msg.user_id in users:
+                set_committed_value(msg, 'user', users[msg.user_id])
+                shown.append(msg)
+
+        return shown
+
+    def recent_by_users(self, user_ids, limit=100):
+        """Return the `limit` newest messages by any of `user_ids`.
+
+        Each shard returns its own newest messages already sorted, and the
+        sorted streams are merged.
+        """
+
+        streams = [
+            Message.recent_by_users(ids, limit, session=self.session(shard))
+            for shard, ids in self.group_by_shard(user_ids).items()
+        ]
+
+        merged = heapq.merge(
+            *streams, key=lambda msg: msg.timestamp, reverse=True)
+
+        return self.attach_authors(list(islice(merged, limit)))
+
+    def get_message_or_404(self, message_id):
+        """Find message `message_id` on whichever shard holds it."""
+
+        for shard in range(self.num_shards):
+            msg = self.session(shard).get(Message, message_id)
+
+            if msg is not None:
+                for shown in self.attach_authors([msg]):
+                    return shown
+
+                break
+
+        abort(404)
+
+    def get_messages(self, refs):
+        """Return the messages named by `refs`, (message id, author id) pairs.
+
+        Messages are returned in the order of `refs`; deleted ones are left
+        out. One query per shard.
+        """
+
+        by_shard = {}
+
+        for message_id, user_id in refs:
+            by_shard.setdefault(self.shard_for(user_id), []).append(message_id)
+
+        found = {}
+
+        for shard, message_ids in by_shard.items():
+            found.update(
+                (msg.id, msg) for msg in self.session(shard).scalars(
+                    select(Message).where(Message.id.in_(message_ids))))
+
+        return self.attach_authors([
+            found[message_id] for message_id, _ in refs if message_id in found])
+
+    def liked_message_ids(self, user_id, messages):
+        """Return the ids of those `messages` that `user_id` has liked."""
+
+        by_shard = {}
+
+        for msg in messages:
+            by_shard.setdefault(self.shard_for(msg.user_id), []).append(msg.id)
+
+        liked = set()
+
+        for shard, message_ids in by_shard.items():
+            liked.update(self.session(shard).scalars(
+                select(Like.message_id)
+                .where(Like.user_id == user_id)
+                .where(Like.message_id.in_(message_ids))))
+
+        return liked
+
+    def _rows_page(self, model, condition, limit=None, before=None):
+        """Return (message, row timestamp) for `model` rows matching
+        `condition`, joined to their messages.
+
+        `model` is one of MESSAGE_ROWS. Newest rows first, at most `limit`
+        of them. `before` is the (timestamp, message id) of the last row on
+        the previous page. Each shard returns its own first page already
+        sorted from the (key, timestamp DESC, message_id DESC) index, and
+        the sorted streams are merged. Rows whose message attach_authors
+        leaves out are dropped, so a page can come up short.
+        """
+
+        onclause = Message.id == model.message_id
+
+        if model is not Like:
+            # Tags and mentions carry the message's timestamp, which lets
+            # Postgres look in just the message's partition.
+            onclause &= Message.timestamp == model.timestamp
+
+        query = (
+            select(Message, model.timestamp)
+            .join(model, onclause)
+            .where(condition)
+            .order_by(model.timestamp.desc(), model.message_id.desc())
+            .limit(limit))
+
+        if before is not None:
+            timestamp, message_id = before
+            query = query.where(
+                tuple_(model.timestamp, model.message_id)
+                < tuple_(timestamp, message_id))
+
+        streams = [
+            self.session(shard).execute(query).tuples().all()
+            for shard in range(self.num_shards)
+        ]
+
+        merged = list(islice(heapq.merge(
+            *streams,
+            key=lambda row: (row[1], row[0].id),
+            reverse=True), limit))
+
+        shown = set(self.attach_authors([msg for msg, _ in merged]))
+
+        return [row for row in merged if row[0] in shown]
+
+    def liked_page(self, user_id, limit=None, before=None):
+        """Return (message, liked at) for messages `user_id` has liked, most
+        recently liked first; see _rows_page."""
+
+        return self._rows_page(Like, Like.user_id == user_id, limit, before)
+
+    def tagged_page(self, tag, limit=None, before=None):
+        """Return (message, timestamp) for messages tagged `tag`, newest
+        first; see _rows_page."""
+
+        return self._rows_page(MessageTag, MessageTag.tag == tag, limit, before)
+
+    def mentions_page(self, user_id, limit=None, before=None):
+        """Return (message, timestamp) for messages mentioning `user_id`,
+        newest first; see _rows_page."""
+
+        return self._rows_page(Mention, Mention.user_id == user_id, limit, before)
+
+    def liked_messages(self, user_id):
+        """Return every message `user_id` has liked, most recently liked
+        first."""
+
+        return [msg for msg, _ in self.liked_page(user_id)]
+
+    def liked_by(self, msg, limit, before=None):
+        """Return a page of who liked `msg`: (user id, liked at) pairs.
+
+        Newest likes first. `before` is the (liked at, user id) of the last
+        like on the previous page; the page starts after it, so every page
+        costs the same however far down it is.
+        """
+
+        query = (
+            select(Like.user_id, Like.timestamp)
+            .where(Like.message_id == msg.id)
+            .order_by(Like.timestamp.desc(), Like.user_id.desc())
+            .limit(limit))
+
+        if before is not None:
+            liked_at, user_id = before
+            query = query.where(
+                tuple_(Like.timestamp, Like.user_id) < tuple_(liked_at, user_id))
+
+        return self.session(self.shard_for(msg.user_id)).execute(query).all()
+
+    def count_messages(self, user_id):
+        """How many messages has `user_id` written?"""
+
+        return self.session(self.shard_for(user_id)).scalar(
+            select(func.count())
+            .select_from(Message)
+            .where(Message.user_id == user_id))
+
+    def count_likes(self, user_id):
+        """How many messages has `user_id` liked?"""
+
+        return sum(
+            self.session(shard).scalar(
+                select(func.count())
+                .select_from(Like)
+                .where(Like.user_id == user_id))
+            for shard in range(self.num_shards))
+
+    ##########################################################################
+    # Writes
+
+    def allocate_message_ids(self, count=1):
+        """Draw `count` ids from the primary's messages id sequence."""
+
+        return db.session.scalars(
+            text("SELECT nextval('messages_id_seq') "
+                 "FROM generate_series(1, :count)"),
+            {"count": count}).all()
+
+    def add_message(self, user_id, text):
+        """Add a message by `user_id` to their shard, with its hashtags and
+        mentions (see hashtags.py); return its id."""
+
+        shard = self.shard_for_write(user_id)
+        session = self.session(shard)
+        timestamp = datetime.utcnow()
+
+        values = {"text": text, "user_id": user_id, "timestamp": timestamp}
+        if shard != 0:
+            values["id"] = self.allocate_message_ids()[0]
+
+        message_id = session.scalar(
+            insert(Message).values(**values).returning(Message.id))
+        hashtags.insert_side_rows(session, [(message_id, text, timestamp)])
+
+        return message_id
+
+    def add_messages(self, user_id, texts):
+        """Add messages by `user_id` with one multi-row insert, like
+        add_message; return their ids, in the order of `texts`."""
+
+        shard = self.shard_for_write(user_id)
+        session = self.session(shard)
+        timestamp = datetime.utcnow()
+        message_ids = self.allocate_message_ids(len(texts))
+
+        session.execute(insert(Message), [
+            {"id": message_id, "text": text, "user_id": user_id,
+             "timestamp": timestamp}
+            for message_id, text in zip(message_ids, texts)
+        ])
+        hashtags.insert_side_rows(session, [
+            (message_id, text, timestamp)
+            for message_id, text in zip(message_ids, texts)
+        ])
+
+        return message_ids
+
+    def toggle_like(self, user_id, msg):
+        """Like `msg` for `user_id`, or unlike it if they already do.
+
+        The message's like_count changes in the same transaction, by how
+        many likes were really added or deleted, so concurrent toggles
+        can't make it drift. Returns True if it's now liked, False if it's
+        now unliked.
+        """
+
+        session = self.session(self.shard_for_write(msg.user_id))
+
+        deleted = session.execute(delete(Like).where(
+            Like.user_id == user_id, Like.message_id == msg.id)).rowcount
+
+        if not deleted:
+            session.execute(insert(Like).values(
+                user_id=user_id, message_id=msg.id))
+
+        session.execute(
+            update(Message)
+            # The timestamp lets Postgres go straight to the partition.
+            .where(Message.id == msg.id, Message.timestamp == msg.timestamp)
+            .values(like_count=Message.like_count + (-1 if deleted else 1)))
+
+        return not deleted
+
+    def delete_message_rows(self, session, message_ids):
+        """Delete the likes, tags and mentions of `message_ids` (a list or
+        a subquery) in `session`."""
+
+        for model in MESSAGE_ROWS:
+            session.execute(
+                delete(model).where(model.message_id.in_(message_ids)))
+
+    def delete_message(self, msg):
+        """Delete `msg` and its likes, tags and mentions."""
+
+        session = self.session(self.shard_for_write(msg.user_id))
+
+        self.delete_message_rows(session, [msg.id])
+        session.execute(delete(Message).where(Message.id == msg.id))
+
+    def delete_user_data(self, user_id):
+        """Delete `user_id`'s messages, likes and mentions from every shard."""
+
+        home = self.session(self.shard_for_write(user_id))
+        message_ids = select(Message.id).where(Message.user_id == user_id)
+
+        self.delete_message_rows(home, message_ids)
+        home.execute(delete(Message).where(Message.user_id == user_id))
+
+        liked = select(Like.message_id).where(Like.user_id == user_id)
+
+        for shard in range(self.num_shards):
+            session = self.session(shard)
+            session.execute(
+                update(Message)
+                .where(Message.id.in_(liked))
+                .values(like_count=Message.like_count - 1))
+            session.execute(delete(Like).where(Like.user_id == user_id))
+            session.execute(delete(Mention).where(Mention.user_id == user_id))
+
+    ##########################################################################
+    # Moving buckets
+
+    def _set_bucket(self, bucket, shard, moving):
+        """Record that `bucket` is on `shard`, and whether it's moving."""
+
+        row = db.session.get(ShardBucket, bucket)
+
+        if row is None:
+            row = ShardBucket(bucket=bucket)
+            db.session.add(row)
+
+        row.shard = shard
+        row.moving = moving
+        db.session.commit()
+
+        self._bucket_map_loaded_at = None
+
+    def move_buckets(self, moves, wait=BUCKET_MAP_TTL):
+        """Move buckets to new shards; `moves` is {bucket: target shard}.
+
+        Writes for the buckets' users are paused (ShardMoving) during the
+        copy. The copy starts only once every worker has seen the pause, and
+        the source rows are deleted only once every worker reads from the
+        new shards.
+
+        If the copy fails the buckets are put back on their source shards,
+        unpaused. If the mover is killed mid-copy they stay paused on their
+        source shards until the move is run again; each copy first clears
+        whatever a previous attempt left on the target.
+
+        Returns the number of messages moved.
+        """
+
+        bucket_map = self.bucket_map()
+        sources = {
+            bucket: bucket_map.get(bucket, (0, False))[0] for bucket in moves}
+        moves = {
+            bucket: target for bucket, target in moves.items()
+            if sources[bucket] != target}
+
+        if not moves:
+            return 0
+
+        for bucket in moves:
+            self._set_bucket(bucket, sources[bucket], moving=True)
+        time.sleep(wait)
+
+        copied = False
+
+        try:
+            moved = sum(
+                self._copy_bucket(bucket, sources[bucket], target)
+                for bucket, target in moves.items())
+
+            for bucket, target in moves.items():
+                self._set_bucket(bucket, target, moving=False)
+            copied = True
+        finally:
+            if not copied:
+                self._abandon_move(moves, sources)
+
+        time.sleep(wait)
+
+        for bucket in moves:
+            self._clear_bucket(self.session(sources[bucket]), bucket)
+
+        return moved
+
+    def _abandon_move(self, moves, sources):
+        """Put the buckets of a failed move back on their source shards, and
+        drop what was copied to the targets."""
+
+        db.session.rollback()
+
+        for bucket, target in moves.items():
+            self.session(target).rollback()
+            self.session(sources[bucket]).rollback()
+            self._set_bucket(bucket, sources[bucket], moving=False)
+
+        for bucket, target in moves.items():
+            self._clear_bucket(self.session(target), bucket)
+
+    def _clear_bucket(self, session, bucket):
+        """Delete `bucket`'s messages, likes, tags and mentions in
+        `session`, and commit."""
+
+        in_bucket = Message.user_id % NUM_BUCKETS == bucket
+
+        self.delete_message_rows(session, select(Message.id).where(in_bucket))
+        session.execute(delete(Message).where(in_bucket))
+        session.commit()
+
+    def _copy_bucket(self, bucket, source, target):
+        """Copy `bucket`'s messages, with their likes, tags and mentions, from
+        `source` to `target`, replacing any the target already has."""
+
+        src = self.session(source)
+        dst = self.session(target)
+        in_bucket = Message.user_id % NUM_BUCKETS == bucket
+
+        # Left there by an earlier attempt that was killed part way.
+        self._clear_bucket(dst, bucket)
+
+        copied = 0
+        last_id = 0
+
+        while True:
+            messages = src.execute(
+                select(Message.__table__)
+                .where(in_bucket, Message.id > last_id)
+                .order_by(Message.id)
+                .limit(MOVE_BATCH_SIZE)).mappings().all()
+
+            if not messages:
+                return copied
+
+            message_ids = [row["id"] for row in messages]
+            dst.execute(insert(Message.__table__), [dict(m) for m in messages])
+
+            for model in MESSAGE_ROWS:
+                rows = src.execute(
+                    select(model.__table__)
+                    .where(model.message_id.in_(message_ids))).mappings().all()
+
+                if rows:
+                    dst.execute(
+                        insert(model.__table__), [dict(row) for row in rows])
+
+            dst.commit()
+
+            copied += len(messages)
+            last_id = message_ids[-1]
+
+    def rebalance(self, wait=BUCKET_MAP_TTL):
+        """Move buckets so that bucket b lives on shard b % num_shards.
+
+        Buckets move REBALANCE_GROUP_SIZE at a time, so only that many
+        buckets' users have writes paused at once. Yields the number of
+        messages moved for each group.
+        """
+
+        bucket_map = self.bucket_map()
+        moves = [
+            (bucket, bucket % self.num_shards) for bucket in range(NUM_BUCKETS)
+            if bucket_map.get(bucket, (0, False))[0] != bucket % self.num_shards
+        ]
+
+        for start in range(0, len(moves), REBALANCE_GROUP_SIZE):
+            group = dict(moves[start:start + REBALANCE_GROUP_SIZE])
+            yield self.move_buckets(group, wait)
+
+
+shards = ShardRouter()
+
+
+if __name__ == "__main__":
+    from app import app  # noqa: F401 (connects the database)
+    # The instance app initialised, not this script's copy of it.
+    from shards import shards
+
+    command = sys.argv[1:2]
+
+    if command == ["create-tables"]:
+        shards.create_tables()
+
+    elif command == ["status"]:
+        for shard in range(shards.num_shards):
+            count = shards.session(shard).scalar(
+                select(func.count()).select_from(Message))
+            print(f"shard {shard}: {count} messages")
+
+    elif command == ["move-bucket"] and len(sys.argv) == 4:
+        moved = shards.move_buckets({int(sys.argv[2]): int(sys.argv[3])})
+        print(f"Moved {moved} messages")
+
+    elif command == ["rebalance"]:
+        for moved in shards.rebalance():
+            print(f"Moved {moved} messages")
+
+    else:
+        print(__doc__)
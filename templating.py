@@ -0,0 +1,94 @@
+"""Compiled template cache shared by every worker and kept across restarts,
+and whitespace trimming of template output.
+
+Jinja compiles each template to Python bytecode the first time a process
+renders it. With a bytecode cache the first worker to compile a template
+writes the result to disk, and every other worker (and every later restart)
+loads it from there instead of parsing the template again.
+
+Cache entries are keyed by the template's name and a hash of its contents,
+not by its path, so:
+
+- editing a template gives it a new entry; the old one is never read again
+- releases deployed to different directories share entries for templates
+  that haven't changed, and two releases running side by side during a
+  rolling deploy don't overwrite each other's entries
+
+Entries are written to a temporary file and renamed into place, so a worker
+never reads a half-written entry. Set JINJA_BYTECODE_CACHE_DIR to choose the
+directory; by default Jinja uses a private directory under the system's
+temporary directory.
+
+The templates are indented for reading, and on a long list page much of
+the HTML is that indentation. With JINJA_TRIM_WHITESPACE on, TrimWhitespace
+removes each line's leading whitespace and the blank lines from template
+sources before they're compiled, which browsers render the same. Templates
+with a <pre> or <textarea>, where whitespace shows, are left alone. Cache
+entries are also keyed by the environment's extensions, so turning
+trimming on or off never loads the other setting's entries.
+"""
+
+import re
+from hashlib import sha1
+
+from jinja2 import FileSystemBytecodeCache
+from jinja2.bccache import Bucket
+from jinja2.ext import Extension
+
+WHITESPACE_SENSITIVE = re.compile(r"<(pre|textarea)\b", re.IGNORECASE)
+
+
+class ContentHashBytecodeCache(FileSystemBytecodeCache):
+    """FileSystemBytecodeCache keyed by template name, content hash and
+    the environment's extensions."""
+
+    def get_bucket(self, environment, name, filename, source):
+        checksum = self.get_source_checksum(source)
+        extensions = ",".join(sorted(environment.extensions))
+        key = sha1(
+            f"{name}|{checksum}|{extensions}".encode("utf-8")).hexdigest()
+
+        bucket = Bucket(environment, key, checksum)
+        self.load_bytecode(bucket)
+
+        return bucket
+
+
+def init_bytecode_cache(app):
+    """Give the app's Jinja environment a bytecode cache, if it's enabled.
+
+    Must run before the first template is rendered.
+    """
+
+    if app.config.get('JINJA_BYTECODE_CACHE'):
+        app.jinja_options = {
+            **app.jinja_options,
+            'bytecode_cache': ContentHashBytecodeCache(
+                app.config.get('JINJA_BYTECODE_CACHE_DIR')),
+        }
+
+
+class TrimWhitespace(Extension):
+    """Remove indentation and blank lines from template sources."""
+
+    def preprocess(self, source, name, filename=None):
+        if WHITESPACE_SENSITIVE.search(source):
+            return source
+
+        return "".join(
+            line.lstrip() for line in source.splitlines(keepends=True)
+            if line.strip())
+
+
+def init_trim_whitespace(app):
+    """Trim the whitespace from the app's templates, if it's enabled.
+
+    Must run before the first template is rendered.
+    """
+
+    if app.config.get('JINJA_TRIM_WHITESPACE'):
+        app.jinja_options = {
+            **app.jinja_options,
+            'extensions': [
+                *app.jinja_options.get('extensions', ()), TrimWhitespace],
+        }
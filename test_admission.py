@@ -0,0 +1,140 @@
+"""Write admission control tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_admission.py
+import os
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import event
+
+from admission import (
+    admission, parse_limit, rejections, MemoryBuckets, PostgresBuckets,
+)
+from models import db, User, Message
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class BucketTestCase(TestCase):
+    def test_parse_limit(self):
+        """Limits are N per second, minute or hour"""
+
+        self.assertEqual(parse_limit("30/minute"), (30, 0.5))
+
+    def check_backend(self, buckets):
+        take = lambda now: buckets.take("message:1", 2, 0.5, now=now)
+
+        self.assertEqual(take(100), 0)
+        self.assertEqual(take(100), 0)
+        self.assertEqual(take(100), 2)
+        self.assertEqual(take(101), 1)
+
+        # Two seconds refill one token.
+        self.assertEqual(take(102), 0)
+        self.assertEqual(take(102), 2)
+
+        # Buckets are per key.
+        self.assertEqual(buckets.take("message:2", 2, 0.5, now=102), 0)
+
+    def test_memory(self):
+        """The memory backend takes tokens and refills them at the rate"""
+
+        self.check_backend(MemoryBuckets())
+
+    def test_postgres(self):
+        """The Postgres backend works the same, shared by workers"""
+
+        PostgresBuckets().reset()
+        self.check_backend(PostgresBuckets())
+        self.assertEqual(
+            PostgresBuckets().take("message:1", 2, 0.5, now=102), 2)
+
+    def test_memory_forgets_full_buckets(self):
+        """Past MAX_MEMORY_BUCKETS, refilled buckets are dropped"""
+
+        buckets = MemoryBuckets()
+
+        with patch('admission.MAX_MEMORY_BUCKETS', 1):
+            buckets.take("message:1", 2, 0.5, now=100)
+            buckets.take("message:2", 2, 0.5, now=110)
+
+        self.assertEqual(list(buckets.buckets), ["message:2"])
+
+
+class AdmissionViewTestCase(TestCase):
+    def setUp(self):
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        admission.backend.reset()
+
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        db.session.rollback()
+        admission.backend.reset()
+
+    def test_rejects_over_limit(self):
+        """Writes past the limit get a 429 with Retry-After, and no
+        database work"""
+
+        statements = []
+
+        def count(*args):
+            statements.append(args)
+
+        rejected = rejections.get(route_class='message')
+
+        with patch.dict(admission.limits, {'message': (2, 1 / 60)}):
+            for n in range(2):
+                resp = self.client.post(
+                    "/messages/new", data={"text": f"post {n}"})
+                self.assertEqual(resp.status_code, 302)
+
+            event.listen(db.engine, 'before_cursor_execute', count)
+
+            try:
+                resp = self.client.post(
+                    "/messages/new", data={"text": "one too many"})
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], "60")
+        self.assertEqual(statements, [])
+        self.assertEqual(Message.query.count(), 2)
+        self.assertEqual(rejections.get(route_class='message'), rejected + 1)
+
+    def test_reads_not_limited(self):
+        """Only POSTs to write routes take tokens"""
+
+        with patch.dict(admission.limits, {'message': (1, 1 / 60)}):
+            for _ in range(3):
+                resp = self.client.get("/messages/new")
+                self.assertEqual(resp.status_code, 200)
+
+    def test_classes_separate(self):
+        """Each route class has its own bucket"""
+
+        with patch.dict(admission.limits, {'message': (1, 1 / 60)}):
+            self.client.post("/messages/new", data={"text": "post"})
+
+            resp = self.client.post(f"/users/follow/{self.u1_id}")
+            self.assertNotEqual(resp.status_code, 429)
@@ -0,0 +1,75 @@
+"""App factory tests.
+
+Startup time is checked against its budget by benchmarks/startup.py.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_app_factory.py
+import os
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import create_app
+from unittest import TestCase
+
+import invalidation
+import likes
+from admission import admission
+from benchmarks.startup import run_python
+from follow_graph import follow_graph
+from profiling import profiler
+from replicas import replicas
+from shards import shards
+
+SINGLETONS = [admission, profiler, shards, replicas, follow_graph,
+              likes.buffer, invalidation.bus]
+
+NO_SIDE_EFFECTS = """
+import os, sys
+os.environ.pop('DATABASE_URL', None)
+os.environ.pop('SECRET_KEY', None)
+import app
+assert 'app' not in vars(app), 'an app was created'
+assert 'flask_debugtoolbar' not in sys.modules, 'the toolbar was imported'
+print('ok')
+"""
+
+TOOLBAR_LOADED = """
+import sys
+from app import create_app
+create_app(%r)
+print('flask_debugtoolbar' in sys.modules)
+"""
+
+
+class AppFactoryTestCase(TestCase):
+    def test_import_has_no_side_effects(self):
+        """Importing app reads no config and creates no app"""
+
+        self.assertEqual(run_python(NO_SIDE_EFFECTS).strip(), "ok")
+
+    def test_profiles(self):
+        """Only the development profile loads the debug toolbar"""
+
+        for profile in ('production', 'benchmark'):
+            self.assertFalse(create_app(profile).config['DEBUG_TOOLBAR'])
+            loaded = run_python(TOOLBAR_LOADED % profile).strip()
+            self.assertEqual(loaded, "False")
+
+        loaded = run_python(TOOLBAR_LOADED % 'development').strip()
+        self.assertEqual(loaded, "True")
+
+    def test_singletons_configured_once(self):
+        """A second app shares the first one's routers and buffers"""
+
+        create_app('benchmark')
+        bound = [(singleton.app, getattr(singleton, 'engines', None))
+                 for singleton in SINGLETONS]
+
+        create_app('production')
+
+        self.assertEqual(
+            [(singleton.app, getattr(singleton, 'engines', None))
+             for singleton in SINGLETONS],
+            bound)
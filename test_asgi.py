@@ -0,0 +1,131 @@
+"""ASGI serving mode tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+import os
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from unittest import TestCase
+import asyncio
+
+from asgi import WarblerASGI, async_requests
+from async_db import TWINS, create_twins, dispose_twins
+from models import db, User
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+async def call(asgi, path, method="GET", user_id=None):
+    """Send one request to `asgi`; return (status, body text)."""
+
+    headers = []
+
+    if user_id is not None:
+        cookie = app.session_interface.get_signing_serializer(app).dumps(
+            {CURR_USER_KEY: user_id})
+        headers.append((b"cookie", f"session={cookie}".encode()))
+
+    scope = {
+        'type': 'http', 'http_version': '1.1', 'method': method,
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+        'root_path': '', 'query_string': b'', 'headers': headers,
+        'server': ('localhost', 80), 'client': ('127.0.0.1', 1234),
+    }
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi(scope, receive, send)
+
+    body = b''.join(m.get('body', b'') for m in sent[1:])
+    return sent[0]['status'], body.decode()
+
+
+class ASGITestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        create_twins([db.engine], app.config)
+        self.asgi = WarblerASGI(app)
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+
+    def run_requests(self, *requests):
+        """Send `requests` concurrently; return their (status, body)s."""
+
+        async def run():
+            try:
+                return await asyncio.gather(
+                    *(call(self.asgi, *request) for request in requests))
+            finally:
+                await dispose_twins()
+
+        return asyncio.run(run())
+
+    def test_routing(self):
+        """Only GETs of the hot read pages run on the event loop"""
+
+        def runs_async(method, path):
+            return self.asgi.runs_async({'method': method, 'path': path})
+
+        self.assertTrue(runs_async("GET", "/"))
+        self.assertTrue(runs_async("GET", "/users/1/followers"))
+        self.assertTrue(runs_async("HEAD", "/messages/1"))
+        self.assertFalse(runs_async("GET", "/login"))
+        self.assertFalse(runs_async("POST", "/messages/new"))
+        self.assertFalse(runs_async("GET", "/no-such-page"))
+
+    def test_async_page_uses_async_driver(self):
+        """Hot pages read through the asyncpg engine"""
+
+        pool = TWINS[db.engine].sync_engine.pool
+        checkouts = pool.checkouts
+        served = async_requests.get()
+
+        [(status, html)] = self.run_requests(("/", "GET", self.u1_id))
+
+        self.assertEqual(status, 200)
+        self.assertIn('alt="u1"', html)
+        self.assertGreater(pool.checkouts, checkouts)
+        self.assertEqual(async_requests.get(), served + 1)
+
+    def test_concurrent_requests_isolated(self):
+        """Concurrent requests on one event loop keep their own user"""
+
+        responses = self.run_requests(
+            *[(f"/users/{self.u1_id}", "GET", user_id)
+              for user_id in (self.u1_id, self.u2_id) * 3])
+
+        for (status, html), (user, other) in zip(
+                responses, [("u1", "u2"), ("u2", "u1")] * 3):
+            self.assertEqual(status, 200)
+            self.assertIn(f'alt="{user}">', html)
+            self.assertNotIn(f'alt="{other}">', html)
+
+    def test_other_routes_threaded(self):
+        """Everything else is served by the sync app"""
+
+        [(status, html)] = self.run_requests(("/login",))
+
+        self.assertEqual(status, 200)
+        self.assertIn("Welcome back.", html)
@@ -0,0 +1,119 @@
+"""Batch write API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_batch_api.py
+import os
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, Follow, MessageTag
+from follow_graph import follow_graph
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class BatchAPITestCase(TestCase):
+    def setUp(self):
+        MessageTag.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        users = [
+            User.signup(f"u{n}", f"u{n}@email.com", "password", None)
+            for n in range(3)
+        ]
+        db.session.commit()
+
+        self.user_ids = [user.id for user in users]
+
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_ids[0]
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_messages(self):
+        """Valid messages are written in order; invalid ones get errors"""
+
+        resp = self.client.post("/api/messages/batch", json={"messages": [
+            {"text": "first #batch"},
+            {"text": ""},
+            {"text": "x" * 141},
+            {"nope": 1},
+            {"text": "second"},
+        ]})
+        results = resp.json['results']
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([result['ok'] for result in results],
+                         [True, False, False, False, True])
+        self.assertIn('text', results[2]['errors'])
+
+        self.assertEqual(db.session.get(Message, results[0]['id']).text,
+                         "first #batch")
+        self.assertEqual(db.session.get(Message, results[4]['id']).text,
+                         "second")
+        self.assertEqual(Message.query.count(), 2)
+        self.assertEqual(MessageTag.query.one().tag, "batch")
+
+    def test_follows(self):
+        """Follows are written together, with a status for each target"""
+
+        u0, u1, u2 = self.user_ids
+        db.session.add(Follow(user_being_followed_id=u2, user_following_id=u0))
+        db.session.commit()
+
+        resp = self.client.post("/api/follows/batch", json={
+            "user_ids": [u1, u2, u0, 999_999, "x", u1]})
+
+        self.assertEqual(
+            [result['status'] for result in resp.json['results']],
+            ["followed", "already_following", "invalid", "not_found",
+             "invalid", "already_following"])
+        self.assertEqual(
+            {follow.user_being_followed_id for follow in
+             Follow.query.filter_by(user_following_id=u0)},
+            {u1, u2})
+        self.assertTrue(follow_graph.follows(u0, u1))
+
+    def test_too_many(self):
+        """Calls with more than BATCH_MAX_ITEMS items are refused"""
+
+        with patch('app.BATCH_MAX_ITEMS', 2):
+            resp = self.client.post("/api/messages/batch", json={
+                "messages": [{"text": "a"}] * 3})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(Message.query.count(), 0)
+
+    def test_json_only(self):
+        """Form posts, and bodies without the list, are refused"""
+
+        resp = self.client.post("/api/messages/batch",
+                                data={"messages": "a"})
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.post("/api/follows/batch", json=[1, 2])
+        self.assertEqual(resp.status_code, 400)
+
+    def test_logged_out(self):
+        """The API needs a logged in user"""
+
+        with self.client.session_transaction() as sess:
+            del sess[CURR_USER_KEY]
+
+        resp = self.client.post("/api/messages/batch", json={"messages": []})
+
+        self.assertEqual(resp.status_code, 401)
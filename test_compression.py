@@ -0,0 +1,146 @@
+"""Response compression tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_compression.py
+import gzip
+import os
+import shutil
+import tempfile
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from unittest import TestCase
+from unittest.mock import patch
+
+from compression import precompress_static
+from models import db, User, Message
+from shards import shards
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+GZIP = {'Accept-Encoding': 'gzip, deflate'}
+
+
+class CompressionTestCase(TestCase):
+    def setUp(self):
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        for n in range(20):
+            shards.add_message(self.u1_id, f"post number {n}")
+        shards.commit()
+
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_compresses_pages(self):
+        """Pages are gzipped for clients that accept it"""
+
+        plain = self.client.get("/")
+        resp = self.client.get("/", headers=GZIP)
+
+        self.assertEqual(resp.content_encoding, "gzip")
+        self.assertIn("Accept-Encoding", resp.vary)
+        self.assertEqual(gzip.decompress(resp.get_data()), plain.get_data())
+        self.assertLess(resp.content_length, plain.content_length / 2)
+
+        self.assertIsNone(plain.content_encoding)
+        self.assertIn("Accept-Encoding", plain.vary)
+
+    def test_refused_gzip(self):
+        """gzip;q=0 means the client doesn't accept it"""
+
+        resp = self.client.get("/", headers={'Accept-Encoding': 'gzip;q=0'})
+
+        self.assertIsNone(resp.content_encoding)
+
+    def test_min_size(self):
+        """Responses under COMPRESS_MIN_SIZE are sent as they are"""
+
+        with patch.dict(app.config, {'COMPRESS_MIN_SIZE': 10_000_000}):
+            resp = self.client.get("/", headers=GZIP)
+
+        self.assertIsNone(resp.content_encoding)
+
+    def test_streamed_not_compressed(self):
+        """Streamed responses, like the data export, are left alone"""
+
+        resp = self.client.get(f"/users/{self.u1_id}/export", headers=GZIP)
+
+        self.assertIsNone(resp.content_encoding)
+        self.assertIn("post number 19", resp.get_data(as_text=True))
+
+
+class StaticTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.old_static_folder = app.static_folder
+        app.static_folder = self.directory
+
+        with open(os.path.join(self.directory, "style.css"), "w") as file:
+            file.write("body { margin: 0; }\n" * 100)
+
+        with open(os.path.join(self.directory, "logo.png"), "wb") as file:
+            file.write(b"not really a png")
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.static_folder = self.old_static_folder
+        shutil.rmtree(self.directory)
+
+    def test_precompress(self):
+        """Compressible files get a .gz, once"""
+
+        written = precompress_static(self.directory)
+
+        self.assertEqual(
+            written, [os.path.join(self.directory, "style.css.gz")])
+        self.assertEqual(precompress_static(self.directory), [])
+
+    def test_serves_precompressed(self):
+        """The .gz is sent to clients that accept gzip"""
+
+        precompress_static(self.directory)
+
+        resp = self.client.get("/static/style.css", headers=GZIP)
+
+        self.assertEqual(resp.content_encoding, "gzip")
+        self.assertEqual(resp.mimetype, "text/css")
+        self.assertEqual(gzip.decompress(resp.get_data()),
+                         b"body { margin: 0; }\n" * 100)
+        self.assertFalse(resp.cache_control.no_store)
+        resp.close()
+
+        resp = self.client.get("/static/style.css")
+
+        self.assertIsNone(resp.content_encoding)
+        self.assertEqual(resp.get_data(), b"body { margin: 0; }\n" * 100)
+        resp.close()
+
+    def test_stale_precompressed(self):
+        """A .gz older than its file isn't sent"""
+
+        precompress_static(self.directory)
+        path = os.path.join(self.directory, "style.css")
+        os.utime(path + ".gz", (0, 0))
+
+        resp = self.client.get("/static/style.css", headers=GZIP)
+
+        self.assertIsNone(resp.content_encoding)
+        resp.close()
\ No newline at end of file
@@ -0,0 +1,137 @@
+"""Data export tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_export.py
+import csv
+import io
+import json
+import os
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from unittest import TestCase
+from unittest.mock import patch
+
+import export
+from models import db, User, Message, Like, Follow
+from shards import shards
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id, self.u2_id, self.u3_id = u1.id, u2.id, u3.id
+
+        self.message_ids = [
+            shards.add_message(self.u1_id, f"post {n}") for n in range(3)]
+        liked_id = shards.add_message(self.u2_id, "liked")
+        shards.commit()
+
+        shards.toggle_like(self.u1_id, shards.get_message_or_404(liked_id))
+        db.session.add_all([
+            Follow(user_being_followed_id=self.u2_id,
+                   user_following_id=self.u1_id),
+            Follow(user_being_followed_id=self.u1_id,
+                   user_following_id=self.u3_id),
+        ])
+        shards.commit()
+
+        self.liked_id = liked_id
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def export(self, **query):
+        resp = self.client.get(f"/users/{self.u1_id}/export",
+                               query_string=query)
+        self.assertEqual(resp.status_code, 200)
+        return resp
+
+    def test_ndjson(self):
+        """The export has messages, likes, following and followers"""
+
+        resp = self.export()
+        records = [json.loads(line) for line in resp.get_data(as_text=True)
+                   .splitlines()]
+
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        self.assertEqual(
+            [(record['type'], record['id']) for record in records],
+            [('message', message_id) for message_id in self.message_ids]
+            + [('like', self.liked_id),
+               ('following', self.u2_id),
+               ('follower', self.u3_id)])
+        self.assertEqual(records[0]['text'], "post 0")
+        self.assertEqual(records[-1]['username'], "u3")
+
+    def test_resume(self):
+        """Passing a record's cursor resumes after it"""
+
+        records = [json.loads(line) for line in
+                   self.export().get_data(as_text=True).splitlines()]
+
+        for n, record in enumerate(records):
+            resumed = [
+                json.loads(line) for line in
+                self.export(after=record['cursor']).get_data(
+                    as_text=True).splitlines()]
+
+            self.assertEqual(resumed, records[n + 1:])
+
+    def test_csv(self):
+        """CSV has a header and a row per record"""
+
+        resp = self.export(format="csv")
+        rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+
+        self.assertEqual(resp.mimetype, "text/csv")
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[1]['text'], "post 1")
+        self.assertEqual(rows[1]['username'], "")
+
+    def test_streamed_in_batches(self):
+        """Records are yielded as they are read, a batch at a time"""
+
+        with patch('export.EXPORT_BATCH_SIZE', 2):
+            lines = export.export_lines(shards, self.u1_id)
+            first = json.loads(next(lines))
+
+        self.assertEqual(first['id'], self.message_ids[0])
+        lines.close()
+
+    def test_bad_requests(self):
+        """Bad formats and cursors are rejected"""
+
+        for query in ({"format": "xml"}, {"after": "nope"},
+                      {"after": "secrets:0:1"}):
+            resp = self.client.get(f"/users/{self.u1_id}/export",
+                                   query_string=query)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_only_own_data(self):
+        """Users can't export someone else's data"""
+
+        resp = self.client.get(f"/users/{self.u2_id}/export")
+
+        self.assertEqual(resp.status_code, 302)
@@ -0,0 +1,170 @@
+"""Follow graph index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follow_graph.py
+import fcntl
+import os
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from unittest import TestCase
+from tempfile import TemporaryDirectory
+
+from follow_graph import FollowGraph, follow_graph, write_snapshot
+from models import db, User, Follow
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class FollowGraphTestCase(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "graph.bin")
+
+        self.graph = FollowGraph()
+        self.graph.path = self.path
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_snapshot_lookups(self):
+        """Follows and neighbor lists come from the mapped snapshot"""
+
+        write_snapshot(self.path, [(1, 3), (1, 2), (2, 3), (5, 1)])
+        self.graph.refresh(force=True)
+
+        self.assertTrue(self.graph.follows(1, 3))
+        self.assertFalse(self.graph.follows(3, 1))
+        self.assertFalse(self.graph.follows(99, 1))
+        self.assertEqual(self.graph.following(1), [2, 3])
+        self.assertEqual(self.graph.followers(3), [1, 2])
+        self.assertEqual(self.graph.followers(4), [])
+        self.assertEqual(self.graph.follower_count(3), 2)
+        self.assertEqual(self.graph.follower_count(99), 0)
+
+    def test_deltas(self):
+        """This process's follows and unfollows apply immediately"""
+
+        write_snapshot(self.path, [(1, 2)], built_at=0)
+        self.graph.refresh(force=True)
+
+        self.graph.add(1, 3)
+        self.graph.remove(1, 2)
+
+        self.assertTrue(self.graph.follows(1, 3))
+        self.assertFalse(self.graph.follows(1, 2))
+        self.assertEqual(self.graph.following(1), [3])
+        self.assertEqual(self.graph.followers(3), [1])
+        self.assertEqual(self.graph.follower_count(3), 1)
+        self.assertEqual(self.graph.follower_count(2), 0)
+
+        # Re-adding a follow the snapshot already has doesn't count twice.
+        self.graph.add(1, 2)
+        self.assertEqual(self.graph.follower_count(2), 1)
+
+    def test_newer_snapshot_replaces_deltas(self):
+        """Deltas older than a new snapshot are dropped"""
+
+        self.graph.add(1, 2)
+        write_snapshot(self.path, [(1, 3)])
+        self.graph.refresh(force=True)
+
+        self.assertFalse(self.graph.follows(1, 2))
+        self.assertEqual(self.graph.following(1), [3])
+
+
+class FollowGraphViewTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        self.directory = TemporaryDirectory()
+        app.config['FOLLOW_GRAPH_PATH'] = os.path.join(
+            self.directory.name, "graph.bin")
+        follow_graph.init_app(app)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['FOLLOW_GRAPH_PATH'] = None
+        follow_graph.init_app(app)
+        self.directory.cleanup()
+
+    def test_built_on_first_use(self):
+        """With no snapshot yet, the first lookup builds one in the
+        background, and the graph is empty until it's mapped"""
+
+        db.session.add(Follow(
+            user_following_id=self.u1_id, user_being_followed_id=self.u2_id))
+        db.session.commit()
+
+        self.assertEqual(follow_graph.following(self.u1_id), [])
+
+        follow_graph.rebuild_thread.join()
+        self.assertTrue(os.path.exists(follow_graph.path))
+
+        follow_graph.refresh(force=True)
+        self.assertEqual(follow_graph.following(self.u1_id), [self.u2_id])
+
+    def test_missing_snapshot_built_once(self):
+        """Another process holding the lock builds the missing snapshot"""
+
+        with open(follow_graph.path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            self.assertEqual(follow_graph.following(self.u1_id), [])
+            follow_graph.rebuild_thread.join()
+
+        self.assertFalse(os.path.exists(follow_graph.path))
+
+    def test_missing_snapshot_built_before_fork(self):
+        """Warm-up builds a missing snapshot in place, even when stale ones
+        aren't rebuilt"""
+
+        thread = follow_graph.rebuild_thread
+        follow_graph.max_age = 0
+        follow_graph.rebuild_if_stale(wait=True)
+
+        self.assertTrue(os.path.exists(follow_graph.path))
+        self.assertIs(follow_graph.rebuild_thread, thread)
+
+    def test_stale_snapshot_rebuilt(self):
+        """A snapshot older than its max age is rebuilt in the background"""
+
+        write_snapshot(follow_graph.path, [], built_at=0)
+        db.session.add(Follow(
+            user_following_id=self.u1_id, user_being_followed_id=self.u2_id))
+        db.session.commit()
+
+        follow_graph.refresh(force=True)
+        self.assertEqual(follow_graph.following(self.u1_id), [])
+
+        follow_graph.rebuild_thread.join()
+        follow_graph.refresh(force=True)
+
+        self.assertEqual(follow_graph.following(self.u1_id), [self.u2_id])
+
+    def test_follow_routes_update_graph(self):
+        """Following and unfollowing update the index"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/users/follow/{self.u2_id}")
+            self.assertTrue(follow_graph.follows(self.u1_id, self.u2_id))
+
+            c.post(f"/users/stop-following/{self.u2_id}")
+            self.assertFalse(follow_graph.follows(self.u1_id, self.u2_id))
@@ -0,0 +1,154 @@
+"""Hashtag and mention tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_hashtags.py
+import os
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from unittest import TestCase
+from unittest.mock import patch
+
+import hashtags
+from models import db, User, Message, MessageTag, Mention
+from shards import shards
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class ExtractTestCase(TestCase):
+    def test_extract_tags(self):
+        """Tags are lowercased and deduplicated; a#b isn't a tag"""
+
+        self.assertEqual(
+            hashtags.extract_tags("#Flask and #flask, a#b, ##x #sql_2"),
+            ["flask", "sql_2"])
+
+    def test_extract_mentions(self):
+        """Mentions are deduplicated; emails aren't mentions"""
+
+        self.assertEqual(
+            hashtags.extract_mentions("@u1 hi @u2 me@u3.com @u1"),
+            ["u1", "u2"])
+
+    def test_link_hashtags(self):
+        """Hashtags become links and the rest is escaped"""
+
+        self.assertEqual(
+            str(hashtags.link_hashtags("it's <b>#Big</b>")),
+            'it&#39;s &lt;b&gt;<a href="/tags/big">#Big</a>&lt;/b&gt;')
+
+
+class HashtagTestCase(TestCase):
+    def setUp(self):
+        MessageTag.query.delete()
+        Mention.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_add_message_indexes(self):
+        """Writing a message stores its tags and mentions"""
+
+        message_id = shards.add_message(
+            self.u1_id, "#Hello @u2 and @nobody #world")
+        shards.commit()
+
+        self.assertEqual(
+            {row.tag for row in MessageTag.query.filter_by(
+                message_id=message_id)},
+            {"hello", "world"})
+        self.assertEqual(
+            [row.user_id for row in Mention.query.filter_by(
+                message_id=message_id)],
+            [self.u2_id])
+
+    def test_delete_message_unindexes(self):
+        """Deleting a message deletes its tags and mentions"""
+
+        message_id = shards.add_message(self.u1_id, "#gone @u2")
+        shards.commit()
+        shards.delete_message(shards.get_message_or_404(message_id))
+        shards.commit()
+
+        self.assertEqual(MessageTag.query.count(), 0)
+        self.assertEqual(Mention.query.count(), 0)
+
+    def test_tag_pages(self):
+        """The tag page lists tagged messages newest first, a page at a time"""
+
+        for n in range(3):
+            shards.add_message(self.u2_id, f"#Python number {n}")
+        shards.add_message(self.u2_id, "untagged")
+        shards.commit()
+
+        with patch('app.PAGE_SIZE', 2):
+            html = self.client.get("/tags/PYTHON").get_data(as_text=True)
+
+            self.assertIn("number 2", html)
+            self.assertIn("number 1", html)
+            self.assertNotIn("number 0", html)
+            self.assertNotIn("untagged", html)
+            self.assertIn('<a href="/tags/python">#Python</a>', html)
+
+            message_id = Message.query.filter_by(
+                text="#Python number 1").one().id
+            timestamp = db.session.get(MessageTag, ("python", message_id)).timestamp
+
+            html = self.client.get(
+                "/tags/python",
+                query_string={"before": timestamp.isoformat(),
+                              "before_id": message_id},
+            ).get_data(as_text=True)
+
+            self.assertIn("number 0", html)
+            self.assertNotIn("number 1", html)
+
+    def test_mentions_page(self):
+        """The mentions page lists messages mentioning the user"""
+
+        shards.add_message(self.u2_id, "hello @u1")
+        shards.add_message(self.u2_id, "hello nobody")
+        shards.commit()
+
+        html = self.client.get(
+            f"/users/{self.u1_id}/mentions").get_data(as_text=True)
+
+        self.assertIn("hello @u1", html)
+        self.assertNotIn("hello nobody", html)
+
+    def test_backfill(self):
+        """Backfill indexes messages written without tags, and can rerun"""
+
+        db.session.add_all([
+            Message(text="old #Tag for @u2", user_id=self.u1_id),
+            Message(text="plain", user_id=self.u1_id),
+        ])
+        db.session.commit()
+
+        with patch('hashtags.BACKFILL_BATCH_SIZE', 1):
+            self.assertEqual(hashtags.backfill(shards), 2)
+            self.assertEqual(hashtags.backfill(shards), 2)
+
+        self.assertEqual([row.tag for row in MessageTag.query], ["tag"])
+        self.assertEqual([row.user_id for row in Mention.query], [self.u2_id])
@@ -0,0 +1,209 @@
+"""Image pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+import os
+import shutil
+import socket
+import tempfile
+from io import BytesIO
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY, enqueue_image_ingest
+from unittest import TestCase
+from unittest.mock import patch
+from urllib.request import Request
+
+from PIL import Image
+
+import images
+import jobs
+from models import db, User, Job
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+def png_bytes(size=(640, 480), color="red"):
+    buffer = BytesIO()
+    Image.new("RGB", size, color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class ImageTestCase(TestCase):
+    def setUp(self):
+        Job.query.delete()
+        User.query.delete()
+
+        # Local files only: the app's own /static/ files are read from disk.
+        u1 = User.signup("u1", "u1@email.com", "password",
+                         "/static/images/default-pic.png")
+        u1.header_image_url = "/static/images/warbler-hero.jpg"
+        db.session.flush()
+        enqueue_image_ingest(u1)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        self.directory = tempfile.mkdtemp()
+        self.old_directory = app.config.get('IMAGE_CACHE_DIR')
+        app.config['IMAGE_CACHE_DIR'] = self.directory
+
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['IMAGE_CACHE_DIR'] = self.old_directory
+        shutil.rmtree(self.directory)
+
+    def test_ingest(self):
+        """Each variant is stored at its size, once per image"""
+
+        data = png_bytes()
+        digest = images.ingest(data)
+
+        for variant, size in images.VARIANTS.items():
+            path = os.path.join(self.directory,
+                                images.variant_name(digest, variant))
+            with Image.open(path) as image:
+                self.assertEqual(image.size, size)
+                self.assertEqual(image.format, "WEBP")
+
+        self.assertEqual(images.ingest(data), digest)
+        self.assertEqual(len(os.listdir(self.directory)), len(images.VARIANTS))
+        self.assertNotEqual(images.ingest(png_bytes(color="blue")), digest)
+
+    def test_bad_images(self):
+        """Unreadable images and unfetchable URLs raise ImageError"""
+
+        with self.assertRaises(images.ImageError):
+            images.ingest(b"not an image")
+
+        for url in ("/static/../app.py", "/static/images/missing.png",
+                    "file:///etc/passwd"):
+            with self.assertRaises(images.ImageError):
+                images.fetch(url)
+
+    def test_internal_addresses_refused(self):
+        """URLs and redirects to non-public addresses aren't fetched"""
+
+        for url in ("http://127.0.0.1:5432/", "http://localhost/x.png",
+                    "http://169.254.169.254/latest/meta-data/",
+                    "http://10.0.0.1/x.png", "http://[::1]/x.png",
+                    "http://[::ffff:192.168.0.1]/x.png"):
+            with patch('images.build_opener') as build_opener:
+                with self.assertRaises(images.ImageError):
+                    images.fetch(url)
+
+            build_opener.assert_not_called()
+
+        # Each redirect is checked as it's opened.
+        with self.assertRaises(images.ImageError):
+            images.PublicHTTPHandler().http_open(
+                Request("http://169.254.169.254/"))
+
+    def test_connects_to_checked_address(self):
+        """The connection goes to the address checked, not a fresh lookup,
+        and still names the host"""
+
+        public = [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                   ('93.184.216.34', 443))]
+        rebound = [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                    ('127.0.0.1', 443))]
+        connected = []
+
+        def create_connection(address, *args):
+            connected.append(address)
+            raise OSError("no network in tests")
+
+        with patch('socket.getaddrinfo', side_effect=[public, public, rebound]), \
+                patch('socket.create_connection', create_connection):
+            with self.assertRaises(images.ImageError):
+                images.fetch("https://images.example.com/a.png")
+
+        self.assertEqual(connected, [('93.184.216.34', 443)])
+
+        connection = images.PinnedHTTPSConnection(
+            "images.example.com", address='93.184.216.34')
+        self.assertEqual(connection.host, "images.example.com")
+        self.assertEqual(connection.port, 443)
+
+    def test_templates_use_variants(self):
+        """Templates use the original URL until the job ingests the images,
+        then the variants"""
+
+        resp = self.client.get(f"/users/{self.u1_id}")
+        self.assertIn('src="/static/images/default-pic.png"', resp.text)
+
+        self.assertEqual(jobs.run_pending(), 1)
+
+        user = db.session.get(User, self.u1_id)
+        self.assertIsNotNone(user.image_digest)
+        self.assertIsNotNone(user.header_image_digest)
+
+        resp = self.client.get(f"/users/{self.u1_id}")
+        self.assertIn(
+            f'src="/images/{images.variant_name(user.image_digest, "card")}"',
+            resp.text)
+        self.assertIn(
+            f"url('/images/"
+            f"{images.variant_name(user.header_image_digest, 'hero')}')",
+            resp.text)
+
+    def test_profile_change_reingests(self):
+        """Changing an image clears its digest and queues another job"""
+
+        jobs.run_pending()
+        data = png_bytes(color="green")
+
+        resp = self.client.post("/users/profile", data={
+            "username": "u1", "email": "u1@email.com", "password": "password",
+            "image_url": "https://example.com/new.png",
+            "header_image_url": "https://example.com/hero.png"})
+        self.assertEqual(resp.status_code, 302)
+
+        user = db.session.get(User, self.u1_id)
+        self.assertIsNone(user.image_digest)
+
+        with patch('images.fetch', return_value=data):
+            self.assertEqual(jobs.run_pending(), 1)
+
+        db.session.refresh(user)
+        self.assertEqual(user.image_digest, images.ingest(data))
+
+    def test_signup_queues_ingest(self):
+        """Signing up queues the ingest job"""
+
+        resp = self.client.post("/signup", data={
+            "username": "u2", "email": "u2@email.com", "password": "password"})
+        self.assertEqual(resp.status_code, 302)
+
+        user = User.query.filter_by(username="u2").one()
+        self.assertEqual(
+            Job.query.filter_by(kind='ingest_user_images').count(), 2)
+        self.assertIn(user.id, [
+            job.payload['user_id'] for job in
+            Job.query.filter_by(kind='ingest_user_images')])
+
+    def test_serve(self):
+        """Variants are served with long-lived, immutable cache headers"""
+
+        name = images.variant_name(images.ingest(png_bytes()), 'thumb')
+
+        resp = self.client.get(f"/images/{name}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "image/webp")
+        self.assertTrue(resp.cache_control.immutable)
+        self.assertEqual(resp.cache_control.max_age, images.CACHE_SECONDS)
+        self.assertFalse(resp.cache_control.no_store)
+
+        self.assertEqual(self.client.get("/images/nope.webp").status_code, 404)
+        self.assertTrue(self.client.get("/").cache_control.no_store)
@@ -0,0 +1,197 @@
+"""Invalidation bus tests, against the local test database."""
+
+# run these tests like:
+#
+#    python -m unittest test_invalidation.py
+import os
+import time
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from unittest import TestCase
+from unittest.mock import patch
+
+import invalidation
+import jobs
+import recommendations
+from models import db, User, Message, Suggestion, Job
+from pooling import direct_engine
+from shards import shards
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+def wait_for(condition, seconds=5):
+    """Wait until `condition()` is true; return whether it became true."""
+
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+
+    return False
+
+
+class BusTestCase(TestCase):
+    def setUp(self):
+        # Another worker's bus, listening on its own connection
+        self.other = invalidation.InvalidationBus()
+        self.other.engine = direct_engine(app.config)
+        self.other.ensure_listening()
+
+        self.assertTrue(wait_for(lambda: self.other.connected_since))
+
+    def tearDown(self):
+        self.other.stop()
+        self.other.engine.dispose()
+        db.session.rollback()
+
+    def test_publish_reaches_other_workers(self):
+        """A committed publish bumps the key in every listening worker"""
+
+        stamp = self.other.stamp("user:1")
+        self.assertTrue(self.other.fresh("user:1", stamp))
+
+        invalidation.bus.publish('user', 1)
+        db.session.commit()
+
+        self.assertTrue(
+            wait_for(lambda: not self.other.fresh("user:1", stamp)))
+        self.assertTrue(self.other.fresh("user:2", self.other.stamp("user:2")))
+
+    def test_rolled_back_publish(self):
+        """A rolled back publish invalidates nothing"""
+
+        stamp = invalidation.bus.stamp("user:1")
+        other_stamp = self.other.stamp("user:1")
+
+        invalidation.bus.publish('user', 1)
+        db.session.rollback()
+
+        # A later notification shows the first one would have arrived.
+        invalidation.bus.publish('user', 2)
+        db.session.commit()
+        self.assertTrue(wait_for(
+            lambda: self.other.version("user:2") != (0, 0)))
+
+        self.assertTrue(invalidation.bus.fresh("user:1", stamp))
+        self.assertTrue(self.other.fresh("user:1", other_stamp))
+
+    def test_publisher_bumps_on_commit(self):
+        """The publishing worker's own entries go stale on commit"""
+
+        stamp = invalidation.bus.stamp("message:7")
+
+        invalidation.bus.publish('message', 7)
+        self.assertTrue(invalidation.bus.fresh("message:7", stamp))
+
+        db.session.commit()
+        self.assertFalse(invalidation.bus.fresh("message:7", stamp))
+
+    def test_fallback_ttl(self):
+        """Without the listener entries expire after FALLBACK_TTL_SECONDS"""
+
+        stamp = self.other.stamp("user:1")
+        self.other.stop()
+
+        self.assertIsNone(self.other.connected_since)
+        self.assertTrue(self.other.fresh("user:1", stamp))
+
+        with patch('invalidation.time.monotonic',
+                   return_value=stamp.loaded_at
+                   + invalidation.FALLBACK_TTL_SECONDS):
+            self.assertFalse(self.other.fresh("user:1", stamp))
+
+    def test_reconnect(self):
+        """The listener reconnects after its connection is killed, and
+        entries loaded before then fall back to the TTL"""
+
+        stamp = self.other.stamp("user:1")
+
+        with patch('invalidation.RECONNECT_SECONDS', 0):
+            db.session.execute(db.text(
+                "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+                "WHERE query = 'LISTEN warbler_invalidate'"))
+            db.session.commit()
+
+            self.assertTrue(wait_for(lambda: self.other.connected_since
+                                     and self.other.connected_since
+                                     > stamp.loaded_at))
+
+        self.assertTrue(self.other.fresh("user:1", stamp))
+
+        with patch('invalidation.time.monotonic',
+                   return_value=stamp.loaded_at
+                   + invalidation.FALLBACK_TTL_SECONDS):
+            self.assertFalse(self.other.fresh("user:1", stamp))
+
+    def test_max_keys(self):
+        """Past MAX_KEYS keys every stamp goes stale"""
+
+        stamp = self.other.stamp("user:1")
+
+        with patch('invalidation.MAX_KEYS', 2):
+            for n in range(3):
+                self.other.bump(f"message:{n}")
+
+        self.assertFalse(self.other.fresh("user:1", stamp))
+
+
+class SuggestionInvalidationTestCase(TestCase):
+    def setUp(self):
+        Job.query.delete()
+        Suggestion.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        users = [
+            User.signup(f"u{n}", f"u{n}@email.com", "password", None)
+            for n in range(3)
+        ]
+        db.session.commit()
+
+        self.user_ids = [user.id for user in users]
+        recommendations.cache.entries.clear()
+
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_ids[0]
+
+    def tearDown(self):
+        db.session.rollback()
+        recommendations.cache.entries.clear()
+
+    def test_follow_invalidates_suggestions(self):
+        """The refresh a follow queues evicts the follower's cached
+        suggestions"""
+
+        u0, u1, _ = self.user_ids
+        recommendations.suggestions_for(u0)
+        self.assertIsNotNone(recommendations.cache.get(u0))
+
+        with patch.object(recommendations, 'REFRESH_SECONDS', 0.1):
+            self.client.post(f"/users/follow/{u1}")
+            time.sleep(0.2)
+
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertIsNone(recommendations.cache.get(u0))
+
+    def test_delete_message_publishes(self):
+        """Deleting a message publishes its key"""
+
+        message_id = shards.add_message(self.user_ids[0], "bye")
+        shards.commit()
+        stamp = invalidation.bus.stamp(f"message:{message_id}")
+
+        self.client.post(f"/messages/{message_id}/delete")
+
+        self.assertFalse(
+            invalidation.bus.fresh(f"message:{message_id}", stamp))
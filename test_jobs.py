@@ -0,0 +1,275 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+import os
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+import invalidation
+import jobs
+from metrics import render as render_metrics
+from models import db, User, Message, Like, Job
+from shards import shards
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+calls = []
+
+
+@jobs.handler('test_record')
+def record(value):
+    calls.append(value)
+
+
+@jobs.handler('test_fail')
+def fail():
+    raise RuntimeError("boom")
+
+
+class JobTestCase(TestCase):
+    def setUp(self):
+        Job.query.delete()
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        calls.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_enqueue_and_run(self):
+        """A committed job runs once and is marked done"""
+
+        jobs.enqueue('test_record', {'value': 1})
+        db.session.commit()
+
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(calls, [1])
+
+        job = Job.query.one()
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.attempts, 1)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_rolled_back_enqueue(self):
+        """A job enqueued in a rolled back transaction never runs"""
+
+        jobs.enqueue('test_record', {'value': 1})
+        db.session.rollback()
+
+        self.assertEqual(jobs.run_pending(), 0)
+
+    def test_idempotency_key(self):
+        """Enqueueing a key twice queues one job"""
+
+        jobs.enqueue('test_record', {'value': 1}, key="k")
+        jobs.enqueue('test_record', {'value': 2}, key="k")
+        db.session.commit()
+
+        jobs.run_pending()
+        self.assertEqual(calls, [1])
+
+    def test_unknown_kind(self):
+        """Enqueueing a kind with no handler is an error"""
+
+        with self.assertRaises(ValueError):
+            jobs.enqueue('nope')
+
+    def test_delay(self):
+        """A delayed job doesn't run before it's due"""
+
+        jobs.enqueue('test_record', {'value': 1}, delay=60)
+        db.session.commit()
+
+        self.assertEqual(jobs.run_pending(), 0)
+
+    def test_retry_then_fail(self):
+        """A failing job backs off between attempts, then fails"""
+
+        jobs.enqueue('test_fail')
+        db.session.commit()
+
+        with patch('jobs.RETRY_BASE_SECONDS', 0):
+            jobs.run_next()
+            job = Job.query.one()
+            self.assertEqual(job.status, 'queued')
+            self.assertIn("boom", job.last_error)
+
+            job.max_attempts = 2
+            db.session.commit()
+            jobs.run_next()
+
+        job = Job.query.one()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(jobs.run_pending(), 0)
+
+    def test_backoff(self):
+        """The first retry waits RETRY_BASE_SECONDS"""
+
+        jobs.enqueue('test_fail')
+        db.session.commit()
+
+        before = datetime.utcnow()
+        jobs.run_next()
+        job = Job.query.one()
+
+        self.assertGreaterEqual(
+            job.run_at, before + timedelta(seconds=jobs.RETRY_BASE_SECONDS))
+        self.assertEqual(jobs.run_pending(), 0)
+
+    def test_expired_lease(self):
+        """A job whose worker died is claimed again after LEASE_SECONDS"""
+
+        jobs.enqueue('test_record', {'value': 1})
+        db.session.commit()
+
+        job = jobs.claim_next()
+        self.assertEqual(jobs.run_pending(), 0)
+
+        job.started_at = datetime.utcnow() - timedelta(
+            seconds=jobs.LEASE_SECONDS + 1)
+        db.session.commit()
+
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(calls, [1])
+        self.assertEqual(Job.query.one().attempts, 2)
+
+    def test_prune(self):
+        """Old finished jobs are deleted; queued ones stay"""
+
+        jobs.enqueue('test_record', {'value': 1})
+        jobs.enqueue('test_record', {'value': 2}, delay=60)
+        db.session.commit()
+        jobs.run_pending()
+
+        Job.query.filter_by(status='done').update({
+            'finished_at': datetime.utcnow() - timedelta(
+                days=jobs.RETAIN_DAYS + 1)})
+        db.session.commit()
+        jobs.prune()
+
+        self.assertEqual([job.status for job in Job.query], ['queued'])
+
+    def test_metrics(self):
+        """/metrics shows queue depth by status and the lag"""
+
+        jobs.enqueue('test_record', {'value': 1})
+        db.session.commit()
+
+        text = render_metrics()
+        self.assertIn('warbler_jobs{status="queued"} 1', text)
+        self.assertIn('warbler_jobs_lag_seconds ', text)
+
+    def test_worker(self):
+        """The worker's threads run queued jobs until stopped"""
+
+        for value in range(3):
+            jobs.enqueue('test_record', {'value': value})
+        db.session.commit()
+
+        worker = jobs.Worker(app, threads=2)
+
+        with patch('jobs.POLL_SECONDS', 0.01):
+            worker.start()
+
+            for _ in range(500):
+                if len(calls) == 3:
+                    break
+                worker.stopping.wait(0.01)
+
+            worker.stop()
+
+        self.assertEqual(sorted(calls), [0, 1, 2])
+
+
+class DeleteUserJobTestCase(TestCase):
+    def setUp(self):
+        Job.query.delete()
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_delete_user(self):
+        """Deleting an account queues a job that deletes it and its data"""
+
+        message_id = shards.add_message(self.u1_id, "bye")
+        shards.commit()
+        shards.toggle_like(self.u2_id, shards.get_message_or_404(message_id))
+        shards.commit()
+
+        stamp = invalidation.bus.stamp(f"user:{self.u1_id}")
+
+        resp = self.client.post("/users/delete", follow_redirects=True)
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Your account is being deleted.", html)
+        self.assertEqual(Job.query.one().kind, 'delete_user')
+
+        # Caches keep the user until the job has deleted them.
+        self.assertEqual(
+            invalidation.bus.version(f"user:{self.u1_id}"), stamp.version)
+
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertNotEqual(
+            invalidation.bus.version(f"user:{self.u1_id}"), stamp.version)
+        self.assertIsNone(db.session.get(User, self.u1_id))
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(Like.query.count(), 0)
+
+        # Running it again, as after a lost lease, does nothing.
+        jobs.delete_user(self.u1_id)
+        shards.commit()
+        self.assertIsNotNone(db.session.get(User, self.u2_id))
+
+    def test_hidden_until_deleted(self):
+        """A user waiting for their delete job can't log in and isn't shown"""
+
+        message_id = shards.add_message(self.u1_id, "going soon")
+        shards.commit()
+
+        other = app.test_client()
+        with other.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u2_id
+
+        self.client.post("/users/delete")
+
+        self.assertTrue(db.session.get(User, self.u1_id).pending_deletion)
+        self.assertFalse(User.authenticate("u1", "password"))
+
+        resp = self.client.post(
+            "/login", data={'username': "u1", 'password': "password"})
+        self.assertIn("Invalid credentials.", resp.get_data(as_text=True))
+
+        self.assertEqual(other.get(f"/users/{self.u1_id}").status_code, 404)
+        self.assertEqual(other.get(f"/messages/{message_id}").status_code, 404)
+        self.assertNotIn("@u1", other.get("/users").get_data(as_text=True))
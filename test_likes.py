@@ -0,0 +1,300 @@
+"""Write-behind like tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_likes.py
+import os
+import tempfile
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import delete
+
+import likes
+import trending
+from models import db, User, Message, Like, MessageTag, Mention, ShardBucket
+from shards import shards, NUM_BUCKETS
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+shard_dir = tempfile.mkdtemp()
+SHARD_URLS = [f"sqlite:///{shard_dir}/shard1.db"]
+
+
+class WriteBehindTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        self.m1_id = shards.add_message(self.u1_id, "popular")
+        shards.commit()
+
+        likes.buffer.reset()
+        trending.counters.reset()
+        self.write_behind = patch.object(likes.buffer, 'enabled', True)
+        self.write_behind.start()
+
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u2_id
+
+    def tearDown(self):
+        self.write_behind.stop()
+        likes.buffer.reset()
+        trending.counters.reset()
+        db.session.rollback()
+
+    def message(self):
+        return shards.get_message_or_404(self.m1_id)
+
+    def test_toggles_coalesce(self):
+        """Toggles are buffered, and only their net change is written"""
+
+        for _ in range(3):
+            likes.toggle_like(self.u2_id, self.message())
+        likes.toggle_like(self.u1_id, self.message())
+        likes.toggle_like(self.u1_id, self.message())
+
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(len(likes.buffer.pending), 2)
+
+        likes.buffer.flush()
+        db.session.expire_all()
+
+        self.assertEqual(
+            [(like.user_id, like.message_id) for like in Like.query],
+            [(self.u2_id, self.m1_id)])
+        self.assertEqual(self.message().like_count, 1)
+        self.assertEqual(likes.buffer.pending, {})
+        self.assertEqual(trending.counters.pending[
+            (trending.current_hour(), self.m1_id)][1], 1)
+
+    def test_unlike_written_behind(self):
+        """A buffered unlike deletes the like and lowers the count"""
+
+        likes.toggle_like(self.u2_id, self.message())
+        likes.buffer.flush()
+        likes.toggle_like(self.u2_id, self.message())
+        likes.buffer.flush()
+        db.session.expire_all()
+
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(self.message().like_count, 0)
+
+    def test_own_view_immediate(self):
+        """The liker sees their like and its count before the flush"""
+
+        with patch.object(likes.buffer, 'flush_seconds', 60):
+            self.client.post(f"/messages/{self.m1_id}/like_or_unlike")
+            html = self.client.get(
+                f"/messages/{self.m1_id}").get_data(as_text=True)
+
+        self.assertIn("bi-star-fill", html)
+        self.assertIn("1 like", html)
+        self.assertEqual(Like.query.count(), 0)
+
+        # Showing it wrote nothing.
+        db.session.expire_all()
+        self.assertEqual(self.message().like_count, 0)
+
+    def test_own_view_on_other_workers(self):
+        """Another worker shows the liker their like from their session, and
+        writes their unlike of it"""
+
+        other = likes.LikeBuffer()
+        other.enabled = True
+
+        with patch.object(likes.buffer, 'flush_seconds', 60):
+            self.client.post(f"/messages/{self.m1_id}/like_or_unlike")
+
+        with patch.object(likes, 'buffer', other), \
+                patch.object(other, 'flush_seconds', 60):
+            html = self.client.get(
+                f"/messages/{self.m1_id}").get_data(as_text=True)
+
+            self.assertIn("bi-star-fill", html)
+            self.assertIn("1 like", html)
+
+            self.client.post(f"/messages/{self.m1_id}/like_or_unlike")
+            html = self.client.get(
+                f"/messages/{self.m1_id}").get_data(as_text=True)
+
+            self.assertNotIn("bi-star-fill", html)
+            self.assertNotIn("1 like", html)
+
+        likes.buffer.flush()
+        other.flush()
+        db.session.expire_all()
+
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(self.message().like_count, 0)
+
+    def test_session_forgets_flushed(self):
+        """Toggles older than SESSION_SECONDS aren't applied"""
+
+        with patch.object(likes.buffer, 'flush_seconds', 60):
+            self.client.post(f"/messages/{self.m1_id}/like_or_unlike")
+
+        likes.buffer.reset()
+
+        with patch.object(likes, 'SESSION_SECONDS', 0):
+            html = self.client.get(
+                f"/messages/{self.m1_id}").get_data(as_text=True)
+
+        self.assertNotIn("bi-star-fill", html)
+
+    def test_flushed_after_request(self):
+        """A request after flush_seconds writes the buffer"""
+
+        with patch.object(likes.buffer, 'flush_seconds', 0):
+            self.client.post(f"/messages/{self.m1_id}/like_or_unlike")
+
+        self.assertEqual(Like.query.count(), 1)
+
+    def test_concurrent_flushes_dont_drift(self):
+        """Two workers flushing the same like count it once"""
+
+        other = likes.LikeBuffer()
+        likes.toggle_like(self.u2_id, self.message())
+        other.toggle(self.u2_id, self.message())
+
+        likes.buffer.flush()
+        other.flush()
+        db.session.expire_all()
+
+        self.assertEqual(Like.query.count(), 1)
+        self.assertEqual(self.message().like_count, 1)
+
+    def test_deleted_message_skipped(self):
+        """Likes of messages deleted before the flush are dropped"""
+
+        likes.toggle_like(self.u2_id, self.message())
+        shards.delete_message(self.message())
+        shards.commit()
+
+        likes.buffer.flush()
+
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(likes.buffer.pending, {})
+
+    def test_failed_flush_kept(self):
+        """A failed flush keeps its likes buffered for the next one"""
+
+        likes.toggle_like(self.u2_id, self.message())
+
+        with patch.object(likes.LikeBuffer, '_flush_shard',
+                          side_effect=RuntimeError("down")):
+            with self.assertRaises(RuntimeError):
+                likes.buffer.flush()
+
+        self.assertEqual(len(likes.buffer.pending), 1)
+
+        likes.buffer.flush()
+        self.assertEqual(Like.query.count(), 1)
+
+
+class WriteBehindShardTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        ShardBucket.query.delete()
+        db.session.commit()
+
+        shards.configure(SHARD_URLS)
+        shards.create_tables()
+
+        session = shards.session(1)
+        for model in (Like, MessageTag, Mention, Message):
+            session.execute(delete(model))
+        session.commit()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        # u2's messages live on shard 1
+        shards.move_buckets({self.u2_id % NUM_BUCKETS: 1}, wait=0)
+
+        likes.buffer.reset()
+
+    def tearDown(self):
+        likes.buffer.reset()
+        db.session.rollback()
+        shards.remove_sessions()
+        shards.configure([])
+
+    def test_flush_to_shard(self):
+        """Likes of a message on another shard are flushed there"""
+
+        message_id = shards.add_message(self.u2_id, "on shard 1")
+        shards.commit()
+
+        with patch.object(likes.buffer, 'enabled', True):
+            likes.toggle_like(self.u1_id, shards.get_message_or_404(message_id))
+            likes.buffer.flush()
+
+            session = shards.session(1)
+            session.expire_all()
+            self.assertEqual(session.get(Like, (self.u1_id, message_id)).user_id,
+                             self.u1_id)
+            self.assertEqual(
+                shards.get_message_or_404(message_id).like_count, 1)
+
+            likes.toggle_like(self.u1_id, shards.get_message_or_404(message_id))
+            likes.buffer.flush()
+
+            session.expire_all()
+            self.assertEqual(
+                shards.get_message_or_404(message_id).like_count, 0)
+
+    def test_flush_while_moving(self):
+        """Likes of messages in a moving bucket stay buffered; the rest
+        are written"""
+
+        moving_id = shards.add_message(self.u2_id, "moving")
+        staying_id = shards.add_message(self.u1_id, "staying")
+        shards.commit()
+
+        with patch.object(likes.buffer, 'enabled', True):
+            for message_id in (moving_id, staying_id):
+                likes.toggle_like(
+                    self.u1_id if message_id == moving_id else self.u2_id,
+                    shards.get_message_or_404(message_id))
+
+            shards._set_bucket(self.u2_id % NUM_BUCKETS, 1, moving=True)
+            likes.buffer.flush()
+
+            self.assertEqual(list(likes.buffer.pending),
+                             [(self.u1_id, moving_id)])
+            self.assertEqual(likes.buffer.flushing, {})
+            self.assertEqual(
+                shards.get_message_or_404(staying_id).like_count, 1)
+
+            shards._set_bucket(self.u2_id % NUM_BUCKETS, 1, moving=False)
+            likes.buffer.flush()
+
+            self.assertEqual(likes.buffer.pending, {})
+            session = shards.session(1)
+            session.expire_all()
+            self.assertEqual(
+                shards.get_message_or_404(moving_id).like_count, 1)
@@ -6,9 +6,12 @@
 
 
 import os
+import re
+from html import unescape
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, Message, User
+from models import db, Message, User, Like
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -104,3 +107,85 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             self.assertIn(f'<img src="{m1.user.image_url}"', html)
 
 
+
+
+class MessageLikeViewTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        likers = [
+            User.signup(f"liker{i}", f"liker{i}@email.com", "password", None)
+            for i in range(3)
+        ]
+        db.session.commit()
+
+        self.liker_ids = [liker.id for liker in likers]
+
+    def like(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        return self.client.post(f"/messages/{self.m1_id}/like_or_unlike")
+
+    def test_like_count(self):
+        """Liking and unliking keep the message's like count"""
+
+        for user_id in self.liker_ids:
+            self.like(user_id)
+
+        self.like(self.liker_ids[0])
+
+        self.assertEqual(db.session.get(Message, self.m1_id).like_count, 2)
+        self.assertEqual(Like.query.filter_by(message_id=self.m1_id).count(), 2)
+
+        html = self.client.get(f"/messages/{self.m1_id}").get_data(as_text=True)
+        self.assertIn("2 likes", html)
+
+    def test_one_csrf_token_per_page(self):
+        """Every like button submits the page's one CSRF form"""
+
+        for n in range(5):
+            db.session.add(Message(text=f"more {n}", user_id=self.u1_id))
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.liker_ids[0]
+
+        with patch.dict(app.config, {'WTF_CSRF_ENABLED': True}):
+            html = self.client.get(f"/users/{self.u1_id}").get_data(
+                as_text=True)
+            tokens = re.findall(r'name="csrf_token"[^>]*value="([^"]*)"', html)
+
+            self.assertEqual(len(tokens), 1)
+            self.assertEqual(
+                html.count('form="csrf-form" formaction="/messages/'), 6)
+
+            self.client.post(f"/messages/{self.m1_id}/like_or_unlike")
+            self.assertEqual(Like.query.count(), 0)
+
+            self.client.post(f"/messages/{self.m1_id}/like_or_unlike",
+                             data={"csrf_token": tokens[0]})
+            self.assertEqual(Like.query.count(), 1)
+
+    def test_liked_by_pages(self):
+        """The liked-by page lists likers newest first, a page at a time"""
+
+        for user_id in self.liker_ids:
+            self.like(user_id)
+
+        with patch('app.PAGE_SIZE', 2):
+            resp = self.client.get(f"/messages/{self.m1_id}/likes")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@liker2", html)
+            self.assertIn("@liker1", html)
+            self.assertNotIn("@liker0", html)
+
+            next_page = re.search(r'href="([^"]*before_id=[^"]*)"', html)
+            html = self.client.get(
+                unescape(next_page.group(1))).get_data(as_text=True)
+
+            self.assertIn("@liker0", html)
+            self.assertNotIn("@liker1", html)
+            self.assertNotIn("before_id=", html)
@@ -0,0 +1,87 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+import os
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+import app as warbler
+from unittest import TestCase
+
+from sqlalchemy import inspect, text
+
+from models import db, SchemaMigration, LikeCount, LikeTotal
+from migrations import MIGRATIONS, run_migrations, pending_migrations
+
+# Building the app, on first use, pushes the app context db needs.
+warbler.app
+
+db.drop_all()
+db.create_all()
+
+
+def index_names(table):
+    """Names of the indexes on `table` in the test database."""
+
+    return {index['name'] for index in inspect(db.engine).get_indexes(table)}
+
+
+class MigrationTestCase(TestCase):
+    def setUp(self):
+        SchemaMigration.query.delete()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_run_migrations(self):
+        """Every migration is applied and recorded once"""
+
+        applied = run_migrations(db.engine)
+
+        self.assertEqual([m.version for m in applied],
+                         [m.version for m in MIGRATIONS])
+        self.assertEqual(SchemaMigration.query.count(), len(MIGRATIONS))
+        self.assertEqual(pending_migrations(db.engine), [])
+        self.assertEqual(run_migrations(db.engine), [])
+
+    def test_hot_path_indexes_rebuilt(self):
+        """Missing indexes are built by the index migration"""
+
+        with db.engine.begin() as conn:
+            conn.execute(text("DROP INDEX ix_messages_user_id_timestamp"))
+            conn.execute(text(
+                "DROP INDEX ix_follows_user_following_id_followed_id"))
+
+        self.assertNotIn('ix_messages_user_id_timestamp',
+                         index_names('messages'))
+
+        run_migrations(db.engine)
+
+        self.assertIn('ix_messages_user_id_timestamp', index_names('messages'))
+        self.assertIn('ix_follows_user_following_id_followed_id',
+                      index_names('follows'))
+        # Superseded by the paging index
+        self.assertNotIn('ix_follows_user_following_id', index_names('follows'))
+        self.assertIn('ix_likes_message_id_timestamp', index_names('likes'))
+        self.assertNotIn('ix_likes_message_id', index_names('likes'))
+
+    def test_like_totals_backfilled(self):
+        """The like_totals migration sums the existing buckets"""
+
+        LikeCount.query.delete()
+        LikeTotal.query.delete()
+        db.session.add_all([
+            LikeCount(hour=1, message_id=10, user_id=1, count=2),
+            LikeCount(hour=2, message_id=10, user_id=1, count=3),
+            LikeCount(hour=2, message_id=11, user_id=1, count=1),
+        ])
+        db.session.commit()
+
+        run_migrations(db.engine)
+
+        self.assertEqual(
+            {(total.message_id, total.likes) for total in LikeTotal.query},
+            {(10, 5), (11, 1)})
@@ -0,0 +1,152 @@
+"""Messages partitioning tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_partitions.py
+import os
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+import app as warbler
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import event, text
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User, Message, Like
+from migrations import run_migrations
+from partitions import (
+    is_partitioned, list_partitions, partition_name, month_start,
+    create_partitions_ahead, detach_partitions_before,
+)
+
+# Building the app, on first use, pushes the app context db needs.
+warbler.app
+
+
+class PartitionTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        db.drop_all()
+        db.create_all()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        db.session.add_all([
+            Message(text="old", user_id=u1.id,
+                    timestamp=datetime(2021, 3, 14, 15, 9)),
+            Message(text="new", user_id=u1.id),
+        ])
+        db.session.commit()
+
+        cls.u1_id = u1.id
+        cls.u2_id = u2.id
+        db.session.rollback()
+
+        run_migrations(db.engine)
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_messages_partitioned(self):
+        """Existing messages are copied into monthly partitions"""
+
+        with db.engine.connect() as conn:
+            self.assertTrue(is_partitioned(conn))
+            names = [name for name, _, _ in list_partitions(conn)]
+
+        self.assertIn("messages_p2021_03", names)
+        self.assertIn(partition_name(month_start(datetime.utcnow())), names)
+        self.assertLessEqual(
+            {"old", "new"}, {m.text for m in Message.query.all()})
+
+    def test_recent_by_users_prunes_partitions(self):
+        """Timeline queries only scan the latest partitions"""
+
+        query = (Message.query
+                 .filter(Message.user_id.in_([self.u1_id]))
+                 .filter(Message.timestamp >=
+                         datetime.utcnow() - timedelta(days=7)))
+
+        plan = "\n".join(db.session.execute(
+            text("EXPLAIN " + str(query.statement.compile(
+                db.engine, compile_kwargs={"literal_binds": True}))),
+        ).scalars())
+
+        self.assertNotIn("messages_p2021_03", plan)
+        self.assertEqual(
+            [m.text for m in Message.recent_by_users([self.u1_id])][0], "new")
+
+    def test_recent_by_users_fallback(self):
+        """Short of recent messages, one more query fills in older ones"""
+
+        db.session.add_all([
+            Message(text="recent", user_id=self.u2_id),
+            Message(text="last month", user_id=self.u2_id,
+                    timestamp=datetime.utcnow() - timedelta(days=30)),
+        ])
+        db.session.commit()
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if statement.lstrip().upper().startswith("SELECT"):
+                statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+
+        try:
+            messages = Message.recent_by_users([self.u2_id], limit=10)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+
+        self.assertEqual([m.text for m in messages], ["recent", "last month"])
+        self.assertEqual(len(statements), 2)
+
+    def test_likes_follow_message_deletes(self):
+        """Deleting a message still deletes its likes"""
+
+        msg = Message(text="liked", user_id=self.u1_id)
+        db.session.add(msg)
+        db.session.flush()
+        db.session.add(Like(user_id=self.u2_id, message_id=msg.id))
+        db.session.commit()
+
+        with db.engine.begin() as conn:
+            conn.execute(text("DELETE FROM messages WHERE id = :id"),
+                         {"id": msg.id})
+
+        self.assertEqual(Like.query.filter_by(message_id=msg.id).count(), 0)
+
+    def test_like_requires_message(self):
+        """Liking a message that doesn't exist is an integrity error"""
+
+        db.session.add(Like(user_id=self.u2_id, message_id=999999))
+
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+
+    def test_partitions_created_ahead_and_detached(self):
+        """Future partitions are created, and old ones detached"""
+
+        in_a_year = datetime.utcnow() + timedelta(days=365)
+        created = create_partitions_ahead(db.engine, now=in_a_year)
+        self.assertIn(partition_name(month_start(in_a_year)), created)
+
+        detached = detach_partitions_before(
+            db.engine, cutoff=datetime(2021, 4, 1))
+        self.assertIn("messages_p2021_03", detached)
+        self.assertEqual(Message.query.filter_by(text="old").count(), 0)
+
+        with db.engine.begin() as conn:
+            for name in detached:
+                conn.execute(text(f"DROP TABLE {name}"))
@@ -0,0 +1,95 @@
+"""Connection pool tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pooling.py
+import os
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError
+
+from models import db
+from pooling import (
+    InstrumentedQueuePool, engine_options, pool_config_from_env,
+)
+
+
+class PoolingTestCase(TestCase):
+    def setUp(self):
+        db.session.remove()
+
+    def test_engine_options_from_env(self):
+        """Pool settings come from the environment"""
+
+        config = pool_config_from_env({
+            'DB_POOL_SIZE': '20',
+            'DB_MAX_OVERFLOW': '5',
+            'DB_POOL_PRE_PING': 'false',
+        })
+        options = engine_options(config)
+
+        self.assertEqual(options['pool_size'], 20)
+        self.assertEqual(options['max_overflow'], 5)
+        self.assertEqual(options['pool_pre_ping'], False)
+        self.assertEqual(options['pool_recycle'], 1800)
+        self.assertIs(options['poolclass'], InstrumentedQueuePool)
+
+    def test_pgbouncer_mode(self):
+        """Behind PgBouncer the app's own pool doesn't overflow"""
+
+        config = pool_config_from_env({'DB_PGBOUNCER': 'true'})
+
+        self.assertEqual(engine_options(config)['max_overflow'], 0)
+
+    def test_primary_pool_instrumented(self):
+        """The app's engine reports pool usage at /metrics"""
+
+        self.assertIsInstance(db.engine.pool, InstrumentedQueuePool)
+
+        with db.engine.connect():
+            html = app.test_client().get("/metrics").get_data(as_text=True)
+
+        self.assertIn('warbler_db_pool_checked_out{pool="primary"} 1', html)
+        self.assertIn('warbler_db_pool_checkouts_total{pool="primary"}', html)
+
+    def test_metrics_restricted(self):
+        """/metrics answers local scrapes, or only the METRICS_TOKEN"""
+
+        client = app.test_client()
+        remote = {'REMOTE_ADDR': '203.0.113.9'}
+
+        self.assertEqual(
+            client.get("/metrics", environ_base=remote).status_code, 404)
+
+        with patch.dict(app.config, {'METRICS_TOKEN': 's3cret'}):
+            self.assertEqual(client.get("/metrics").status_code, 404)
+            self.assertEqual(client.get(
+                "/metrics", environ_base=remote,
+                headers={'Authorization': 'Bearer wrong'}).status_code, 404)
+            self.assertEqual(client.get(
+                "/metrics", environ_base=remote,
+                headers={'Authorization': 'Bearer s3cret'}).status_code, 200)
+
+    def test_pool_wait_and_timeout(self):
+        """Time spent waiting for a connection, and timeouts, are counted"""
+
+        engine = create_engine(
+            app.config['SQLALCHEMY_DATABASE_URI'],
+            **engine_options({'DB_POOL_SIZE': 1, 'DB_MAX_OVERFLOW': 0,
+                              'DB_POOL_TIMEOUT': 0.2}, "test"))
+
+        with engine.connect():
+            with self.assertRaises(TimeoutError):
+                engine.connect()
+
+        self.assertEqual(engine.pool.timeouts, 1)
+        self.assertEqual(engine.pool.waiting, 0)
+        self.assertGreaterEqual(engine.pool.wait_seconds, 0.2)
+
+        engine.dispose()
@@ -0,0 +1,151 @@
+"""Request profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiling.py
+import os
+import sys
+import time
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from flask import Flask
+
+from async_db import ASYNC_IO_KEY
+from profiling import Profiler, Ring, fold, merged
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class RingTestCase(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_keeps_highest_ranked(self):
+        """Past `keep` profiles, the lowest-ranked are dropped"""
+
+        ring = Ring(self.directory.name, keep=2)
+
+        for rank in (30, 10, 20, 5):
+            ring.add(rank, "warbler.homepage", {"a;b": rank})
+
+        self.assertEqual(
+            [name.split("-")[0] for name in ring.files()],
+            ["000000000000020", "000000000000030"])
+        self.assertEqual(merged(ring), {"a;b": 50})
+
+    def test_expires(self):
+        """Profiles older than retain_seconds make way first"""
+
+        ring = Ring(self.directory.name, keep=2, retain_seconds=60)
+
+        ring.add(100, "old", {"a": 1}, now=1000)
+        ring.add(1, "new", {"a": 1}, now=1100)
+
+        self.assertEqual([name.split("-")[-1] for name in ring.files()],
+                         ["new.folded"])
+
+
+class ProfilerTestCase(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+
+        self.app = Flask(__name__)
+        self.app.config.update(
+            PROFILE_SAMPLE_RATE=0,
+            SLOW_REQUEST_SECONDS=0.05,
+            PROFILE_INTERVAL_SECONDS=0.001,
+            PROFILE_KEEP=10,
+            PROFILE_DIR=self.directory.name,
+        )
+
+        @self.app.get('/slow')
+        def slow():
+            busy(0.1)
+            return "slow"
+
+        @self.app.get('/fast')
+        def fast():
+            return "fast"
+
+        self.profiler = Profiler()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.profiler.stop()
+        self.directory.cleanup()
+
+    def ring_files(self, ring):
+        return os.listdir(os.path.join(self.directory.name, ring))
+
+    def test_slow_requests_kept(self):
+        """Only requests over SLOW_REQUEST_SECONDS land in the slow ring"""
+
+        self.profiler.init_app(self.app)
+
+        self.client.get('/fast')
+        self.client.get('/slow')
+
+        self.assertEqual(self.profiler.active, {})
+        (name,) = self.ring_files("slow")
+        self.assertTrue(name.endswith("-slow.folded"))
+        self.assertGreaterEqual(int(name.split("-")[0]), 100_000)
+
+        stacks = merged(self.profiler.slow_ring)
+        self.assertTrue(any(stack.startswith("slow;dispatch_request")
+                            and "busy (test_profiling.py" in stack
+                            for stack in stacks))
+        self.assertGreater(sum(stacks.values()), 10)
+
+    def test_sampled_requests(self):
+        """Sampled requests are kept whatever their time"""
+
+        self.app.config.update(PROFILE_SAMPLE_RATE=1, SLOW_REQUEST_SECONDS=0)
+        self.profiler.init_app(self.app)
+
+        self.client.get('/fast')
+        self.client.get('/fast')
+
+        self.assertEqual(len(self.ring_files("sampled")), 2)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory.name, "slow")))
+
+    def test_async_requests_skipped(self):
+        """Requests on the event loop share its thread, so aren't watched"""
+
+        self.app.config.update(PROFILE_SAMPLE_RATE=1)
+        self.profiler.init_app(self.app)
+
+        self.client.get('/slow', environ_overrides={ASYNC_IO_KEY: True})
+
+        self.assertIsNone(self.profiler.thread)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_off(self):
+        """With neither setting the profiler adds no hooks"""
+
+        self.app.config.update(SLOW_REQUEST_SECONDS=0)
+        self.profiler.init_app(self.app)
+
+        self.client.get('/slow')
+
+        self.assertIsNone(self.profiler.thread)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_fold(self):
+        """Stacks are folded outermost first"""
+
+        def inner():
+            return fold(sys._getframe())
+
+        stack = inner().split(";")
+
+        self.assertTrue(stack[-1].startswith("inner (test_profiling.py:"))
+        self.assertTrue(stack[-2].startswith("test_fold (test_profiling.py:"))
@@ -0,0 +1,146 @@
+"""Who to follow tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+import os
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import time
+from unittest import TestCase
+from unittest.mock import patch
+from tempfile import TemporaryDirectory
+
+import jobs
+import recommendations
+from follow_graph import follow_graph
+from models import db, User, Follow, Suggestion, Job
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class RecommendationsTestCase(TestCase):
+    def setUp(self):
+        Job.query.delete()
+        User.query.delete()
+
+        users = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(1, 6)
+        ]
+        db.session.flush()
+        self.ids = [None] + [user.id for user in users]
+        u = self.ids
+
+        # u1 follows u2 and u3, who both follow u4; u3 also follows u5
+        # and u1. Nobody follows u1 back except u3.
+        for follower, followed in [(1, 2), (1, 3), (2, 4), (3, 4), (3, 5),
+                                   (3, 1)]:
+            db.session.add(Follow(user_following_id=u[follower],
+                                  user_being_followed_id=u[followed]))
+        db.session.commit()
+
+        self.directory = TemporaryDirectory()
+        app.config['FOLLOW_GRAPH_PATH'] = os.path.join(
+            self.directory.name, "graph.bin")
+        follow_graph.init_app(app)
+        follow_graph.build_snapshot()
+        recommendations.cache.entries.clear()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['FOLLOW_GRAPH_PATH'] = None
+        follow_graph.init_app(app)
+        self.directory.cleanup()
+
+    def test_friends_of_friends(self):
+        """Candidates are ranked by mutual follows, then popularity"""
+
+        u = self.ids
+        scored = recommendations.score_candidates(u[1])
+
+        self.assertEqual([(candidate, mutual) for _, candidate, mutual in scored],
+                         [(u[4], 2), (u[5], 1)])
+
+    def test_popular_fallback(self):
+        """Someone following nobody is offered the most-followed accounts"""
+
+        u = self.ids
+        scored = recommendations.score_candidates(u[4])
+
+        self.assertEqual({candidate for _, candidate, _ in scored},
+                         {u[1], u[2], u[3], u[5]})
+
+    def test_refresh_and_sidebar(self):
+        """Precomputed suggestions appear in the home page sidebar"""
+
+        u = self.ids
+        self.assertEqual(recommendations.refresh_all(), 5)
+        self.assertEqual(
+            Suggestion.query.filter_by(user_id=u[1]).count(), 2)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u[1]
+
+            html = c.get("/").get_data(as_text=True)
+
+        self.assertIn('id="who-to-follow"', html)
+        self.assertIn("@u4", html)
+        self.assertIn("Followed by 2 you follow", html)
+
+    def test_follow_refreshes(self):
+        """Following a suggestion hides it straight away, and one job per
+        window recomputes the follower's suggestions"""
+
+        u = self.ids
+        recommendations.refresh_all()
+        recommendations.suggestions_for(u[1])
+
+        with patch.object(recommendations, 'REFRESH_SECONDS', 0.5):
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = u[1]
+
+                c.post(f"/users/follow/{u[4]}")
+                c.post(f"/users/stop-following/{u[4]}")
+                c.post(f"/users/follow/{u[4]}")
+
+            suggested = [s.id for s in recommendations.suggestions_for(u[1])]
+            self.assertEqual(suggested, [u[5]])
+            self.assertLessEqual(
+                Job.query.filter_by(kind='refresh_suggestions').count(), 2)
+            self.assertEqual(
+                Suggestion.query.filter_by(user_id=u[1]).count(), 2)
+
+            time.sleep(1)
+            jobs.run_pending()
+
+        self.assertEqual(
+            Suggestion.query.filter_by(user_id=u[1]).count(), 1)
+
+    def test_pending_deletion_hidden(self):
+        """Users waiting to be deleted aren't suggested"""
+
+        u = self.ids
+        recommendations.refresh_all()
+        db.session.get(User, u[4]).pending_deletion = True
+        db.session.commit()
+
+        suggested = [s.id for s in recommendations.suggestions_for(u[1])]
+        self.assertEqual(suggested, [u[5]])
+
+        Suggestion.query.delete()
+        db.session.commit()
+        recommendations.cache.entries.clear()
+
+        suggested = [s.id for s in recommendations.suggestions_for(u[1])]
+        self.assertEqual(suggested, [u[5]])
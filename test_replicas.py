@@ -0,0 +1,93 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+import os
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from unittest import TestCase
+
+from models import db, User
+from replicas import replicas, db_reads, LAST_WRITE_KEY
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class ReplicaTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        # The test database stands in for its own replica
+        replicas.configure([app.config['SQLALCHEMY_DATABASE_URI']])
+        self.max_lag_seconds = replicas.max_lag_seconds
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+        replicas.configure([])
+        replicas.max_lag_seconds = self.max_lag_seconds
+
+    def get_home(self, last_write=None):
+        """GET / as u1; return how many reads went to a replica."""
+
+        before = db_reads.get(role='replica')
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+                if last_write:
+                    sess[LAST_WRITE_KEY] = last_write
+
+            resp = c.get("/")
+
+        self.assertEqual(resp.status_code, 200)
+        return db_reads.get(role='replica') - before
+
+    def test_get_reads_from_replica(self):
+        """Read-only requests read from the replica"""
+
+        self.assertGreater(self.get_home(), 0)
+
+    def test_reads_own_writes_from_primary(self):
+        """After writing, a user reads from the primary for a while"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "Hello"})
+
+            with c.session_transaction() as sess:
+                last_write = sess[LAST_WRITE_KEY]
+
+        self.assertEqual(self.get_home(last_write), 0)
+        self.assertGreater(self.get_home(last_write - 60), 0)
+
+    def test_lagging_replica_skipped(self):
+        """A replica lagging too far behind isn't used"""
+
+        replicas.max_lag_seconds = -1
+
+        self.assertEqual(self.get_home(), 0)
+
+    def test_replica_lag_metric(self):
+        """Replica lag is reported at /metrics"""
+
+        self.get_home()
+        resp = self.client.get("/metrics")
+
+        self.assertIn('warbler_replica_lag_seconds{replica="0"} 0.0',
+                      resp.get_data(as_text=True))
@@ -0,0 +1,213 @@
+"""Shard routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_shards.py
+import os
+import tempfile
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import delete, func, select
+
+from models import (
+    db, User, Message, Like, Follow, ShardBucket, MessageTag, Mention,
+)
+from shards import shards, NUM_BUCKETS
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+# Two extra shards, each a SQLite database in a scratch directory
+shard_dir = tempfile.mkdtemp()
+SHARD_URLS = [f"sqlite:///{shard_dir}/shard{n}.db" for n in (1, 2)]
+
+
+def count_messages_on(shard):
+    """Number of messages stored on `shard`."""
+
+    return shards.session(shard).scalar(
+        select(func.count()).select_from(Message))
+
+
+class ShardTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        ShardBucket.query.delete()
+        db.session.commit()
+
+        shards.configure(SHARD_URLS)
+        shards.create_tables()
+
+        for shard in (1, 2):
+            session = shards.session(shard)
+            for model in (Like, MessageTag, Mention, Message):
+                session.execute(delete(model))
+            session.commit()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        # u2's messages live on shard 1
+        shards.move_buckets({self.u2_id % NUM_BUCKETS: 1}, wait=0)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        shards.remove_sessions()
+        shards.configure([])
+
+    def test_messages_routed_by_author(self):
+        """Messages are written to their author's shard"""
+
+        shards.add_message(self.u1_id, "on the primary")
+        shards.add_message(self.u2_id, "on shard 1")
+        shards.commit()
+
+        self.assertEqual(count_messages_on(0), 1)
+        self.assertEqual(count_messages_on(1), 1)
+        self.assertEqual(count_messages_on(2), 0)
+        self.assertEqual(shards.count_messages(self.u2_id), 1)
+
+    def test_recent_by_users_merges_shards(self):
+        """Timelines merge every shard's messages, newest first"""
+
+        for n in range(3):
+            shards.add_message(self.u1_id, f"u1 #{n}")
+            shards.add_message(self.u2_id, f"u2 #{n}")
+            shards.commit()
+
+        messages = shards.recent_by_users([self.u1_id, self.u2_id], limit=4)
+
+        self.assertEqual([m.text for m in messages],
+                         ["u2 #2", "u1 #2", "u2 #1", "u1 #1"])
+        self.assertEqual(messages[0].user.username, "u2")
+
+    def test_likes_live_with_message(self):
+        """Likes are stored, found and counted on the message's shard"""
+
+        message_id = shards.add_message(self.u2_id, "like me")
+        shards.commit()
+
+        msg = shards.get_message_or_404(message_id)
+        shards.toggle_like(self.u1_id, msg)
+        shards.commit()
+
+        self.assertEqual(shards.liked_message_ids(self.u1_id, [msg]),
+                         {message_id})
+        self.assertEqual(shards.count_likes(self.u1_id), 1)
+        self.assertEqual(
+            [m.id for m in shards.liked_messages(self.u1_id)], [message_id])
+
+    def test_like_count_on_shard(self):
+        """A message's like count follows likes, unlikes and deleted users"""
+
+        message_id = shards.add_message(self.u2_id, "count me")
+        shards.commit()
+
+        self.assertTrue(shards.toggle_like(
+            self.u1_id, shards.get_message_or_404(message_id)))
+        shards.commit()
+        self.assertEqual(shards.get_message_or_404(message_id).like_count, 1)
+
+        self.assertFalse(shards.toggle_like(
+            self.u1_id, shards.get_message_or_404(message_id)))
+        shards.commit()
+        self.assertEqual(shards.get_message_or_404(message_id).like_count, 0)
+
+        shards.toggle_like(self.u1_id, shards.get_message_or_404(message_id))
+        shards.delete_user_data(self.u1_id)
+        shards.commit()
+        self.assertEqual(shards.get_message_or_404(message_id).like_count, 0)
+
+    def test_move_buckets(self):
+        """Moving a bucket moves its messages and their likes"""
+
+        message_id = shards.add_message(self.u2_id, "moving #bags")
+        shards.commit()
+        shards.toggle_like(self.u1_id, shards.get_message_or_404(message_id))
+        shards.commit()
+
+        moved = shards.move_buckets({self.u2_id % NUM_BUCKETS: 2}, wait=0)
+
+        self.assertEqual(moved, 1)
+        self.assertEqual(count_messages_on(1), 0)
+        self.assertEqual(count_messages_on(2), 1)
+        self.assertEqual(shards.count_likes(self.u1_id), 1)
+        self.assertEqual(
+            [msg.id for msg, _ in shards.tagged_page("bags")], [message_id])
+
+    def test_failed_move_restored(self):
+        """A move that fails part way leaves the bucket on its source shard"""
+
+        bucket = self.u2_id % NUM_BUCKETS
+        message_id = shards.add_message(self.u2_id, "stay put")
+        shards.commit()
+        shards.toggle_like(self.u1_id, shards.get_message_or_404(message_id))
+        shards.commit()
+
+        copy_bucket = shards._copy_bucket
+
+        def copy_then_fail(*args):
+            copy_bucket(*args)
+            raise OSError("connection lost")
+
+        with patch.object(shards, '_copy_bucket', copy_then_fail):
+            with self.assertRaises(OSError):
+                shards.move_buckets({bucket: 2}, wait=0)
+
+        self.assertEqual(shards.bucket_map().get(bucket), (1, False))
+        self.assertEqual(count_messages_on(1), 1)
+        self.assertEqual(count_messages_on(2), 0)
+        self.assertEqual(shards.shard_for_write(self.u2_id), 1)
+
+    def test_move_rerun_after_partial_copy(self):
+        """Rerunning a killed move replaces what it had copied"""
+
+        bucket = self.u2_id % NUM_BUCKETS
+        message_id = shards.add_message(self.u2_id, "half way #there")
+        shards.commit()
+        shards.toggle_like(self.u1_id, shards.get_message_or_404(message_id))
+        shards.commit()
+
+        # As a mover killed after copying, before switching the bucket over
+        shards._set_bucket(bucket, 1, moving=True)
+        shards._copy_bucket(bucket, 1, 2)
+
+        moved = shards.move_buckets({bucket: 2}, wait=0)
+
+        self.assertEqual(moved, 1)
+        self.assertEqual(count_messages_on(1), 0)
+        self.assertEqual(count_messages_on(2), 1)
+        self.assertEqual(shards.bucket_map().get(bucket), (2, False))
+        self.assertEqual(shards.count_likes(self.u1_id), 1)
+
+    def test_homepage_across_shards(self):
+        """The home timeline shows followed users' messages from any shard"""
+
+        db.session.add(Follow(user_being_followed_id=self.u2_id,
+                              user_following_id=self.u1_id))
+        shards.add_message(self.u2_id, "from shard 1")
+        shards.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("from shard 1", html)
@@ -0,0 +1,93 @@
+"""Template bytecode cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_templating.py
+import os
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from unittest import TestCase
+from tempfile import TemporaryDirectory
+
+from jinja2 import DictLoader, Environment
+
+from templating import ContentHashBytecodeCache, TrimWhitespace
+
+
+class BytecodeCacheTestCase(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.cache = ContentHashBytecodeCache(self.directory.name)
+        self.templates = {'page.html': "Hello {{ name }}"}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def environment(self):
+        """Return a fresh environment, as a new worker would have."""
+
+        return Environment(
+            loader=DictLoader(self.templates), bytecode_cache=self.cache)
+
+    def bucket(self, source):
+        return self.cache.get_bucket(
+            self.environment(), 'page.html', None, source)
+
+    def test_shared_between_environments(self):
+        """A template compiled once is loaded from disk afterwards"""
+
+        self.assertIsNone(self.bucket(self.templates['page.html']).code)
+
+        self.environment().get_template('page.html')
+
+        self.assertIsNotNone(self.bucket(self.templates['page.html']).code)
+        template = self.environment().get_template('page.html')
+        self.assertEqual(template.render(name="Ann"), "Hello Ann")
+
+    def test_invalidated_by_content(self):
+        """Editing a template gives it a new cache entry"""
+
+        self.environment().get_template('page.html')
+        self.templates['page.html'] = "Goodbye {{ name }}"
+
+        self.assertIsNone(self.bucket(self.templates['page.html']).code)
+
+        template = self.environment().get_template('page.html')
+        self.assertEqual(template.render(name="Ann"), "Goodbye Ann")
+        self.assertEqual(len(os.listdir(self.directory.name)), 2)
+
+    def test_keyed_by_extensions(self):
+        """Trimmed and untrimmed templates have separate cache entries"""
+
+        self.environment().get_template('page.html')
+
+        trimmed = Environment(
+            loader=DictLoader(self.templates), bytecode_cache=self.cache,
+            extensions=[TrimWhitespace])
+        trimmed.get_template('page.html')
+
+        self.assertEqual(len(os.listdir(self.directory.name)), 2)
+
+
+class TrimWhitespaceTestCase(TestCase):
+    def render(self, source):
+        environment = Environment(
+            loader=DictLoader({'page.html': source}),
+            extensions=[TrimWhitespace])
+        return environment.get_template('page.html').render(name="Ann")
+
+    def test_trims_indentation(self):
+        """Indentation and blank lines are removed, newlines are kept"""
+
+        self.assertEqual(
+            self.render("<ul>\n\n    <li>\n      {{ name }} Lee\n"
+                        "    </li>\n</ul>\n"),
+            "<ul>\n<li>\nAnn Lee\n</li>\n</ul>")
+
+    def test_whitespace_sensitive_untouched(self):
+        """Templates with a <pre> or <textarea> aren't trimmed"""
+
+        source = "<pre>\n    {{ name }}\n</pre>"
+
+        self.assertEqual(self.render(source), "<pre>\n    Ann\n</pre>")
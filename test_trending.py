@@ -0,0 +1,179 @@
+"""Trending messages tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+import os
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from unittest import TestCase
+from unittest.mock import patch
+
+import trending
+from models import db, User, Message, Like, LikeCount, LikeTotal
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+HOUR = 3600
+
+
+class TrendingTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        LikeCount.query.delete()
+        LikeTotal.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        self.m1 = Message(text="first", user_id=u1.id)
+        self.m2 = Message(text="second", user_id=u1.id)
+        db.session.add_all([self.m1, self.m2])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.counters = trending.LikeCounters()
+        trending.counters.reset()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        trending.counters.reset()
+
+    def test_window(self):
+        """Likes count for WINDOW_HOURS hours, then drop out"""
+
+        now = 1_000 * HOUR
+        hours_ago = lambda hours: now - hours * HOUR
+
+        self.counters.record(self.m1, 1, now=now)
+        self.counters.record(self.m2, 1, now=hours_ago(2))
+        self.counters.record(self.m2, 1, now=hours_ago(3))
+        self.counters.record(self.m1, 1, now=hours_ago(trending.WINDOW_HOURS))
+        self.counters.flush(now=now)
+
+        top = self.counters.compute_top()
+
+        self.assertEqual([(entry.message_id, entry.likes) for entry in top],
+                         [(self.m2.id, 2), (self.m1.id, 1)])
+
+        # The m2 likes leave the window with their hours.
+        later = now + (trending.WINDOW_HOURS - 2) * HOUR
+        self.counters.flush(now=later)
+        top = self.counters.compute_top()
+
+        self.assertEqual([entry.message_id for entry in top], [self.m1.id])
+        self.assertEqual(
+            [(total.message_id, total.likes) for total in LikeTotal.query],
+            [(self.m1.id, 1)])
+
+    def test_flush_adds_up(self):
+        """Flushes add to existing buckets; unlikes subtract"""
+
+        now = 1_000 * HOUR
+
+        for delta in (1, 1, 1, -1):
+            self.counters.record(self.m1, delta, now=now)
+            self.counters.flush(now=now)
+
+        self.assertEqual(
+            db.session.get(LikeCount, (1_000, self.m1.id)).count, 2)
+        self.assertEqual(db.session.get(LikeTotal, self.m1.id).likes, 2)
+        self.assertEqual(self.counters.pending, {})
+
+    def test_expired_buckets_pruned(self):
+        """Buckets that leave the window are deleted on flush"""
+
+        now = 1_000 * HOUR
+
+        self.counters.record(self.m1, 1, now=now)
+        self.counters.flush(now=now)
+        self.counters.flush(now=now + trending.WINDOW_HOURS * HOUR)
+
+        self.assertEqual(LikeCount.query.count(), 0)
+        self.assertEqual(LikeTotal.query.count(), 0)
+
+    def test_prune_subtracts_once(self):
+        """Two processes pruning the same hour take its buckets off the
+        totals once"""
+
+        now = 1_000 * HOUR
+        other = trending.LikeCounters()
+
+        self.counters.record(self.m1, 1, now=now)
+        self.counters.record(self.m1, 1, now=now + HOUR)
+        self.counters.flush(now=now + HOUR)
+
+        later = now + trending.WINDOW_HOURS * HOUR
+        self.counters.flush(now=later)
+        other.flush(now=later)
+
+        self.assertEqual(db.session.get(LikeTotal, self.m1.id).likes, 1)
+        self.assertEqual(
+            [entry.likes for entry in other.compute_top()], [1])
+
+    def test_trending_page(self):
+        """Liking a message puts it on the trending page"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u2_id
+
+        resp = self.client.post(f"/messages/{self.m1.id}/like_or_unlike")
+        self.assertEqual(resp.status_code, 302)
+
+        self.assertIsNotNone(
+            db.session.get(Like, (self.u2_id, self.m1.id)).timestamp)
+
+        trending.counters.flush()
+        resp = self.client.get("/messages/trending")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("first", html)
+        self.assertNotIn("second", html)
+
+    def test_trending_page_cached(self):
+        """The page reads the cached top list between recomputes"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u2_id
+
+        self.client.get("/messages/trending")
+
+        self.counters.record(self.m2, 1)
+        self.counters.flush()
+        html = self.client.get("/messages/trending").get_data(as_text=True)
+
+        self.assertIn("Nothing has been liked today", html)
+
+    def test_flush_after_any_request(self):
+        """Counts are flushed after any request; a failed flush keeps them"""
+
+        trending.counters.record(self.m1, 1)
+        trending.counters.flushed_at = 0
+
+        with patch.object(trending.counters, '_write',
+                          side_effect=RuntimeError("database down")):
+            resp = self.client.get("/login")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(list(trending.counters.pending.values()),
+                         [[self.u1_id, 1]])
+
+        trending.counters.flushed_at = 0
+        self.client.get("/login")
+
+        self.assertEqual(trending.counters.pending, {})
+        self.assertEqual(
+            LikeCount.query.filter_by(message_id=self.m1.id).one().count, 1)
@@ -1,7 +1,10 @@
 import os
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, Message, User
+from sqlalchemy import event
+
+from models import db, Message, User, Follow
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -140,3 +143,105 @@ class UserAddViewTestCase(UserBaseViewTestCase):
 
         self.assertIn(">Access unauthorized.</div>", html)
 
+
+class UserPagesViewTestCase(UserBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # u3, u4 and u5 follow u2; u1 follows u4
+        others = [
+            User.signup(f"u{n}", f"u{n}@email.com", "password", None)
+            for n in (3, 4, 5)
+        ]
+        db.session.flush()
+        self.other_ids = [other.id for other in others]
+
+        for other_id in self.other_ids:
+            db.session.add(Follow(user_following_id=other_id,
+                                  user_being_followed_id=self.u2_id))
+        db.session.add(Follow(user_following_id=self.u1_id,
+                              user_being_followed_id=self.other_ids[1]))
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def test_followers_pages(self):
+        """Followers come a page at a time, in id order"""
+
+        with patch('app.PAGE_SIZE', 2):
+            resp = self.client.get(f"/users/{self.u2_id}/followers")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@u3", html)
+            self.assertIn("@u4", html)
+            self.assertNotIn("@u5", html)
+            self.assertIn(f"/users/stop-following/{self.other_ids[1]}", html)
+            self.assertIn(f"after={self.other_ids[1]}", html)
+
+            resp = self.client.get(
+                f"/users/{self.u2_id}/followers?after={self.other_ids[1]}")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("@u5", html)
+            self.assertNotIn("@u3", html)
+            self.assertNotIn("after=", html)
+
+    def test_following_page(self):
+        """The following page lists who the user follows"""
+
+        resp = self.client.get(f"/users/{self.other_ids[0]}/following")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@u2", html)
+        self.assertIn(f"/users/follow/{self.u2_id}", html)
+
+    def test_users_page_queries(self):
+        """The users page doesn't run a query per user listed"""
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if statement.lstrip().upper().startswith("SELECT"):
+                statements.append(statement)
+
+        def selects_for_users_page():
+            statements.clear()
+            event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                html = self.client.get("/users").get_data(as_text=True)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+            return html, len(statements)
+
+        html, few = selects_for_users_page()
+        self.assertIn(f"/users/stop-following/{self.other_ids[1]}", html)
+        self.assertIn(f"/users/follow/{self.u2_id}", html)
+
+        for n in range(6, 16):
+            User.signup(f"u{n}", f"u{n}@email.com", "password", None)
+        db.session.commit()
+
+        html, many = selects_for_users_page()
+        self.assertIn("@u15", html)
+        self.assertEqual(many, few)
+
+    def test_likes_pages(self):
+        """Liked messages come a page at a time, most recently liked first"""
+
+        for n in range(3):
+            message = Message(text=f"liked no. {n}", user_id=self.u2_id)
+            db.session.add(message)
+            db.session.commit()
+            self.client.post(f"/messages/{message.id}/like_or_unlike")
+
+        with patch('app.PAGE_SIZE', 2):
+            html = self.client.get(
+                f"/users/{self.u1_id}/likes").get_data(as_text=True)
+
+            self.assertIn("liked no. 2", html)
+            self.assertIn("liked no. 1", html)
+            self.assertNotIn("liked no. 0", html)
+            self.assertIn("before_id=", html)
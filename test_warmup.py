@@ -0,0 +1,64 @@
+"""Preload warm-up tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_warmup.py
+import os
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from unittest import TestCase
+
+from invalidation import bus
+from models import db
+from warmup import compile_templates, dispose_engines, warm_up
+
+
+class WarmUpTestCase(TestCase):
+    def setUp(self):
+        db.session.remove()
+
+    def test_compile_templates(self):
+        """Every template is compiled into the Jinja cache"""
+
+        names = compile_templates(app)
+
+        self.assertIn('home.html', names)
+        self.assertIn('users/detail.html', names)
+
+        cached = {name for _, name in app.jinja_env.cache.keys()}
+        self.assertLessEqual(set(names), cached)
+
+    def test_warm_up_closes_connections(self):
+        """No connections are left open for the workers to inherit"""
+
+        warm_up(app)
+
+        self.assertEqual(db.engine.pool.checkedin(), 0)
+        self.assertEqual(db.engine.pool.checkedout(), 0)
+
+    def test_warm_up_doesnt_listen(self):
+        """The warm-up requests leave the invalidation listener to the
+        workers"""
+
+        bus.stop()
+        bus.pid = None
+
+        warm_up(app)
+
+        self.assertIsNone(bus.pid)
+        self.assertEqual(bus.engine.pool.checkedout(), 0)
+
+    def test_dispose_after_fork(self):
+        """A worker forgets its parent's connections without closing them"""
+
+        db.session.execute(db.select(1))
+        connection = db.session.connection().connection.dbapi_connection
+        db.session.remove()
+
+        dispose_engines(app, close=False)
+
+        self.assertEqual(db.engine.pool.checkedin(), 0)
+        self.assertEqual(connection.closed, 0)
+        connection.close()
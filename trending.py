@@ -0,0 +1,241 @@
+"""Trending messages: the most liked over the last WINDOW_HOURS hours.
+
+Likes are counted into hourly buckets, rows of the like_counts table keyed by
+(hour, message). A message's score is the sum of its last WINDOW_HOURS
+buckets, so the window slides forward an hour at a time. Buckets are deleted
+as they fall out of the window, so the table is a ring of WINDOW_HOURS
+hours.
+
+That sum is kept running in the like_totals table, one row per message:
+each flush adds its counts to both tables in one transaction, and the
+first flush of each hour deletes the expired buckets and subtracts them
+from the totals in one statement. A message's total is therefore always
+the sum of its like_counts rows.
+
+Counting is cheap under heavy liking:
+
+- A like or unlike only adds to a counter in this process's memory. After
+  any request, once FLUSH_SECONDS have passed since the last flush, the
+  counters are written as one multi-row upsert, however many likes came
+  in, so busy messages don't make each like queue on the same row lock. A
+  flush that fails is logged and its counts are kept for the next one.
+- The top TOP_N is read from the totals' (likes DESC) index, TOP_N rows
+  however many messages were liked in the window, at most every
+  TOP_SECONDS per process; the trending page reads that cached list.
+
+Counts still waiting to be flushed when a worker exits are lost, so the
+counts are approximate; the likes table stays exact.
+"""
+
+import logging
+import time
+from collections import namedtuple
+from threading import Lock
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, LikeCount, LikeTotal
+
+logger = logging.getLogger(__name__)
+
+WINDOW_HOURS = 24
+TOP_N = 20
+
+FLUSH_SECONDS = 5
+TOP_SECONDS = 30
+
+TrendingMessage = namedtuple('TrendingMessage', ['message_id', 'user_id', 'likes'])
+
+
+def current_hour(now=None):
+    """Hours since the Unix epoch."""
+
+    return int((time.time() if now is None else now) // 3600)
+
+
+class LikeCounters:
+    """Hourly like counters; see the module docstring.
+
+    The locks only guard the in-memory state and are never held while
+    talking to the database, as in ShardRouter.bucket_map.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # {(hour, message id): [author id, net likes]}
+        self.pending = {}
+        self.flushed_at = time.monotonic()
+        self.pruned_hour = None
+        self._top = []
+        self._top_loaded_at = None
+
+    def init_app(self, app):
+        """Flush the app's counts after its requests."""
+
+        app.after_request(self.flush_after_request)
+
+    def record(self, msg, delta, now=None):
+        """Count a like (`delta` 1) or unlike (-1) of `msg`."""
+
+        key = (current_hour(now), msg.id)
+
+        with self.lock:
+            counter = self.pending.setdefault(key, [msg.user_id, 0])
+            counter[1] += delta
+
+    def flush_after_request(self, response):
+        self.maybe_flush()
+        return response
+
+    def maybe_flush(self):
+        """Flush if FLUSH_SECONDS have passed since the last flush."""
+
+        with self.lock:
+            if time.monotonic() - self.flushed_at < FLUSH_SECONDS:
+                return
+
+            self.flushed_at = time.monotonic()
+
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Flushing like counts failed")
+
+    def flush(self, now=None):
+        """Add the pending counts to like_counts and drop expired buckets.
+
+        If the write fails the counts go back to pending, added to any
+        recorded since, and the error is raised.
+        """
+
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.flushed_at = time.monotonic()
+
+        try:
+            self._write(pending, now)
+        except Exception:
+            with self.lock:
+                for key, (user_id, count) in pending.items():
+                    counter = self.pending.setdefault(key, [user_id, 0])
+                    counter[1] += count
+            raise
+
+    def _write(self, pending, now):
+        """Upsert `pending` into like_counts and like_totals, and prune, in
+        one transaction.
+
+        Rows are written in key order, so concurrent flushes lock them in
+        the same order.
+        """
+
+        rows = [
+            dict(hour=hour, message_id=message_id, user_id=user_id, count=count)
+            for (hour, message_id), (user_id, count) in sorted(pending.items())
+            if count
+        ]
+
+        totals = {}
+
+        for row in rows:
+            total = totals.setdefault(
+                row['message_id'],
+                dict(message_id=row['message_id'], user_id=row['user_id'],
+                     likes=0))
+            total['likes'] += row['count']
+
+        hour = current_hour(now)
+        prune = self.pruned_hour != hour
+
+        if not rows and not prune:
+            return
+
+        with db.engine.begin() as conn:
+            if rows:
+                statement = insert(LikeCount)
+                conn.execute(
+                    statement.on_conflict_do_update(
+                        index_elements=[LikeCount.hour, LikeCount.message_id],
+                        set_={'count': LikeCount.count + statement.excluded.count}),
+                    rows)
+
+                conn.execute(
+                    self._add_to_totals(insert(LikeTotal)),
+                    [totals[message_id] for message_id in sorted(totals)])
+
+            if prune:
+                self._prune(conn, hour - WINDOW_HOURS)
+
+        self.pruned_hour = hour
+
+    def _add_to_totals(self, statement):
+        return statement.on_conflict_do_update(
+            index_elements=[LikeTotal.message_id],
+            set_={'likes': LikeTotal.likes + statement.excluded.likes})
+
+    def _prune(self, conn, last_expired_hour):
+        """Delete the buckets up to `last_expired_hour` and subtract them
+        from the totals, then drop totals that came to nothing.
+
+        Two processes pruning at once can't both subtract a bucket: only
+        the one whose DELETE removed it sees it returned.
+        """
+
+        expired = (
+            delete(LikeCount)
+            .where(LikeCount.hour <= last_expired_hour)
+            .returning(LikeCount.message_id, LikeCount.user_id, LikeCount.count)
+            .cte('expired'))
+
+        conn.execute(
+            self._add_to_totals(
+                insert(LikeTotal).from_select(
+                    ['message_id', 'user_id', 'likes'],
+                    select(expired.c.message_id, func.max(expired.c.user_id),
+                           -func.sum(expired.c.count))
+                    .group_by(expired.c.message_id)
+                    .order_by(expired.c.message_id)))
+            .add_cte(expired))
+
+        # Only exact zeros: a negative total still matches its buckets.
+        conn.execute(delete(LikeTotal).where(LikeTotal.likes == 0))
+
+    def compute_top(self, limit=TOP_N):
+        """Return the `limit` most liked messages in the window, best first."""
+
+        rows = db.session.execute(
+            select(LikeTotal.message_id, LikeTotal.user_id, LikeTotal.likes)
+            .where(LikeTotal.likes > 0)
+            .order_by(LikeTotal.likes.desc(), LikeTotal.message_id.desc())
+            .limit(limit))
+
+        return [TrendingMessage(*row) for row in rows]
+
+    def top(self):
+        """Return the cached top TOP_N, recomputing it every TOP_SECONDS."""
+
+        with self.lock:
+            loaded_at = self._top_loaded_at
+
+            if loaded_at is not None and time.monotonic() - loaded_at <= TOP_SECONDS:
+                return self._top
+
+        top = self.compute_top()
+
+        with self.lock:
+            self._top = top
+            self._top_loaded_at = time.monotonic()
+
+        return top
+
+    def reset(self):
+        """Forget pending counts and the cached top list."""
+
+        with self.lock:
+            self.pending = {}
+            self._top = []
+            self._top_loaded_at = None
+
+
+counters = LikeCounters()
@@ -0,0 +1,95 @@
+"""Warm the app up before gunicorn forks its workers.
+
+With preload_app (see gunicorn.conf.py) the app is created once in the
+master process. warm_up then does the work each worker would otherwise do on
+its first requests, so the forked workers share the results copy-on-write:
+
+- compile every template under templates/
+- configure the SQLAlchemy mappers
+- load in-process caches (the shard bucket map, the follow graph snapshot)
+- serve the homepage once, anonymously and as the first user, so SQLAlchemy
+  has compiled the hot-path queries (the compiled statements are cached on
+  the engines, which the workers inherit)
+
+Connections must never be shared between processes, so warm_up closes every
+pool when it's done, and each worker drops whatever it inherited after the
+fork with dispose_engines(app, close=False). The homepage requests don't
+start the invalidation listener (see invalidation.py): each worker starts
+its own on its first request.
+"""
+
+from sqlalchemy.orm import configure_mappers
+
+from app import CURR_USER_KEY
+from models import db, User
+from follow_graph import follow_graph
+from invalidation import bus
+from replicas import replicas
+from shards import shards
+
+
+def compile_templates(app):
+    """Compile every template into the app's Jinja cache; return their names."""
+
+    names = app.jinja_env.list_templates()
+
+    for name in names:
+        app.jinja_env.get_template(name)
+
+    return names
+
+
+def warm_homepage(app):
+    """Request the homepage anonymously and, if there's a user, logged in."""
+
+    with app.app_context():
+        user_id = db.session.scalar(
+            db.select(User.id).order_by(User.id).limit(1))
+
+    client = app.test_client()
+    bus.paused = True
+
+    try:
+        client.get('/')
+
+        if user_id is not None:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = user_id
+
+            client.get('/')
+
+    finally:
+        bus.paused = False
+
+
+def dispose_engines(app, close=True):
+    """Drop the pooled connections of every engine the app uses.
+
+    In a freshly forked worker pass close=False: the connections belong to
+    the parent, so they're forgotten rather than closed.
+    """
+
+    with app.app_context():
+        engines = list(db.engines.values())
+
+    if bus.engine is not None:
+        engines.append(bus.engine)
+
+    for engine in engines + shards.engines + replicas.engines:
+        engine.dispose(close=close)
+
+
+def warm_up(app):
+    """Do the app's one-time setup now, then close its connections."""
+
+    compile_templates(app)
+    configure_mappers()
+
+    with app.app_context():
+        shards.bucket_map()
+        # Here rather than on a thread the forked workers wouldn't have
+        follow_graph.rebuild_if_stale(wait=True)
+        follow_graph.refresh(force=True)
+
+    warm_homepage(app)
+    dispose_engines(app)